@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# This file is part of the CernVM File System.
+#
+
+# Benchmark of the shrinkwrap spec tools on synthetic traces from
+# make_trace.py.  For every trace size the tools run as separate
+# processes, like in trace.sh, and their wall time, rows per second and
+# peak resident memory are reported.  Traces are kept in the work
+# directory and reused by later runs.
+#
+# With --save the results are written as JSON.  With --baseline they are
+# compared against such a file, and the exit code is 1 if a tool got
+# slower or bigger than the tolerance allows.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+def script(name):
+  return os.path.join(scriptDir, name)
+
+def run(argv):
+  # Run a command and return its wall time and peak RSS in bytes
+  start = time.time()
+  with open(os.devnull, "w") as devnull:
+    process = subprocess.Popen(argv, stdout=devnull)
+    (pid, status, usage) = os.wait4(process.pid, 0)
+  elapsed = time.time() - start
+  process.returncode = os.waitstatus_to_exitcode(status)
+  maxRss = usage.ru_maxrss
+  if sys.platform != "darwin":
+    maxRss *= 1024
+  return (process.returncode, elapsed, maxRss)
+
+class SpecBenchmark:
+  def __init__(self, args):
+    self.workDir = args.workdir
+    self.generator = args.generator
+    self.skew = args.skew
+    self.jobs = args.jobs
+    self.results = []
+
+  def trace(self, rows, seed):
+    traceName = os.path.join(self.workDir, "trace-%d-%d.csv" % (rows, seed))
+    if not os.path.exists(traceName):
+      argv = [sys.executable, script("make_trace.py"), "-r", str(rows),
+              "-k", str(self.skew), "-e", str(seed)] + self.generator
+      code = subprocess.call(argv + [traceName + ".tmp"],
+                             stdout=subprocess.DEVNULL)
+      if code != 0:
+        raise RuntimeError("make_trace.py failed for " + str(rows) + " rows")
+      os.rename(traceName + ".tmp", traceName)
+    return traceName
+
+  def measure(self, tool, rows, argv, okCodes=(0,)):
+    (code, elapsed, maxRss) = run([sys.executable] + argv)
+    result = {"tool": tool, "rows": rows, "seconds": elapsed,
+              "maxRss": maxRss, "ok": code in okCodes}
+    self.results.append(result)
+    print("%-16s %12d %10.2f %12.0f %10.1f%s" %
+          (tool, rows, elapsed, rows / elapsed if elapsed else 0,
+           maxRss / 1048576.0, "" if result["ok"] else "  FAILED"))
+    sys.stdout.flush()
+
+  def run_size(self, rows):
+    traces = [self.trace(rows, 0), self.trace(rows, 1)]
+    prefix = os.path.join(self.workDir, "bench-%d" % rows)
+    self.measure("spec_builder", rows,
+      [script("spec_builder.py"), "-j", "1", traces[0], prefix + ".pdir.spec"])
+    self.measure("spec_builder-j", 2*rows,
+      [script("spec_builder.py"), "-j", str(self.jobs)] + traces +
+      [prefix + ".multi.spec"])
+    self.measure("spec_builder-ex", rows,
+      [script("spec_builder.py"), "-j", "1", "--policy", "exact", traces[1],
+       prefix + ".exact.spec"])
+    self.measure("trace_compact", rows,
+      [script("trace_compact.py"), traces[0], prefix + ".cpt"])
+    self.measure("spec_builder-cpt", rows,
+      [script("spec_builder.py"), "-j", "1", prefix + ".cpt",
+       prefix + ".cpt.spec"])
+    # rows are a proxy for the size of the specs spec_diff merges
+    self.measure("spec_diff", rows,
+      [script("spec_diff.py"), "3", prefix + ".pdir.spec",
+       prefix + ".exact.spec", prefix + ".diff.spec"])
+    self.measure("spec_test", rows,
+      [script("spec_test.py"), "-q", traces[0], prefix + ".pdir.spec"])
+    # the trace of seed 1 is not fully covered by the spec of seed 0
+    self.measure("spec_test-miss", rows,
+      [script("spec_test.py"), "-q", traces[1], prefix + ".pdir.spec"],
+      okCodes=(0, 1))
+
+  def compare(self, baselineName, tolerance):
+    # Return the regressions against a saved run
+    with open(baselineName, "r") as baselineFile:
+      baseline = dict(((r["tool"], r["rows"]), r)
+                      for r in json.load(baselineFile)["results"])
+    regressions = []
+    for result in self.results:
+      old = baseline.get((result["tool"], result["rows"]))
+      if old is None:
+        continue
+      for key in ("seconds", "maxRss"):
+        if result[key] > old[key] * (1 + tolerance):
+          regressions.append("%s at %d rows: %s %.4g -> %.4g" %
+            (result["tool"], result["rows"], key, old[key], result[key]))
+    return regressions
+
+def parse_args():
+  argparser = argparse.ArgumentParser()
+
+  argparser.add_argument("rows",
+    type=float,
+    nargs="*",
+    default=[1e4, 1e5, 1e6],
+    help="Trace sizes in rows, e.g. 1e4 1e6 1e8")
+
+  argparser.add_argument("--workdir", "-w",
+    required=False,
+    default="/tmp/cvmfs-spec-bench",
+    type=str,
+    help="Directory for the traces and specs")
+
+  argparser.add_argument("--skew", "-k",
+    required=False,
+    default=1.0,
+    type=float,
+    help="Zipf exponent of the file popularity in the traces")
+
+  argparser.add_argument("--generator",
+    required=False,
+    default="-d 5 -n 5 -f 40",
+    type=str,
+    help="Further make_trace.py options shaping the repository")
+
+  argparser.add_argument("--jobs", "-j",
+    required=False,
+    default=2,
+    type=int,
+    help="Processes of the multi-trace spec_builder run")
+
+  argparser.add_argument("--save",
+    required=False,
+    default=None,
+    type=str,
+    help="Write the results as JSON to this file")
+
+  argparser.add_argument("--baseline",
+    required=False,
+    default=None,
+    type=str,
+    help="Compare against the JSON results of an earlier run")
+
+  argparser.add_argument("--tolerance",
+    required=False,
+    default=0.25,
+    type=float,
+    help="Allowed relative increase of time and memory over the baseline")
+
+  args = argparser.parse_args()
+  args.generator = args.generator.split()
+  return args
+
+def main():
+  args = parse_args()
+  if not os.path.isdir(args.workdir):
+    os.makedirs(args.workdir)
+  bench = SpecBenchmark(args)
+  print("%-16s %12s %10s %12s %10s" %
+        ("tool", "rows", "seconds", "rows/s", "max MB"))
+  for rows in args.rows:
+    bench.run_size(int(rows))
+  failed = [r for r in bench.results if not r["ok"]]
+  if args.save:
+    with open(args.save, "w") as saveFile:
+      json.dump({"skew": args.skew, "generator": args.generator,
+                 "results": bench.results}, saveFile, indent=2)
+  if args.baseline:
+    regressions = bench.compare(args.baseline, args.tolerance)
+    for regression in regressions:
+      print("REGRESSION: " + regression)
+    if regressions:
+      sys.exit(1)
+  if failed:
+    sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,9 @@
 #
 
 import argparse
-from docker_injector import DockerInjector
+from docker_injector import BatchInjector, DockerInjector, default_cache_dir
 import fileinput
+import sys
 import tempfile
 
 argparser = argparse.ArgumentParser()
@@ -28,12 +29,67 @@ argparser.add_argument("--dest_tag",
   required=False,
   default="cvmfs",
   type=str)
+argparser.add_argument("--threads",
+  required=False,
+  default=None,
+  type=int,
+  help="Number of threads compressing the layer, default one per CPU")
+argparser.add_argument("--max_deltas",
+  required=False,
+  default=0,
+  type=int,
+  help="Inject only the changes since prepare as delta layers, up to this many "
+       "before the layer is compacted again, default 0 always injects the full layer")
+argparser.add_argument("--images",
+  required=False,
+  default=None,
+  type=str,
+  help="File with further images to inject into, one \"image [source_tag]\" per line")
+argparser.add_argument("--workers",
+  required=False,
+  default=8,
+  type=int,
+  help="Number of images injected into at the same time")
+argparser.add_argument("--chunk_size",
+  required=False,
+  default=16,
+  type=int,
+  help="Size of the chunks layers are uploaded in, in MB")
+argparser.add_argument("--insecure",
+  required=False,
+  action="store_true",
+  help="Access the registry over plain HTTP")
+argparser.add_argument("--cache_dir",
+  required=False,
+  default=default_cache_dir(),
+  type=str,
+  help="Directory caching manifests by digest, \"\" disables the cache")
 args = argparser.parse_args()
 
-injector = DockerInjector(args.host, args.image, args.source_tag, args.user, args.pw)
+if args.images:
+  if args.command != "inject":
+    argparser.error("--images only works with the inject command")
+  if args.max_deltas > 0:
+    argparser.error("--images injects the full layer and does not take --max_deltas")
+  targets = [(args.image, args.source_tag)]
+  with open(args.images) as images_file:
+    for line in images_file:
+      fields = line.split()
+      if fields and not fields[0].startswith("#"):
+        targets.append((fields[0], fields[1] if len(fields) > 1 else args.source_tag))
+  batch = BatchInjector(args.host, targets, args.user, args.pw,
+    threads=args.threads, workers=args.workers, chunk_size=args.chunk_size << 20,
+    insecure=args.insecure, cache_dir=args.cache_dir or None)
+  if batch.update(args.dir, args.dest_tag):
+    sys.exit(1)
+  sys.exit(0)
+
+injector = DockerInjector(args.host, args.image, args.source_tag, args.user, args.pw,
+  threads=args.threads, chunk_size=args.chunk_size << 20, insecure=args.insecure,
+  cache_dir=args.cache_dir or None)
 if args.command == "init":
   injector.setup(args.dest_tag)
 elif args.command == "prepare":
-  injector.unpack(args.dir)
+  injector.unpack(args.dir, index=args.max_deltas > 0)
 elif args.command == "inject":
-  injector.update(args.dir, args.dest_tag)
\ No newline at end of file
+  injector.update(args.dir, args.dest_tag, args.max_deltas)
\ No newline at end of file
@@ -2,15 +2,28 @@
 # This file is part of the CernVM File System.
 #
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from dxf import DXF, hash_file, hash_bytes
-from dxf.exceptions import DXFUnauthorizedError
+from dxf.exceptions import DXFUnauthorizedError, DXFMountFailed
+import hashlib
+import io
 import json
+import queue
+import re
+import shutil
+import stat
 import subprocess
+import struct
 import tarfile
 import tempfile
-from requests.exceptions import HTTPError
+import threading
+import time
+import requests
+from requests.exceptions import HTTPError, RequestException
 import os
+import urllib.parse as urlparse
 import zlib
 
 def exec_bash(cmd):
@@ -18,6 +31,370 @@ def exec_bash(cmd):
   output, error = process.communicate()
   return (output, error)
 
+class ParallelGzip:
+  """
+  Gzip compressor which deflates blocks of its input in a pool of threads,
+  like pigz. zlib releases the GIL while compressing, so the blocks are
+  compressed in parallel. Every block is primed with the last 32 KB of
+  the previous one and ends on a byte boundary, so the blocks concatenate
+  to a single deflate stream. The gzip header has no name and time stamp,
+  so the same input always gives the same digest.
+  """
+  header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+  window = 32768
+
+  def __init__(self, threads=None, block_size=1 << 20, level=6):
+    self.threads = threads or os.cpu_count() or 1
+    self.block_size = block_size
+    self.level = level
+
+  def _deflate(self, block, zdict, last):
+    if zdict:
+      compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                    zdict=zdict)
+    else:
+      compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) +\
+      compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+  def compress(self, chunks):
+    """
+    Generator of the gzip stream of the byte chunks
+    """
+    crc = 0
+    size = 0
+    pending = deque()
+    buf = bytearray()
+    zdict = b""
+    yield ParallelGzip.header
+    with ThreadPoolExecutor(max_workers=self.threads) as pool:
+      for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        buf += chunk
+        # keep the rest back, the last block has to finish the stream
+        while len(buf) > self.block_size:
+          block = bytes(buf[:self.block_size])
+          del buf[:self.block_size]
+          pending.append(pool.submit(self._deflate, block, zdict, False))
+          zdict = block[-ParallelGzip.window:]
+          while len(pending) > 2 * self.threads:
+            yield pending.popleft().result()
+      pending.append(pool.submit(self._deflate, bytes(buf), zdict, True))
+      while pending:
+        yield pending.popleft().result()
+    yield struct.pack("<II", crc, size & 0xffffffff)
+
+class HashingStream:
+  """
+  Passes through byte chunks while computing their sha256 digest and size
+  """
+  def __init__(self, chunks):
+    self.chunks = chunks
+    self.sha256 = hashlib.sha256()
+    self.size = 0
+
+  def __iter__(self):
+    for chunk in self.chunks:
+      self.sha256.update(chunk)
+      self.size += len(chunk)
+      yield chunk
+
+  def digest(self):
+    return "sha256:" + self.sha256.hexdigest()
+
+class LayerReader(io.RawIOBase):
+  """
+  Readable stream of the decompressed contents of a gzipped blob. A thread
+  downloads and decompresses the chunks up to queue_size chunks ahead of the
+  reader, so that the download overlaps with whatever consumes the stream.
+  Progress and throughput are printed every report_interval seconds
+  """
+  def __init__(self, chunks, size=None, queue_size=16, report_interval=5):
+    self.size = size
+    self.downloaded = 0
+    self.queue = queue.Queue(queue_size)
+    self.buf = b""
+    self.pos = 0
+    self.eof = False
+    self.cancelled = False
+    self.start = time.time()
+    self.reported = self.start
+    self.report_interval = report_interval
+    self.thread = threading.Thread(target=self._download, args=(chunks,), daemon=True)
+    self.thread.start()
+
+  def _put(self, item):
+    while not self.cancelled:
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def _download(self, chunks):
+    decompress_object = zlib.decompressobj(16+zlib.MAX_WBITS)
+    try:
+      for chunk in chunks:
+        if self.cancelled:
+          return
+        self.downloaded += len(chunk)
+        self._put(decompress_object.decompress(chunk))
+      self._put(decompress_object.flush())
+      if not decompress_object.eof:
+        raise IOError("Layer ended before the end of its gzip stream")
+      self._put(None)
+    except Exception as e:
+      self._put(e)
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    while self.pos == len(self.buf):
+      if self.eof:
+        return 0
+      item = self.queue.get()
+      if item is None:
+        self.eof = True
+        item = b""
+      elif isinstance(item, Exception):
+        raise item
+      self.buf = item
+      self.pos = 0
+      if time.time() - self.reported >= self.report_interval:
+        self.report()
+    n = min(len(b), len(self.buf) - self.pos)
+    b[:n] = self.buf[self.pos:self.pos + n]
+    self.pos += n
+    return n
+
+  def report(self):
+    """
+    Prints the downloaded megabytes and the throughput so far
+    """
+    now = time.time()
+    self.reported = now
+    progress = "%.1f MB" % (self.downloaded / 1e6)
+    if self.size:
+      progress += " of %.1f MB (%d%%)" % (self.size / 1e6, 100 * self.downloaded // self.size)
+    print("Downloaded " + progress + ", %.1f MB/s" %
+          (self.downloaded / 1e6 / max(now - self.start, 1e-6)))
+
+  def close(self):
+    self.cancelled = True
+    super().close()
+
+def read_ahead(chunks, ahead):
+  """
+  Generator passing through the chunks, which a thread produces up to ahead
+  chunks in advance of the consumer
+  """
+  chunk_queue = queue.Queue(ahead)
+  stop = threading.Event()
+  end = object()
+  def put(item):
+    while not stop.is_set():
+      try:
+        chunk_queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+  def produce():
+    try:
+      for chunk in chunks:
+        put(chunk)
+        if stop.is_set():
+          return
+      put(end)
+    except Exception as e:
+      put(e)
+  threading.Thread(target=produce, daemon=True).start()
+  try:
+    while True:
+      item = chunk_queue.get()
+      if item is end:
+        return
+      if isinstance(item, Exception):
+        raise item
+      yield item
+  finally:
+    stop.set()
+
+class StaleCheckpoint(Exception):
+  """
+  Raised when the data of an interrupted upload differs from the data to resume it with
+  """
+
+class UploadLost(Exception):
+  """
+  Raised when the registry has less of an upload than the chunks already sent
+  """
+
+def index_path(layer_dir):
+  """
+  Path of the index scan_tree output of layer_dir is kept in, next to the directory
+  """
+  return os.path.normpath(layer_dir) + ".inject.json"
+
+def upload_checkpoint_path(layer_dir):
+  """
+  Path of the checkpoint of an interrupted upload of a layer of layer_dir
+  """
+  return os.path.normpath(layer_dir) + ".upload.json"
+
+def scan_tree(root, old=None):
+  """
+  Lists everything below root as a dictionary from the "./" prefixed path, as the
+  layer tars name it, to [kind, mode, uid, gid, size, mtime_ns, digest]. The digest
+  of a regular file is the hash of its content, taken over from the old listing if
+  size and mtime did not change, the digest of a symlink is its target
+  """
+  old = old or {}
+  files = {}
+  for dir_path, dir_names, file_names in os.walk(root):
+    for name in dir_names + file_names:
+      path = os.path.join(dir_path, name)
+      key = "./" + os.path.relpath(path, root)
+      st = os.lstat(path)
+      digest = None
+      if stat.S_ISDIR(st.st_mode):
+        kind = "d"
+      elif stat.S_ISREG(st.st_mode):
+        kind = "f"
+        prev = old.get(key)
+        if prev and prev[0] == "f" and prev[4] == st.st_size and prev[5] == st.st_mtime_ns:
+          digest = prev[6]
+        else:
+          digest = hash_file(path)
+      elif stat.S_ISLNK(st.st_mode):
+        kind = "l"
+        digest = os.readlink(path)
+      else:
+        kind = "o"
+        digest = str(st.st_rdev)
+      files[key] = [kind, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+                    st.st_size, st.st_mtime_ns, digest]
+  return files
+
+def tree_changes(old, new):
+  """
+  Compares two scan_tree listings. Entries only differing in mtime are unchanged.
+
+  :rtype: tuple
+  :returns: Tuple of the sorted paths to add to a delta layer, including the
+    parents of changed entries, and of the sorted paths to white out
+  """
+  def same(a, b):
+    return a[0] == b[0] and a[1:4] == b[1:4] and a[6] == b[6]
+  changed = set()
+  whiteouts = []
+  for path, entry in new.items():
+    prev = old.get(path)
+    if prev is not None and same(prev, entry):
+      continue
+    # a changed kind replaces the old entry in the same layer
+    if prev is not None and prev[0] != entry[0]:
+      whiteouts.append(path)
+    while path != "." and path not in changed:
+      changed.add(path)
+      path = os.path.dirname(path)
+  for path in old:
+    # whiting out a directory hides everything below
+    parent = os.path.dirname(path)
+    if path not in new and (parent == "." or new.get(parent, "-")[0] == "d"):
+      whiteouts.append(path)
+  return (sorted(changed), sorted(whiteouts))
+
+def whiteout_path(dest_dir, member_name):
+  """
+  Path below dest_dir of the entry the whiteout file member_name removes. A name
+  which is absolute, contains ".." or leads outside dest_dir raises ValueError
+  """
+  target = os.path.basename(member_name)[len(".wh."):]
+  if os.path.isabs(member_name) or ".." in member_name.split("/") or \
+     target in ("", ".", ".."):
+    raise ValueError("Refusing whiteout file " + member_name)
+  root = os.path.realpath(dest_dir)
+  parent = os.path.realpath(os.path.join(root, os.path.dirname(member_name)))
+  if parent != root and not parent.startswith(root + os.sep):
+    raise ValueError("Whiteout file " + member_name + " points outside " + dest_dir)
+  return os.path.join(parent, target)
+
+def extract_tar(fileobj, dest_dir):
+  """
+  Extracts a streamed layer tar into dest_dir. Whiteout files remove the entries
+  they name instead of being extracted. Members which would end up outside
+  dest_dir raise an error
+  """
+  # without extraction filters, tarfile writes wherever the names point
+  has_filter = hasattr(tarfile, "tar_filter")
+  def members(tar):
+    for member in tar:
+      name = os.path.basename(member.name)
+      if not name.startswith(".wh."):
+        if not has_filter and (os.path.isabs(member.name) or
+                               ".." in member.name.split("/")):
+          raise ValueError("Refusing layer member " + member.name)
+        yield member
+        continue
+      path = whiteout_path(dest_dir, member.name)
+      if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+      elif os.path.lexists(path):
+        os.unlink(path)
+  tar = tarfile.open(fileobj=fileobj, mode="r|")
+  if has_filter:
+    tar.extractall(dest_dir, members=members(tar), filter="tar")
+  else:
+    tar.extractall(dest_dir, members=members(tar))
+  tar.close()
+
+def default_cache_dir():
+  """
+  Directory manifests are cached in by default, in the user's cache directory
+  """
+  cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+  return os.path.join(cache_home, "cvmfs-inject")
+
+class ManifestCache:
+  """
+  On-disk cache of image manifests and configurations by their digest. Entries are
+  checked against their digest when read, so a damaged entry is only a miss.
+  Without a path nothing is cached
+  """
+  def __init__(self, path):
+    self.path = path
+
+  def _file(self, digest):
+    if self.path is None or digest is None or \
+       re.match(r"^sha256:[0-9a-f]{64}$", digest) is None:
+      return None
+    return os.path.join(self.path, digest.replace(":", "-"))
+
+  def get(self, digest):
+    path = self._file(digest)
+    if path is None:
+      return None
+    try:
+      with open(path, "rb") as cache_file:
+        data = cache_file.read()
+    except OSError:
+      return None
+    return data if hash_bytes(data) == digest else None
+
+  def put(self, digest, data):
+    path = self._file(digest)
+    if path is None:
+      return
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as cache_file:
+        cache_file.write(data)
+      os.rename(cache_file.name, path)
+    except OSError as e:
+      print("WARNING: Cannot cache " + digest + ": " + str(e))
+
 class FatManifest:
   """
   Class which represents a "fat" OCI image configuration manifest
@@ -76,6 +453,14 @@ class FatManifest:
         break
     if not found:
       raise ValueError("Image did not contain old cvmfs injection!")
+
+    # The new version contains all delta layers, drop them with their history
+    delta_tars = [delta_tar for delta_tar, _ in self.get_deltas()]
+    self.manif["rootfs"]["diff_ids"] = [diff_id for diff_id in self.manif["rootfs"]["diff_ids"]
+                                        if diff_id not in delta_tars]
+    self.manif["history"] = [entry for entry in self.manif["history"]
+                             if self._delta_of(entry) not in delta_tars]
+    self._set_deltas([])
     
     local_time = datetime.now(timezone.utc).astimezone()
     self.manif["history"].append({
@@ -86,6 +471,50 @@ class FatManifest:
       "empty_layer":True
     })
     
+  def add_delta(self, tar_digest, gz_digest):
+    """
+    Adds a delta layer with the changes to the injected layer on top of the image
+    """
+    if not self.is_cvmfs_prepared():
+      raise ValueError("Cannot inject in unprepated image")
+    self.manif["rootfs"]["diff_ids"].append(tar_digest)
+
+    local_time = datetime.now(timezone.utc).astimezone()
+    self.manif["history"].append({
+      "created":local_time.isoformat(),
+      "created_by":"/bin/sh -c #(nop) ADD delta file:"+tar_digest+" in / ",
+      "author":"cvmfs_shrinkwrap",
+      "comment": "This change was executed through the CVMFS Shrinkwrap Docker Injector"
+    })
+    self._set_deltas(self.get_deltas() + [(tar_digest, gz_digest)])
+
+  def get_deltas(self):
+    """
+    Retrieves the (tar digest, gz digest) pairs of the delta layers in the order
+    they were added
+    """
+    labels = self.manif["config"]["Labels"]
+    return list(zip(labels.get("cvmfs_injection_delta_tar", "").split(),
+                    labels.get("cvmfs_injection_delta_gz", "").split()))
+
+  def _set_deltas(self, deltas):
+    for config in ("config", "container_config"):
+      if config not in self.manif or "Labels" not in self.manif[config]:
+        continue
+      labels = self.manif[config]["Labels"]
+      if deltas:
+        labels["cvmfs_injection_delta_tar"] = " ".join(tar for tar, _ in deltas)
+        labels["cvmfs_injection_delta_gz"] = " ".join(gz for _, gz in deltas)
+      else:
+        labels.pop("cvmfs_injection_delta_tar", None)
+        labels.pop("cvmfs_injection_delta_gz", None)
+
+  def _delta_of(self, history_entry):
+    created_by = history_entry.get("created_by", "").split()
+    if "delta" in created_by and created_by.index("delta") + 1 < len(created_by):
+      return created_by[created_by.index("delta") + 1][len("file:"):]
+    return None
+
   def is_cvmfs_prepared(self):
     """
     Checks whether image is prepared for cvmfs injection
@@ -130,10 +559,18 @@ class ImageManifest:
     })
     self.manif["config"]["size"] = manifest_size
     self.manif["config"]["digest"] = manifest_digest
-  def inject(self ,old, new, layer_size, manifest_digest, manifest_size):
+  def add_delta(self, layer_digest, layer_size, manifest_digest, manifest_size):
+    """
+    Adds a delta layer on top of the image
+    """
+    self.init_cvmfs_layer(layer_digest, layer_size, manifest_digest, manifest_size)
+  def inject(self ,old, new, layer_size, manifest_digest, manifest_size, deltas=()):
     """
-    Injects a new version of the layer by replacing the corresponding digest
+    Injects a new version of the layer by replacing the corresponding digest.
+    The layers with digests in deltas are contained in the new version and dropped
     """
+    self.manif["layers"] = [layer for layer in self.manif["layers"]
+                            if layer["digest"] not in deltas]
     for i in range(len(self.manif["layers"])):
       if self.manif["layers"][i]["digest"] == old:
         self.manif["layers"][i]["digest"] = new
@@ -149,13 +586,26 @@ class DockerInjector:
   The main class of the Docker injector which injects new versions of a layer into 
   OCI images retrieved from an OCI compliant distribution API
   """
-  def __init__(self, host, repo, alias, user, pw):
+  def __init__(self, host, repo, alias, user, pw, threads=None, session=None,
+               chunk_size=16 << 20, insecure=False, cache_dir=None):
     """
-    Initializes the injector by downloading both the slim and the fat image manifest
+    Initializes the injector by downloading both the slim and the fat image manifest.
+    threads is the number of threads compressing layers, by default one per CPU.
+    All requests go through session if one is given, to reuse its connections.
+    Layers are uploaded in chunks of chunk_size bytes. With insecure, the registry
+    is accessed over plain HTTP. Manifests are cached in cache_dir if one is given
     """
     def auth(dxf, response):
       dxf.authenticate(user, pw, response=response)
-    self.dxfObject = DXF(host, repo, tlsverify=True, auth=auth)
+    self.repo = repo
+    self.dxfObject = DXF(host, repo, insecure=insecure, tlsverify=True, auth=auth)
+    if session is not None:
+      self.dxfObject._sessions.insert(0, session)
+    self.gzip = ParallelGzip(threads)
+    self.chunk_size = chunk_size
+    self.upload_ahead = 32
+    self.upload_retries = 5
+    self.cache = ManifestCache(cache_dir)
     self.image_manifest = self._get_manifest(alias)  
     self.fat_manifest = self._get_fat_manifest(self.image_manifest)
 
@@ -163,119 +613,508 @@ class DockerInjector:
     """
     Sets an image up for layer injection
     """
-    tar_digest, gz_digest = self._build_init_tar()
-    layer_size = self.dxfObject.blob_size(gz_digest)
+    tar_digest, gz_digest, layer_size = self._build_init_tar()
     self.fat_manifest.init_cvmfs_layer(tar_digest, gz_digest)
-    fat_man_json = self.fat_manifest.as_JSON()
-    manifest_digest = hash_bytes(bytes(fat_man_json, 'utf-8'))
-    self.dxfObject.push_blob(data=fat_man_json, digest=manifest_digest)
-    manifest_size = self.dxfObject.blob_size(manifest_digest)
+    manifest_digest, manifest_size = self._push_fat_manifest()
     self.image_manifest.init_cvmfs_layer(gz_digest, layer_size, manifest_digest, manifest_size)
-
-    image_man_json = self.image_manifest.as_JSON()
-    self.dxfObject.set_manifest(push_alias, image_man_json)
+    self._set_manifest(push_alias)
   
-  def unpack(self, dest_dir):
+  def unpack(self, dest_dir, index=False):
     """
-    Unpacks the current version of a layer into the dest_dir directory in order to update it
+    Unpacks the current version of a layer and its delta layers into the dest_dir
+    directory in order to update it. With index, the listing of the unpacked files
+    that delta updates compare against is written to index_path(dest_dir)
     """
     if not self.fat_manifest.is_cvmfs_prepared():
       os.makedirs(dest_dir+"/cvmfs", exist_ok=True)
       return
-      
-    gz_digest = self.fat_manifest.get_gz_digest()
-    # Write out tar file
-    decompress_object = zlib.decompressobj(16+zlib.MAX_WBITS)
-    try:
-      chunk_it = self.dxfObject.pull_blob(gz_digest)
-    except HTTPError as e:
-      if e.response.status_code == 404:
-        print("ERROR: The hash of the CVMFS layer must have changed.")
-        print("This is a known issue. Please do not reupload images to other repositories after CVMFS injection!")
-      else:
-        raise e
-    with tempfile.TemporaryFile() as tmp_file:
-      for chunk in chunk_it:
-        tmp_file.write(decompress_object.decompress(chunk))
-      tmp_file.write(decompress_object.flush())
-      tmp_file.seek(0)
-      tar = tarfile.TarFile(fileobj=tmp_file)
-      tar.extractall(dest_dir)
-      tar.close()
 
-  def update(self, src_dir, push_alias):
+    self._extract_layer(self.fat_manifest.get_gz_digest(), dest_dir)
+    for _, delta_gz_digest in self.fat_manifest.get_deltas():
+      self._extract_layer(delta_gz_digest, dest_dir)
+    if index:
+      self._save_index(dest_dir, scan_tree(dest_dir))
+
+  def update(self, src_dir, push_alias, max_deltas=0):
     """
     Packs and uploads the contents of src_dir as a layer and injects the layer into the image.
-    The new layer version is stored under the tag push_alias
+    The new layer version is stored under the tag push_alias.
+    With max_deltas > 0, only the changes since src_dir was unpacked or updated
+    are uploaded as an additional delta layer. Once max_deltas delta layers are
+    stacked, the next update compacts them into a new version of the layer
     """
     if not self.fat_manifest.is_cvmfs_prepared():
       print("Preparing image for CVMFS injection...")
       self.setup(push_alias)
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-      print("Bundling file into tar...")
-      _, error = exec_bash("tar --xattrs -C "+src_dir+" -cvf "+tmp_file.name+" .")
-      if error:
-        raise RuntimeError("Failed to tar with error " + str(error))
-      tar_digest = hash_file(tmp_file.name)
-      print("Bundling tar into gz...")
-      gz_dest = tmp_file.name+".gz"
-      _, error = exec_bash("gzip "+tmp_file.name)
-      if error:
-        raise RuntimeError("Failed to tar with error " + str(error))
-      print("Uploading...")
-      gz_digest = self.dxfObject.push_blob(gz_dest)
-      os.unlink(gz_dest)
+    if max_deltas > 0:
+      index = self._load_index(src_dir)
+      print("Scanning for changes...")
+      files = scan_tree(src_dir, index["files"] if index else None)
+      if index and len(self.fat_manifest.get_deltas()) < max_deltas:
+        self._update_delta(src_dir, push_alias, index["files"], files)
+        self._save_index(src_dir, files)
+        return
+    print("Bundling, compressing and uploading layer...")
+    tar_digest, gz_digest, layer_size = self._push_layer(src_dir)
     print("Refreshing manifests...")
+    self._inject_layer(tar_digest, gz_digest, layer_size, push_alias)
+    if max_deltas > 0:
+      self._save_index(src_dir, files)
+
+  def _inject_layer(self, tar_digest, gz_digest, layer_size, push_alias):
+    """
+    Replaces the layer and its delta layers by an uploaded new version of the layer
+    and stores the new manifests under the tag push_alias
+    """
     old_gz_digest = self.fat_manifest.get_gz_digest()
-    layer_size = self.dxfObject.blob_size(gz_digest)
+    delta_gz_digests = [delta_gz for _, delta_gz in self.fat_manifest.get_deltas()]
     self.fat_manifest.inject(tar_digest, gz_digest)
-    fat_man_json = self.fat_manifest.as_JSON()
-    manifest_digest = hash_bytes(bytes(fat_man_json, 'utf-8'))
-    self.dxfObject.push_blob(data=fat_man_json, digest=manifest_digest)
-    manifest_size = self.dxfObject.blob_size(manifest_digest)
+    manifest_digest, manifest_size = self._push_fat_manifest()
 
-    self.image_manifest.inject(old_gz_digest, gz_digest, layer_size, manifest_digest, manifest_size)
-    
-    image_man_json = self.image_manifest.as_JSON()
-    self.dxfObject.set_manifest(push_alias, image_man_json)
+    self.image_manifest.inject(old_gz_digest, gz_digest, layer_size, manifest_digest, manifest_size,
+                               delta_gz_digests)
+    self._set_manifest(push_alias)
+
+  def _update_delta(self, src_dir, push_alias, old_files, files):
+    """
+    Uploads the differences between the old_files and files listings of src_dir
+    as a delta layer, with whiteout files for the removed entries
+    """
+    changed, whiteouts = tree_changes(old_files, files)
+    if changed or whiteouts:
+      print("Bundling, compressing and uploading delta layer of " + str(len(changed)) +
+            " changed and " + str(len(whiteouts)) + " removed entries...")
+      tar_digest, gz_digest, layer_size = self._push_delta(src_dir, changed, whiteouts)
+      print("Refreshing manifests...")
+      self.fat_manifest.add_delta(tar_digest, gz_digest)
+      manifest_digest, manifest_size = self._push_fat_manifest()
+      self.image_manifest.add_delta(gz_digest, layer_size, manifest_digest, manifest_size)
+    else:
+      print("No changes, tagging the current image")
+    self._set_manifest(push_alias)
+
+  def _layer_digests(self):
+    return [self.fat_manifest.get_gz_digest()] +\
+      [delta_gz for _, delta_gz in self.fat_manifest.get_deltas()]
+
+  def _load_index(self, layer_dir):
+    """
+    Loads the index of layer_dir, if it was written for the current layers of the image
+    """
+    try:
+      with open(index_path(layer_dir)) as index_file:
+        index = json.load(index_file)
+    except (OSError, ValueError):
+      return None
+    if index.get("layers") != self._layer_digests():
+      print("Index of " + layer_dir + " does not match the image, pushing the full layer")
+      return None
+    return index
 
+  def _save_index(self, layer_dir, files):
+    path = index_path(layer_dir)
+    with open(path + ".tmp", "w") as index_file:
+      json.dump({"layers": self._layer_digests(), "files": files}, index_file)
+    os.rename(path + ".tmp", path)
+
+  def _extract_layer(self, gz_digest, dest_dir):
+    """
+    Extracts a layer into dest_dir while it is downloaded, without a temporary
+    copy of the tar. Whiteout files remove the entries they name
+    """
+    try:
+      (chunk_it, size) = self.dxfObject.pull_blob(gz_digest, size=True, chunk_size=1 << 20)
+    except HTTPError as e:
+      if e.response.status_code == 404:
+        print("ERROR: The hash of the CVMFS layer must have changed.")
+        print("This is a known issue. Please do not reupload images to other repositories after CVMFS injection!")
+      raise e
+    with LayerReader(chunk_it, size) as layer:
+      extract_tar(layer, dest_dir)
+      layer.report()
 
   def _get_manifest(self, alias):
-    return ImageManifest(self.dxfObject.get_manifest(alias))
+    """
+    Retrieves the image manifest of alias. If the registry tells the digest of the
+    manifest behind a tag and it is cached, only that HEAD request is made
+    """
+    digest = alias if alias.startswith("sha256:") else None
+    if digest is None and self.cache.path is not None:
+      digest, _ = self.dxfObject.head_manifest_and_response(alias)
+    manifest = self.cache.get(digest)
+    if manifest is None:
+      _, r = self.dxfObject.get_manifest_and_response(alias)
+      manifest = r.content
+      digest = hash_bytes(manifest)
+      if r.headers.get("Docker-Content-Digest", digest) != digest:
+        raise ValueError("Manifest of " + alias + " does not match its digest")
+      self.cache.put(digest, manifest)
+    return ImageManifest(manifest)
 
   def _get_fat_manifest(self, image_manifest):
-    fat_manifest = ""
-    (readIter, _) = self.dxfObject.pull_blob(self.image_manifest.get_fat_manif_digest(), size=True, chunk_size=4096)
-    for chunk in readIter:
-      fat_manifest += str(chunk)[2:-1]
-    fat_manifest = fat_manifest.replace("\\\\","\\")
+    """
+    Retrieves the image configuration the image manifest refers to
+    """
+    digest = image_manifest.get_fat_manif_digest()
+    fat_manifest = self.cache.get(digest)
+    if fat_manifest is None:
+      fat_manifest = bytearray()
+      # pull_blob verifies the digest at the end
+      for chunk in self.dxfObject.pull_blob(digest, chunk_size=1 << 16):
+        fat_manifest += chunk
+      fat_manifest = bytes(fat_manifest)
+      self.cache.put(digest, fat_manifest)
     return FatManifest(fat_manifest)
 
+  def _push_fat_manifest(self):
+    """
+    Uploads the image configuration and caches it
+
+    :rtype: tuple
+    :returns: Tuple containing its digest and size
+    """
+    fat_man_json = bytes(self.fat_manifest.as_JSON(), 'utf-8')
+    manifest_digest = hash_bytes(fat_man_json)
+    self.dxfObject.push_blob(data=fat_man_json, digest=manifest_digest)
+    self.cache.put(manifest_digest, fat_man_json)
+    return (manifest_digest, len(fat_man_json))
+
+  def _set_manifest(self, push_alias):
+    """
+    Stores the image manifest under the tag push_alias and caches it
+    """
+    image_man_json = bytes(self.image_manifest.as_JSON(), 'utf-8')
+    self.dxfObject.set_manifest(push_alias, image_man_json)
+    self.cache.put(hash_bytes(image_man_json), image_man_json)
+
   def _build_init_tar(self):
     """
     Builds an empty /cvmfs tar and uploads it to the registry
 
     :rtype: tuple
-    :returns: Tuple containing the tar digest and gz digest
-    """
-    ident = self.image_manifest.get_fat_manif_digest()[5:15]
-    tmp_name = "/tmp/injector-"+ident
-    os.makedirs(tmp_name+"/cvmfs", exist_ok=True)
-    tar_dest = "/tmp/"+ident+".tar"
-    _, error = exec_bash("tar --xattrs -C "+tmp_name+" -cvf "+tar_dest+" .")
-    if error:
-      print("Failed to tar with error " + str(error))
+    :returns: Tuple containing the tar digest, gz digest and gz size
+    """
+    with tempfile.TemporaryDirectory(prefix="injector-") as tmp_name:
+      os.makedirs(tmp_name+"/cvmfs")
+      return self._push_layer(tmp_name)
+
+  def _push_layer(self, src_dir):
+    """
+    Packs src_dir into a gzipped tar layer and uploads it
+
+    :rtype: tuple
+    :returns: Tuple containing the tar digest, gz digest and gz size
+    """
+    return self._push_tar(["-C", src_dir, "."], upload_checkpoint_path(src_dir))
+
+  def _push_delta(self, src_dir, changed, whiteouts):
+    """
+    Packs the changed paths of src_dir and whiteout files for the removed paths
+    into a gzipped tar layer and uploads it
+
+    :rtype: tuple
+    :returns: Tuple containing the tar digest, gz digest and gz size
+    """
+    with tempfile.TemporaryDirectory(prefix="injector-") as tmp_name:
+      changed_list = os.path.join(tmp_name, "changed")
+      with open(changed_list, "w") as list_file:
+        list_file.write("".join(path + "\0" for path in changed))
+      tar_args = ["--no-recursion", "--null"]
+      # the whiteouts come first, so that a streaming unpack removes replaced
+      # entries before it extracts their new versions
+      if whiteouts:
+        whiteout_dir = os.path.join(tmp_name, "whiteouts")
+        whiteout_list = os.path.join(tmp_name, "whiteout")
+        with open(whiteout_list, "w") as list_file:
+          for path in whiteouts:
+            whiteout = os.path.join(os.path.dirname(path), ".wh." + os.path.basename(path))
+            os.makedirs(os.path.join(whiteout_dir, os.path.dirname(path)), exist_ok=True)
+            open(os.path.join(whiteout_dir, whiteout), "w").close()
+            list_file.write(whiteout + "\0")
+        tar_args += ["-C", whiteout_dir, "-T", whiteout_list]
+      tar_args += ["-C", src_dir, "-T", changed_list]
+      return self._push_tar(tar_args, upload_checkpoint_path(src_dir))
+
+  def _push_tar(self, tar_args, checkpoint=None):
+    """
+    Runs tar with the tar_args naming the layer contents and uploads the layer in
+    a single pass. The tar stream is hashed, compressed in parallel, hashed again
+    and streamed to the registry chunk by chunk without touching the disk.
+    An upload interrupted before is resumed from the checkpoint file, as tar and
+    the compression give the same layer for the same contents
+
+    :rtype: tuple
+    :returns: Tuple containing the tar digest, gz digest and gz size
+    """
+    try:
+      return self._pack_and_push(tar_args, checkpoint)
+    except StaleCheckpoint:
+      print("The layer changed since the interrupted upload, starting over")
+      return self._pack_and_push(tar_args, checkpoint)
+
+  def _pack_and_push(self, tar_args, checkpoint):
+    with tempfile.TemporaryFile() as tar_errors:
+      # without times of the pax headers, the same contents give the same tar
+      tar_process = subprocess.Popen(["tar", "--xattrs", "--sort=name",
+                                      "--pax-option=exthdr.name=%d/PaxHeaders/%f,"
+                                      "delete=atime,delete=ctime,exthdr.mtime=0",
+                                      "-cf", "-"] + tar_args,
+                                     stdout=subprocess.PIPE, stderr=tar_errors)
+      def tar_chunks():
+        for chunk in iter(lambda: tar_process.stdout.read(1 << 20), b""):
+          yield chunk
+        # fail before the upload is completed
+        if tar_process.wait() != 0:
+          tar_errors.seek(0)
+          raise RuntimeError("Failed to tar with error " + str(tar_errors.read()))
+      tar_stream = HashingStream(tar_chunks())
+      try:
+        gz_digest, layer_size = self._push_stream(self.gzip.compress(tar_stream), checkpoint)
+      finally:
+        tar_process.stdout.close()
+        if tar_process.poll() is None:
+          tar_process.kill()
+        tar_process.wait()
+    return (tar_stream.digest(), gz_digest, layer_size)
+
+  def _upload_url(self, location, digest=None):
+    url_parts = list(urlparse.urlparse(location))
+    if digest is not None:
+      query = urlparse.parse_qs(url_parts[4])
+      query.update({"digest": [digest]})
+      url_parts[4] = urlparse.urlencode(query, True)
+    if url_parts[1]:
+      url_parts[0] = "http" if self.dxfObject._insecure else "https"
+    return urlparse.urlunparse(url_parts)
+
+  def _push_stream(self, chunks, checkpoint=None):
+    """
+    Uploads a blob whose digest is only known at its end, following the OCI
+    distribution spec: the upload is opened with a POST, the data sent in order
+    in chunks of chunk_size by PATCH requests with their Content-Range and the
+    upload closed by a PUT with the digest. The chunks are produced ahead while
+    the previous ones are sent. DXF's push_blob needs the digest up front, so
+    this uses its request helpers directly.
+
+    After every chunk the upload location, the offset and the hash of the data
+    up to it are written to the checkpoint file. A later call with the same data
+    skips to the offset and continues the upload
+
+    :rtype: tuple
+    :returns: Tuple containing the digest and size of the blob
+    """
+    stream = HashingStream(read_ahead(chunks, self.upload_ahead))
+    location, offset, prefix_digest = self._resume_upload(checkpoint)
+    if location is None:
+      r = self.dxfObject._request("post", "blobs/uploads/")
+      location, offset = r.headers["Location"], 0
+    else:
+      print("Resuming upload at " + str(offset) + " bytes")
+    uploaded = hashlib.sha256()
+    resume_offset = offset
+    skipped = 0
+    buf = bytearray()
+    for chunk in stream:
+      if skipped < resume_offset:
+        skip = min(len(chunk), resume_offset - skipped)
+        uploaded.update(chunk[:skip])
+        skipped += skip
+        chunk = chunk[skip:]
+        if skipped == resume_offset and uploaded.hexdigest() != prefix_digest:
+          os.unlink(checkpoint)
+          raise StaleCheckpoint()
+      buf += chunk
+      while len(buf) >= self.chunk_size:
+        location = self._patch_chunk(location, buf[:self.chunk_size], offset)
+        uploaded.update(buf[:self.chunk_size])
+        offset += self.chunk_size
+        del buf[:self.chunk_size]
+        self._save_checkpoint(checkpoint, location, offset, uploaded)
+    if skipped < resume_offset:
+      os.unlink(checkpoint)
+      raise StaleCheckpoint()
+    if buf:
+      location = self._patch_chunk(location, buf, offset)
+    digest = stream.digest()
+    for attempt in range(self.upload_retries + 1):
+      try:
+        self.dxfObject._base_request("put", self._upload_url(location, digest))
+        break
+      except RequestException as e:
+        # a rejected digest or other client error won't go away by retrying
+        if attempt == self.upload_retries or \
+           (e.response is not None and e.response.status_code < 500):
+          raise e
+        time.sleep(min(2 ** attempt, 30))
+        try:
+          # the blob may have been completed although the response was lost
+          self.dxfObject.blob_size(digest)
+          break
+        except RequestException:
+          pass
+    if checkpoint is not None and os.path.exists(checkpoint):
+      os.unlink(checkpoint)
+    return (digest, stream.size)
+
+  def _patch_chunk(self, location, data, start):
+    """
+    Sends data as the part of an upload beginning at the offset start. After a
+    failure the upload status tells how much of it arrived and the rest is sent
+    again, up to upload_retries times. If the registry has less than start, the
+    upload can't be continued and UploadLost is raised
+
+    :returns: The location to continue the upload at
+    """
+    end = start + len(data)
+    done = start
+    for attempt in range(self.upload_retries + 1):
+      if done >= end:
+        return location
+      try:
+        r = self.dxfObject._base_request("patch", self._upload_url(location),
+                                         data=bytes(data[done - start:]),
+                                         headers={"Content-Type": "application/octet-stream",
+                                                  "Content-Range": "%d-%d" % (done, end - 1)})
+        return r.headers["Location"]
+      except RequestException as e:
+        if attempt == self.upload_retries or \
+           (e.response is not None and e.response.status_code == 404):
+          raise e
+        print("Upload of bytes " + str(done) + "-" + str(end - 1) + " failed (" + str(e) +
+              "), retrying")
+        time.sleep(min(2 ** attempt, 30))
+        try:
+          location, done = self._upload_status(location)
+        except RequestException:
+          pass
+        if done < start:
+          # an earlier chunk went missing, the data to send again is gone
+          raise UploadLost("The registry has " + str(done) + " bytes of the upload, " +
+                           "expected at least " + str(start))
+
+  def _upload_status(self, location):
+    """
+    Queries how many bytes of an upload the registry has
+
+    :rtype: tuple
+    :returns: Tuple containing the location to continue at and the offset
+    """
+    r = self.dxfObject._base_request("get", self._upload_url(location))
+    # an empty upload and one with one byte both report 0-0
+    size = int(r.headers.get("Range", "0-0").split("-")[1])
+    return (r.headers.get("Location", location), size + 1 if size > 0 else 0)
+
+  def _save_checkpoint(self, checkpoint, location, offset, uploaded):
+    if checkpoint is None:
       return
-    tar_digest = hash_file(tar_dest)
-    _, error = exec_bash("gzip -n "+tar_dest)
-    if error:
-      print("Failed to tar with error " + str(error))
+    with open(checkpoint + ".tmp", "w") as checkpoint_file:
+      json.dump({"repo": self.repo, "location": location, "offset": offset,
+                 "sha256": uploaded.hexdigest()}, checkpoint_file)
+    os.rename(checkpoint + ".tmp", checkpoint)
+
+  def _resume_upload(self, checkpoint):
+    """
+    Loads the checkpoint of an interrupted upload, if the registry still has it
+
+    :rtype: tuple
+    :returns: Tuple containing the location, offset and digest of the data up to
+      the offset, or Nones
+    """
+    try:
+      with open(checkpoint) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    except (TypeError, OSError, ValueError):
+      return (None, None, None)
+    if state.get("repo") != self.repo:
+      return (None, None, None)
+    try:
+      location, offset = self._upload_status(state["location"])
+    except RequestException:
+      print("The interrupted upload expired, starting over")
+      return (None, None, None)
+    if offset != state["offset"]:
+      print("The interrupted upload is at " + str(offset) + " instead of " +
+            str(state["offset"]) + " bytes, starting over")
+      return (None, None, None)
+    return (location, offset, state["sha256"])
+
+class ThreadSessions(threading.local):
+  """
+  Stands in for a requests.Session, giving every thread a session of its own, as
+  sessions are not guaranteed to be thread-safe. A thread reuses the connections
+  of its session for all the injectors it works for
+  """
+  def __init__(self):
+    self.session = requests.Session()
+
+  def __getattr__(self, name):
+    return getattr(self.session, name)
+
+class BatchInjector:
+  """
+  Injects the same version of the layer into several images of one registry.
+  The layer is packed and uploaded once, mounted into the other repositories
+  and the manifests of the images are rewritten in parallel
+  """
+  def __init__(self, host, targets, user, pw, threads=None, workers=8, chunk_size=16 << 20,
+               insecure=False, cache_dir=None):
+    """
+    Initializes a DockerInjector for each (repository, alias) pair of targets.
+    workers is the number of images handled at the same time, each worker with
+    its own session to the registry. The other arguments are passed on
+    """
+    self.workers = workers
+    self.sessions = ThreadSessions()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      self.injectors = list(pool.map(
+        lambda target: DockerInjector(host, target[0], target[1], user, pw, threads, self.sessions,
+                                      chunk_size, insecure, cache_dir),
+        targets))
+
+  def update(self, src_dir, push_alias):
+    """
+    Packs and uploads the contents of src_dir as a layer and injects it into all
+    images, storing each under the tag push_alias. Images which fail are reported
+    and do not stop the others
+
+    :rtype: list
+    :returns: List of the (repository, exception) pairs of the failed images
+    """
+    source = self.injectors[0]
+    print("Bundling, compressing and uploading layer...")
+    layer = source._push_layer(src_dir)
+    print("Injecting layer into " + str(len(self.injectors)) + " images...")
+    def inject(injector):
+      if not injector.fat_manifest.is_cvmfs_prepared():
+        injector.setup(push_alias)
+      self._share_blob(source, injector, layer[1])
+      injector._inject_layer(*layer, push_alias)
+    failed = []
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      futures = [(injector, pool.submit(inject, injector)) for injector in self.injectors]
+      for injector, future in futures:
+        try:
+          future.result()
+          print("Injected into " + injector.repo + ":" + push_alias)
+        except Exception as e:
+          print("ERROR: Injection into " + injector.repo + " failed: " + str(e))
+          failed.append((injector.repo, e))
+    return failed
+
+  def _share_blob(self, source, target, digest):
+    """
+    Makes the blob uploaded through source available in the repository of target.
+    It is cross-mounted if the registry allows it, otherwise copied over
+    """
+    try:
+      target.dxfObject.blob_size(digest)
+      return
+    except HTTPError as e:
+      if e.response.status_code != 404:
+        raise e
+    try:
+      target.dxfObject.mount_blob(source.repo, digest)
       return
-    gz_dest = tar_dest+".gz"
-    gzip_digest = self.dxfObject.push_blob(tar_dest+".gz")
-
-    # Cleanup
-    os.rmdir(tmp_name+"/cvmfs")
-    os.rmdir(tmp_name)
-    os.unlink(gz_dest)
-    return (tar_digest, gzip_digest)
+    except (DXFMountFailed, HTTPError):
+      print("Cannot mount layer into " + target.repo + ", copying it")
+    target._push_stream(source.dxfObject.pull_blob(digest, chunk_size=1 << 20))
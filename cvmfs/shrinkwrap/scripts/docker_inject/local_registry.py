@@ -0,0 +1,272 @@
+#
+# This file is part of the CernVM File System.
+#
+
+# Minimal in-memory stand-in for an OCI distribution registry, for trying out
+# the injector without a real registry. It serves manifests and blobs, chunked
+# and monolithic uploads with Content-Range checks, upload status queries and
+# cross-repository mounts. It has no authentication.
+#
+# Faults can be injected: with fail_every, every n-th PATCH stores only half
+# of its data and drops the connection. With fail_after, the registry answers
+# 503 to everything after that many PATCHes, until it is revived.
+
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import urllib.parse as urlparse
+import uuid
+
+class RegistryHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    if self.server.registry.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def read_body(self):
+    if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+      data = bytearray()
+      while True:
+        size = int(self.rfile.readline().split(b";")[0], 16)
+        if size == 0:
+          self.rfile.readline()
+          return bytes(data)
+        data += self.rfile.read(size)
+        self.rfile.readline()
+    length = int(self.headers.get("Content-Length", 0))
+    return self.rfile.read(length) if length else b""
+
+  def reply(self, code, headers={}, data=b""):
+    self.send_response(code)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(data)
+
+  def dispatch(self):
+    registry = self.server.registry
+    url = urlparse.urlparse(self.path)
+    match = re.match(r"^/v2/(.+)/(blobs/uploads|blobs|manifests)/?(.*)$", url.path)
+    if url.path == "/v2/":
+      return self.reply(200)
+    if match is None:
+      return self.reply(404)
+    if registry.is_down():
+      self.read_body()
+      return self.reply(503)
+    (repo, kind, ref) = match.groups()
+    handler = getattr(registry, (self.command + "_" + kind.replace("/", "_")).lower(), None)
+    if handler is None:
+      self.read_body()
+      return self.reply(405)
+    return handler(self, repo, ref, urlparse.parse_qs(url.query))
+
+  do_GET = do_HEAD = do_POST = do_PATCH = do_PUT = dispatch
+
+class LocalRegistry:
+  """
+  The state of the registry and the handlers of its requests
+  """
+  def __init__(self, fail_every=0, fail_after=None, verbose=False):
+    self.fail_every = fail_every
+    self.fail_after = fail_after
+    self.verbose = verbose
+    self.blobs = {}
+    self.repo_blobs = {}
+    self.manifests = {}
+    self.uploads = {}
+    self.stats = {"patch": 0, "failed_patch": 0, "put": 0, "mount": 0,
+                  "bytes_in": 0, "bytes_out": 0}
+    self.lock = threading.Lock()
+    self.server = None
+
+  def start(self, port=0):
+    """
+    Serves the registry on localhost in a thread
+
+    :returns: The host:port of the registry
+    """
+    self.server = ThreadingHTTPServer(("127.0.0.1", port), RegistryHandler)
+    self.server.daemon_threads = True
+    self.server.registry = self
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return "127.0.0.1:" + str(self.server.server_address[1])
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def is_down(self):
+    return self.fail_after is not None and self.stats["patch"] >= self.fail_after
+
+  def revive(self):
+    self.fail_after = None
+
+  def add_blob(self, repo, data):
+    digest = "sha256:" + hashlib.sha256(data).hexdigest()
+    with self.lock:
+      self.blobs[digest] = data
+      self.repo_blobs.setdefault(repo, set()).add(digest)
+    return digest
+
+  def add_image(self, repo, tag, config, layers=()):
+    """
+    Adds an image with the config dictionary and the layer blobs
+    """
+    config_json = json.dumps(config).encode()
+    manifest = {
+      "schemaVersion": 2,
+      "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+      "config": {
+        "mediaType": "application/vnd.docker.container.image.v1+json",
+        "size": len(config_json),
+        "digest": self.add_blob(repo, config_json)
+      },
+      "layers": [{
+        "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+        "size": len(layer),
+        "digest": self.add_blob(repo, layer)
+      } for layer in layers]
+    }
+    self.manifests[(repo, tag)] = json.dumps(manifest).encode()
+
+  def _upload_headers(self, repo, upload_id):
+    size = len(self.uploads[upload_id])
+    # like the reference registry, which reports 0-0 for an empty upload
+    return {"Location": "/v2/" + repo + "/blobs/uploads/" + upload_id,
+            "Range": "0-" + str(max(size - 1, 0)),
+            "Docker-Upload-UUID": upload_id}
+
+  def get_blobs(self, handler, repo, digest, query):
+    if digest not in self.repo_blobs.get(repo, ()):
+      return handler.reply(404)
+    data = self.blobs[digest]
+    if handler.command == "GET":
+      self.stats["bytes_out"] += len(data)
+    handler.reply(200, {"Docker-Content-Digest": digest,
+                        "Content-Type": "application/octet-stream"}, data)
+
+  head_blobs = get_blobs
+
+  def get_manifests(self, handler, repo, ref, query):
+    data = self.manifests.get((repo, ref))
+    if data is None:
+      return handler.reply(404)
+    handler.reply(200, {
+      "Content-Type": "application/vnd.docker.distribution.manifest.v2+json",
+      "Docker-Content-Digest": "sha256:" + hashlib.sha256(data).hexdigest()
+    }, data)
+
+  head_manifests = get_manifests
+
+  def put_manifests(self, handler, repo, ref, query):
+    self.manifests[(repo, ref)] = handler.read_body()
+    handler.reply(201)
+
+  def get_blobs_uploads(self, handler, repo, upload_id, query):
+    if upload_id not in self.uploads:
+      return handler.reply(404)
+    handler.reply(204, self._upload_headers(repo, upload_id))
+
+  def post_blobs_uploads(self, handler, repo, ref, query):
+    data = handler.read_body()
+    mount = query.get("mount", [None])[0]
+    source = query.get("from", [None])[0]
+    if mount is not None and mount in self.repo_blobs.get(source, ()):
+      with self.lock:
+        self.repo_blobs.setdefault(repo, set()).add(mount)
+        self.stats["mount"] += 1
+      return handler.reply(201, {"Location": "/v2/" + repo + "/blobs/" + mount,
+                                 "Docker-Content-Digest": mount})
+    upload_id = uuid.uuid4().hex
+    self.uploads[upload_id] = bytearray()
+    if "digest" in query:
+      self.uploads[upload_id] += data
+      return self._complete(handler, repo, upload_id, query["digest"][0])
+    handler.reply(202, self._upload_headers(repo, upload_id))
+
+  def patch_blobs_uploads(self, handler, repo, upload_id, query):
+    upload = self.uploads.get(upload_id)
+    if upload is None:
+      handler.read_body()
+      return handler.reply(404)
+    content_range = handler.headers.get("Content-Range")
+    if content_range is not None and int(content_range.split("-")[0]) != len(upload):
+      handler.read_body()
+      return handler.reply(416, self._upload_headers(repo, upload_id))
+    self.stats["patch"] += 1
+    if self.fail_every and self.stats["patch"] % self.fail_every == 0 and \
+       "Content-Length" in handler.headers:
+      # keep half of the data and hang up, like a broken connection
+      length = int(handler.headers["Content-Length"])
+      data = handler.rfile.read(length // 2)
+      upload += data
+      self.stats["bytes_in"] += len(data)
+      self.stats["failed_patch"] += 1
+      handler.close_connection = True
+      return
+    data = handler.read_body()
+    upload += data
+    self.stats["bytes_in"] += len(data)
+    handler.reply(202, self._upload_headers(repo, upload_id))
+
+  def put_blobs_uploads(self, handler, repo, upload_id, query):
+    data = handler.read_body()
+    if upload_id not in self.uploads:
+      return handler.reply(404)
+    self.uploads[upload_id] += data
+    self.stats["bytes_in"] += len(data)
+    return self._complete(handler, repo, upload_id, query.get("digest", [""])[0])
+
+  def _complete(self, handler, repo, upload_id, digest):
+    data = bytes(self.uploads[upload_id])
+    if "sha256:" + hashlib.sha256(data).hexdigest() != digest:
+      return handler.reply(400, {}, b'{"errors": [{"code": "DIGEST_INVALID"}]}')
+    del self.uploads[upload_id]
+    with self.lock:
+      self.blobs[digest] = data
+      self.repo_blobs.setdefault(repo, set()).add(digest)
+      self.stats["put"] += 1
+    handler.reply(201, {"Location": "/v2/" + repo + "/blobs/" + digest,
+                        "Docker-Content-Digest": digest})
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument("--port",
+    required=False,
+    default=5000,
+    type=int)
+  argparser.add_argument("--fail_every",
+    required=False,
+    default=0,
+    type=int,
+    help="Break every n-th PATCH request halfway")
+  argparser.add_argument("--image",
+    required=False,
+    default=None,
+    type=str,
+    help="Add an empty image repo:tag")
+  args = argparser.parse_args()
+
+  registry = LocalRegistry(fail_every=args.fail_every, verbose=True)
+  if args.image:
+    repo, tag = args.image.rsplit(":", 1)
+    registry.add_image(repo, tag, {
+      "rootfs": {"type": "layers", "diff_ids": []},
+      "history": [],
+      "config": {"Labels": {}},
+      "container_config": {"Labels": {}}
+    })
+  registry.server = ThreadingHTTPServer(("127.0.0.1", args.port), RegistryHandler)
+  registry.server.registry = registry
+  print("Serving a local registry on 127.0.0.1:" + str(args.port))
+  registry.server.serve_forever()
+
+if __name__ == "__main__":
+  main()
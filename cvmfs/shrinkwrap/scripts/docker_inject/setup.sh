@@ -2,4 +2,4 @@
 # This file is part of the CernVM File System.
 #
 
-pip install --user python-dxf
\ No newline at end of file
+pip install --user python-dxf requests
\ No newline at end of file
@@ -0,0 +1,70 @@
+#
+# This file is part of the CernVM File System.
+#
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from docker_injector import extract_tar, whiteout_path
+
+def make_tar(entries):
+  """
+  Builds a tar of (name, data) entries, data None making a directory
+  """
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode="w") as tar:
+    for name, data in entries:
+      info = tarfile.TarInfo(name)
+      if data is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+      else:
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+  buf.seek(0)
+  return buf
+
+class ExtractTest(unittest.TestCase):
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.dest_dir = os.path.join(self.work_dir, "a", "dest")
+    self.victim = os.path.join(self.work_dir, "victim")
+    os.makedirs(os.path.join(self.dest_dir, "dir", "sub"))
+    with open(os.path.join(self.dest_dir, "dir", "file"), "w") as f:
+      f.write("file")
+    with open(self.victim, "w") as f:
+      f.write("victim")
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def test1Whiteouts(self):
+    extract_tar(make_tar([("./dir/.wh.file", b""), ("./dir/.wh.sub", b""),
+                          ("./dir/new", b"new")]), self.dest_dir)
+    self.assertEqual(["new"], os.listdir(os.path.join(self.dest_dir, "dir")))
+
+  def test2MaliciousWhiteouts(self):
+    os.symlink(self.work_dir, os.path.join(self.dest_dir, "link"))
+    for name in ["/" + self.victim.lstrip("/")[:-len("victim")] + ".wh.victim",
+                 "../../.wh.victim", "./dir/../../../.wh.victim",
+                 "./link/.wh.victim", "./dir/.wh..", "./.wh."]:
+      with self.assertRaises(ValueError):
+        extract_tar(make_tar([(name, b"")]), self.dest_dir)
+      self.assertTrue(os.path.exists(self.victim))
+      self.assertTrue(os.path.isdir(os.path.join(self.dest_dir, "dir")))
+    self.assertEqual(os.path.join(os.path.realpath(self.dest_dir), "dir", "file"),
+                     whiteout_path(self.dest_dir, "./dir/.wh.file"))
+
+  def test3MaliciousMembers(self):
+    for name in ["../../escaped", "./dir/../../../escaped"]:
+      with self.assertRaises(Exception):
+        extract_tar(make_tar([(name, b"bad")]), self.dest_dir)
+      self.assertFalse(os.path.exists(os.path.join(self.work_dir, "escaped")))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,140 @@
+#
+# This file is part of the CernVM File System.
+#
+
+# Throughput and recovery check of the chunked layer upload of the injector
+# against the in-memory registry of local_registry.py.
+#
+#  - throughput: a layer of a generated directory is uploaded with every
+#    chunk size and the MB/s of the compressed layer are reported
+#  - recovery: every n-th PATCH breaks halfway, the upload has to retry the
+#    rest of the chunk and give the same blob
+#  - resume: the registry goes down in the middle of the upload, a second
+#    run has to continue from the checkpoint instead of starting over
+#
+# The exit code is 1 if a blob differs from the one of an undisturbed upload.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from docker_injector import DockerInjector, upload_checkpoint_path
+from local_registry import LocalRegistry
+
+empty_config = {
+  "rootfs": {"type": "layers", "diff_ids": []},
+  "history": [],
+  "config": {"Labels": {}},
+  "container_config": {"Labels": {}}
+}
+
+def make_tree(root, size):
+  # Half random, half repetitive data, so that it compresses to about a half
+  rand = random.Random(0)
+  os.makedirs(os.path.join(root, "cvmfs", "repo"))
+  file_size = 4 << 20
+  for i in range((size + file_size - 1) // file_size):
+    with open(os.path.join(root, "cvmfs", "repo", "file" + str(i)), "wb") as out_file:
+      out_file.write(rand.getrandbits(8 * file_size // 2).to_bytes(file_size // 2, "little"))
+      out_file.write(b"cvmfs" * (file_size // 10))
+
+def make_injector(registry, **kwargs):
+  host = registry.start()
+  registry.add_image("bench", "latest", empty_config)
+  return DockerInjector(host, "bench", "latest", "user", "pw", insecure=True, **kwargs)
+
+def push(injector, src_dir):
+  start = time.time()
+  (_, gz_digest, size) = injector._push_layer(src_dir)
+  return (gz_digest, size, time.time() - start)
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument("--size",
+    required=False,
+    default=256,
+    type=int,
+    help="Size of the generated directory in MB")
+  argparser.add_argument("--chunk_sizes",
+    required=False,
+    default="4,16,64",
+    type=str,
+    help="Comma separated chunk sizes in MB to measure")
+  argparser.add_argument("--fail_every",
+    required=False,
+    default=3,
+    type=int,
+    help="Break every n-th PATCH in the recovery run")
+  argparser.add_argument("--threads",
+    required=False,
+    default=None,
+    type=int,
+    help="Number of threads compressing the layer")
+  args = argparser.parse_args()
+
+  work_dir = tempfile.mkdtemp(prefix="upload-bench-")
+  src_dir = os.path.join(work_dir, "src")
+  failures = 0
+  try:
+    make_tree(src_dir, args.size << 20)
+    chunk_sizes = [int(size) << 20 for size in args.chunk_sizes.split(",")]
+
+    print("%-10s %12s %10s %10s %8s" % ("run", "chunk MB", "MB", "seconds", "MB/s"))
+    reference = None
+    for chunk_size in chunk_sizes:
+      registry = LocalRegistry()
+      injector = make_injector(registry, threads=args.threads, chunk_size=chunk_size)
+      (gz_digest, size, elapsed) = push(injector, src_dir)
+      registry.stop()
+      print("%-10s %12d %10.1f %10.2f %8.1f" %
+            ("upload", chunk_size >> 20, size / 1e6, elapsed, size / 1e6 / elapsed))
+      reference = reference or gz_digest
+      if gz_digest != reference:
+        print("FAILED: chunk size " + str(chunk_size >> 20) + " MB gave a different blob")
+        failures += 1
+
+    chunk_size = chunk_sizes[0]
+    registry = LocalRegistry(fail_every=args.fail_every)
+    injector = make_injector(registry, threads=args.threads, chunk_size=chunk_size)
+    (gz_digest, size, elapsed) = push(injector, src_dir)
+    registry.stop()
+    print("%-10s %12d %10.1f %10.2f %8.1f  %d broken PATCHes, %.1f MB sent twice" %
+          ("recovery", chunk_size >> 20, size / 1e6, elapsed, size / 1e6 / elapsed,
+           registry.stats["failed_patch"], (registry.stats["bytes_in"] - size) / 1e6))
+    if gz_digest != reference or gz_digest not in registry.blobs:
+      print("FAILED: recovered upload gave a different blob")
+      failures += 1
+
+    chunks = size // chunk_size
+    registry = LocalRegistry(fail_after=max(chunks // 2, 1))
+    injector = make_injector(registry, threads=args.threads, chunk_size=chunk_size)
+    injector.upload_retries = 0
+    try:
+      push(injector, src_dir)
+      print("FAILED: upload did not break")
+      failures += 1
+    except Exception as e:
+      print("Interrupted upload: " + str(e))
+    registry.revive()
+    before = registry.stats["bytes_in"]
+    (gz_digest, size, elapsed) = push(injector, src_dir)
+    registry.stop()
+    resent = registry.stats["bytes_in"] - before
+    print("%-10s %12d %10.1f %10.2f %8.1f  %.1f MB sent after the interruption" %
+          ("resume", chunk_size >> 20, size / 1e6, elapsed, size / 1e6 / elapsed, resent / 1e6))
+    if gz_digest != reference or gz_digest not in registry.blobs:
+      print("FAILED: resumed upload gave a different blob")
+      failures += 1
+    if resent >= size or os.path.exists(upload_checkpoint_path(src_dir)):
+      print("FAILED: upload was not resumed from its checkpoint")
+      failures += 1
+  finally:
+    shutil.rmtree(work_dir)
+  sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+  main()
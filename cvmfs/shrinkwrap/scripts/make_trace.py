@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+""" Shrinkwrap helper script to generate a synthetic cvmfs trace log.
+
+The trace accesses a virtual repository laid out like the one make_repo.py
+creates: every directory has a number of files and subdirectories down to
+a maximal depth.  Files are picked with a Zipf-like skew, so few files get
+most of the accesses like in real software stacks.
+
+Example usage:
+python3 make_trace.py -d 4 -n 5 -f 30 -r 100000 -k 1.1 /tmp/trace.log
+Example output in /tmp/trace.log:
+  1.0,-1,"","Tracer starting"
+  1.000001,0,"/dir3/dir0/file7","open()"
+  1.000002,0,"/dir3/dir0","opendir()"
+  1.000003,-2,"/dir1/dir4/dir2/file12","getattr()"
+
+With -l, a listing of the virtual repository as read by spec_builder.py's
+--listing is written as well.
+"""
+
+from __future__ import print_function
+import sys
+import csv
+import random
+from optparse import OptionParser
+
+
+# calls on files and on directories and how often they happen
+file_calls = [("open()", 30), ("getattr()", 25), ("lookup()", 25),
+              ("readlink()", 2), ("getxattr()", 3), ("listxattr()", 2)]
+dir_calls  = [("opendir()", 8), ("statfs()", 5)]
+dir_call_names = set(call for (call, weight) in dir_calls)
+failure_ratio = 0.05
+
+
+def PrintError(msg):
+  print("[ERROR] " + msg, file=sys.stderr)
+  sys.exit(1)
+
+
+class TraceFactory:
+  def __init__(self, max_dir_depth, num_subdirs, num_files_per_dir, \
+               num_rows, skew, min_file_size, max_file_size, seed=0):
+    self.max_dir_depth     = max_dir_depth
+    self.num_subdirs       = num_subdirs
+    self.num_files_per_dir = num_files_per_dir
+    self.num_rows          = num_rows
+    self.skew              = skew
+    self.min_file_size     = min_file_size
+    self.max_file_size     = max_file_size
+    self.random            = random.Random(seed)
+    self.dirs              = []
+    self.rows_produced     = 0
+    self.failures_produced = 0
+    self.paths_touched     = set()
+
+  def Produce(self, trace_file):
+    self._ProduceDirs("", 0)
+    calls = file_calls + dir_calls
+    call_weights = self._CumulativeWeights([w for (c, w) in calls])
+    num_files = len(self.dirs) * self.num_files_per_dir
+    # Zipf-like popularity of files, with files in random order
+    rank_weights = self._CumulativeWeights(
+      [1.0 / (rank ** self.skew) for rank in range(1, num_files + 1)])
+    file_order = list(range(num_files))
+    self.random.shuffle(file_order)
+
+    writer = csv.writer(trace_file, delimiter=',', quotechar='"', \
+                        quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+    writer.writerow([1.0, -1, "", "Tracer starting"])
+    batch = 10000
+    while self.rows_produced < self.num_rows:
+      count = min(batch, self.num_rows - self.rows_produced)
+      ranks = self.random.choices(range(num_files), cum_weights=rank_weights,
+                                  k=count)
+      picks = self.random.choices(calls, cum_weights=call_weights, k=count)
+      rows = []
+      for rank, (call, weight) in zip(ranks, picks):
+        file_index = file_order[rank]
+        directory = self.dirs[file_index // self.num_files_per_dir]
+        if call in dir_call_names:
+          path = directory
+        else:
+          path = directory + "/file" + str(file_index % self.num_files_per_dir)
+        ret = 0
+        if self.random.random() < failure_ratio:
+          ret = -2
+          self.failures_produced += 1
+        else:
+          self.paths_touched.add(path)
+        self.rows_produced += 1
+        rows.append([1.0 + self.rows_produced * 1e-6, ret, path, call])
+      writer.writerows(rows)
+
+  def ProduceListing(self, listing_file):
+    """Write the virtual repository as "path",size,type lines."""
+    sizes = random.Random(self.random.random())
+    writer = csv.writer(listing_file, delimiter=',', quotechar='"', \
+                        quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+    for directory in self.dirs:
+      writer.writerow(["." + directory, 4096, "d"])
+      for i in range(self.num_files_per_dir):
+        writer.writerow(["." + directory + "/file" + str(i), \
+          sizes.randint(self.min_file_size, self.max_file_size), "f"])
+
+  def PredictResults(self):
+    directories = 1
+    for i in range(self.max_dir_depth):
+      directories += self.num_subdirs ** (i + 1)
+    print("Prediction:")
+    print("   directories in repository:   " , directories)
+    print("   files in repository:         " , \
+          directories * self.num_files_per_dir)
+    print("   rows to be produced:         " , self.num_rows)
+
+  def PrintReport(self):
+    print("Results:")
+    print("   rows produced:       " , self.rows_produced)
+    print("   failed calls:        " , self.failures_produced)
+    print("   distinct paths:      " , len(self.paths_touched))
+
+  def _CumulativeWeights(self, weights):
+    total = 0
+    cumulative = []
+    for weight in weights:
+      total += weight
+      cumulative.append(total)
+    return cumulative
+
+  def _ProduceDirs(self, path, dir_level):
+    self.dirs.append(path)
+    if dir_level >= self.max_dir_depth:
+      return
+    for i in range(self.num_subdirs):
+      self._ProduceDirs(''.join([path, "/dir", str(i)]), dir_level + 1)
+
+
+if __name__ == "__main__":
+  # command line parameter parser setup
+  usage = "usage: %prog [options] <trace file>\n\
+  This creates a synthetic trace log based on the parameters provided."
+  parser = OptionParser(usage)
+  parser.add_option("-d", "--max-dir-depth",     dest="max_dir_depth",     default=4,      help="the maximal directory structure depth")
+  parser.add_option("-n", "--num-subdirs",       dest="num_subdirs",       default=5,      help="number of sub-directories per stage")
+  parser.add_option("-f", "--num-files-per-dir", dest="num_files_per_dir", default=30,     help="number of files per directory")
+  parser.add_option("-r", "--num-rows",          dest="num_rows",          default=10000,  help="number of trace rows")
+  parser.add_option("-k", "--skew",              dest="skew",              default=1.0,    help="Zipf exponent of the file popularity, 0 for uniform")
+  parser.add_option("-s", "--min-file-size",     dest="min_file_size",     default=0,      help="minimal file size in the listing")
+  parser.add_option("-b", "--max-file-size",     dest="max_file_size",     default=102400, help="maximal file size in the listing")
+  parser.add_option("-l", "--listing",           dest="listing",           default=None,   help="also write the repository listing to this file")
+  parser.add_option("-e", "--seed",              dest="seed",              default=0,      help="random seed")
+
+  # read command line arguments
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("Please provide the mandatory arguments")
+  try:
+    max_dir_depth     = int(options.max_dir_depth)
+    num_subdirs       = int(options.num_subdirs)
+    num_files_per_dir = int(options.num_files_per_dir)
+    num_rows          = int(float(options.num_rows))
+    skew              = float(options.skew)
+    min_file_size     = int(options.min_file_size)
+    max_file_size     = int(options.max_file_size)
+    seed              = int(options.seed)
+  except ValueError:
+    PrintError("Cannot parse numerical options and/or parameters")
+  trace_path = args[0]
+
+  # check option consistency
+  if max_dir_depth < 0 or num_subdirs < 0:
+    PrintError("directory structure does not make sense")
+  if num_files_per_dir < 1:
+    PrintError("need at least one file per directory")
+  if num_rows < 0 or skew < 0:
+    PrintError("number of rows and skew must not be negative")
+  if min_file_size < 0 or max_file_size < 0 or min_file_size > max_file_size:
+    PrintError("file size restrictions do not make sense.")
+
+  trace_factory = TraceFactory(max_dir_depth,     \
+                               num_subdirs,       \
+                               num_files_per_dir, \
+                               num_rows,          \
+                               skew,              \
+                               min_file_size,     \
+                               max_file_size,     \
+                               seed)
+  trace_factory.PredictResults()
+  with open(trace_path, "w") as trace_file:
+    trace_factory.Produce(trace_file)
+  if options.listing:
+    with open(options.listing, "w") as listing_file:
+      trace_factory.ProduceListing(listing_file)
+  trace_factory.PrintReport()
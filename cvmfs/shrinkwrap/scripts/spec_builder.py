@@ -4,7 +4,12 @@
 
 import argparse
 import csv
+import multiprocessing
 import os.path
+import runpy
+import sys
+
+import trace_compact
 
 from collections import namedtuple
 
@@ -22,6 +27,8 @@ class SpecPoint:
       return "^" + self.path + "/*"
     elif self.mode==0:
       return "^" + (self.path if self.path != "" else "/")
+    elif self.mode==2:
+      return self.path + "/*"
   def __eq__(self, other):
     return self.path == other.path
   def __ne__(self, other):
@@ -31,48 +38,179 @@ class SpecPoint:
   def __gt__(self, other):
     return self.path > other.path
 
-def peek(stack, pos = 1):
-  return stack[-pos] if len(stack)>0 else None
-
 def get_parent(path):
   pos = path.rfind("/")
   return path[:pos] if pos>0 else ""
 
+# Policies map an iterable of TracePoints to a stream of SpecPoints
 def exact_parser(pathsToInclude):
-  specsToInclude = []
   for curPoint in pathsToInclude:
-    specPoint = None
     if curPoint.action in exact_parser.dirFlat:
-      specPoint = SpecPoint(curPoint.path, 1)
+      yield SpecPoint(curPoint.path, 1)
     else:
-      specPoint = SpecPoint(curPoint.path, 0)
-    specsToInclude.append(specPoint)
-  return specsToInclude
+      yield SpecPoint(curPoint.path, 0)
 exact_parser.dirFlat = ["opendir()"]
 
 def parent_dir_parser(pathsToInclude):
-  specsToInclude = []
   # Go through tracer points and build specs based on made calls
   for curPoint in pathsToInclude:
-    specPoint = None
     if curPoint.action in parent_dir_parser.parentDirFlat:
-      specPoint = SpecPoint(get_parent(curPoint.path), 1)
+      yield SpecPoint(get_parent(curPoint.path), 1)
     elif curPoint.action in parent_dir_parser.dirFlat:
-      specPoint = SpecPoint(curPoint.path, 1)
+      yield SpecPoint(curPoint.path, 1)
     else:
-      specPoint = SpecPoint(curPoint.path, 0)
-    specsToInclude.append(specPoint)
-  return specsToInclude
+      yield SpecPoint(curPoint.path, 0)
 
 
 parent_dir_parser.parentDirFlat = ["open()"]
 parent_dir_parser.dirFlat = ["opendir()"]
 
+# POLICY cost: Trace like exact, then replace the spec points of each
+# directory by its flat listing or its whole subtree where that is
+# cheaper, given the directory listing of the repository.  The cost
+# weighs the bytes and entries of the shrinkwrapped image against the
+# number of spec rules.  Exact rules always pull in the least data, but
+# a directory of mostly traced files is cheaper as one flat rule.
+def cost_finish(pathTrie, context):
+  if context.listing is None:
+    raise TraceError("The cost policy needs a directory listing (--listing)")
+  cost_rules(pathTrie.root, "", context)
+
+def cost_rules(node, path, context):
+  # Switch node to the cheapest rules covering it and the spec points
+  # below it and return their cost
+  entryCost = context.entryCost
+  ruleCost = context.ruleCost
+  childCosts = 0
+  uncovered = 0
+  for name, child in node.children.items():
+    cost = cost_rules(child, path + "/" + name, context)
+    childCosts += cost
+    if child.children or (child.mode != 0 and child.mode is not None):
+      # more than the entry in the flat listing of node
+      uncovered += cost - entryCost - (ruleCost if child.mode == 0 else 0)
+  own = entryCost + (ruleCost if node.mode is not None else 0)
+  stats = context.listing.entries.get(path)
+  if stats is None or not stats.isDir:
+    return own + (stats.size if stats is not None else 0) + childCosts
+  flat = entryCost*(1 + stats.flatEntries) + stats.flatBytes + ruleCost
+  tree = entryCost*(1 + stats.treeEntries) + stats.treeBytes + ruleCost
+  if node.mode == 2:
+    return tree
+  costs = [(flat + uncovered, 1), (tree, 2)]
+  if node.mode != 1:
+    costs.insert(0, (own + childCosts, node.mode))
+  (cost, mode) = min(costs, key=lambda costMode: costMode[0])
+  if mode == 1 and node.mode != 1:
+    # the flat listing already covers the exact spec points of children
+    node.mode = 1
+    for name, child in list(node.children.items()):
+      if child.mode == 0 and not child.children:
+        del node.children[name]
+  elif mode == 2:
+    node.mode = 2
+    node.children = {}
+  return cost
+
+# Policies map an iterable of TracePoints to a stream of SpecPoints.  A
+# policy may also have a finish function, which revises the merged trie
+# of all traces before the spec is computed.  More policies can be added
+# by plugins calling register_policy.
 ParsingPolicies = {
   "pdir": parent_dir_parser,
-  "exact": exact_parser
+  "exact": exact_parser,
+  "cost": exact_parser
 }
 
+PolicyFinishers = {
+  "cost": cost_finish
+}
+
+PolicyContext = namedtuple("PolicyContext",
+  ["listing", "entryCost", "ruleCost"])
+
+def register_policy(name, parser, finish=None):
+  ParsingPolicies[name] = parser
+  if finish is not None:
+    PolicyFinishers[name] = finish
+  else:
+    PolicyFinishers.pop(name, None)
+
+def load_plugin(fileName):
+  runpy.run_path(fileName, init_globals={
+    "register_policy": register_policy,
+    "SpecPoint": SpecPoint,
+    "get_parent": get_parent
+  })
+
+def load_plugins(fileNames):
+  # Also the initializer of the worker processes, which don't inherit
+  # the registered policies unless they are forked
+  for fileName in fileNames:
+    load_plugin(fileName)
+
+# Sizes and entry counts of a repository, from lines "path",size,type
+# as written by
+#   cd /cvmfs/<repo> && find . -printf '"%p",%s,%y\n'
+# Directories get the bytes and entries of their flat listing and of
+# their whole subtree.  Bytes only count entries that are no directory.
+class EntryStats:
+  __slots__ = ("size", "isDir", "flatBytes", "flatEntries",
+               "treeBytes", "treeEntries")
+  def __init__(self):
+    self.size = 0
+    self.isDir = True
+    self.flatBytes = 0
+    self.flatEntries = 0
+    self.treeBytes = 0
+    self.treeEntries = 0
+
+class DirectoryListing:
+  def __init__(self):
+    self.entries = {}
+
+  def stats(self, path):
+    entry = self.entries.get(path)
+    if entry is None:
+      entry = self.entries[sys.intern(path)] = EntryStats()
+    return entry
+
+  def load(self, fileName):
+    with open(fileName, "r") as listingFile:
+      csvReader = csv.reader(listingFile, delimiter=',', quotechar='"')
+      for row in csvReader:
+        path = row[0][1:] if row[0].startswith(".") else row[0]
+        path = path.rstrip("/")
+        entry = self.stats(path)
+        entry.size = int(row[1])
+        entry.isDir = row[2] == "d"
+        if path == "":
+          continue
+        size = 0 if entry.isDir else entry.size
+        path = get_parent(path)
+        parent = self.stats(path)
+        parent.flatBytes += size
+        parent.flatEntries += 1
+        while True:
+          parent.treeBytes += size
+          parent.treeEntries += 1
+          if path == "":
+            break
+          path = get_parent(path)
+          parent = self.stats(path)
+    return self
+
+  def rule_size(self, specPoint):
+    # (bytes, entries) a spec point pulls in, None if not listed
+    entry = self.entries.get(specPoint.path)
+    if entry is None:
+      return None
+    if specPoint.mode == 1 and entry.isDir:
+      return (entry.flatBytes, entry.flatEntries + 1)
+    if specPoint.mode == 2 and entry.isDir:
+      return (entry.treeBytes, entry.treeEntries + 1)
+    return (0 if entry.isDir else entry.size, 1)
+
 class TracePoint(namedtuple("TracePoint", ["path", "action"])):
   def __eq__(self, other):
     return self.path == other.path
@@ -83,49 +221,219 @@ class TracePoint(namedtuple("TracePoint", ["path", "action"])):
   def __gt__(self, other):
     return self.path > other.path
 
+# Trie of spec points keyed by path component.  Component names are
+# interned, so memory scales with the number of unique names and paths.
+# Nodes with mode None only lead to deeper spec points, the others are
+# exact (0) or flat directory (1) spec points.
+class PathNode:
+  __slots__ = ("children", "parent", "mode", "inDfs")
+  def __init__(self, parent):
+    self.children = {}
+    self.parent = parent
+    self.mode = None
+    self.inDfs = False
+
+class PathTrie:
+  def __init__(self):
+    # The top node holds the first components of the paths, which is ""
+    # for the root and for every absolute path
+    self.top = PathNode(None)
+    self.root = PathNode(None)
+    self.root.mode = 0
+    self.top.children[""] = self.root
+
+  def add(self, path, mode):
+    node = self.top
+    for part in path.split("/"):
+      child = node.children.get(part)
+      if child is None:
+        # the root is the parent of all relative paths
+        child = PathNode(node if node is not self.top else self.root)
+        node.children[sys.intern(part)] = child
+      node = child
+    if node.mode is None or node.mode < mode:
+      node.mode = mode
+
+  def __getstate__(self):
+    # Flat preorder list of (name, mode, number of children), which is
+    # much cheaper to pass between processes than the nodes themselves
+    nodes = []
+    work = [("", self.top)]
+    while work:
+      (name, node) = work.pop()
+      nodes.append((name, node.mode, len(node.children)))
+      work.extend(node.children.items())
+    return nodes
+
+  def __setstate__(self, nodes):
+    self.top = PathNode(None)
+    self.root = PathNode(None)
+    work = [(self.top, nodes[0][2])]
+    for (name, mode, numChildren) in nodes[1:]:
+      while work[-1][1] == 0:
+        work.pop()
+      (parent, remaining) = work[-1]
+      work[-1] = (parent, remaining - 1)
+      if parent is self.top and name == "":
+        node = self.root
+      else:
+        node = PathNode(parent if parent is not self.top else self.root)
+      node.mode = mode
+      parent.children[sys.intern(name)] = node
+      work.append((node, numChildren))
+
+  def merge(self, other):
+    # Add all spec points of other, taking over its nodes
+    work = [(self.top, other.top)]
+    while work:
+      (node, otherNode) = work.pop()
+      for name, otherChild in otherNode.children.items():
+        child = node.children.get(name)
+        if child is None:
+          otherChild.parent = node if node is not self.top else self.root
+          node.children[name] = otherChild
+          continue
+        if otherChild.mode is not None\
+          and (child.mode is None or child.mode < otherChild.mode):
+          child.mode = otherChild.mode
+        work.append((child, otherChild))
+    return self
+
+  def spec(self):
+    # Visit the spec points in the order of their sorted path strings and
+    # keep the minimal set on a stack, like sorting all paths and walking
+    # them with string prefix comparisons would.  A path sorts before
+    # the paths of its siblings starting with it and a character smaller
+    # than "/", and those sort before its subtree.
+    self.pathSpec = []
+    self.workStack = [(self.root, SpecPoint("", 0))]
+    self.visit(self.top, None)
+    return self.pathSpec + [el for (node, el) in self.workStack]
+
+  def visit(self, node, prefix):
+    entries = []
+    for name, child in node.children.items():
+      if child.mode is not None:
+        entries.append((name, False, child))
+      if child.children:
+        entries.append((name + "/", True, child))
+    entries.sort(key=lambda entry: entry[0])
+    for (key, descend, child) in entries:
+      path = key if prefix is None else prefix + "/" + key
+      if descend:
+        child.inDfs = True
+        self.visit(child, path[:-1])
+        child.inDfs = False
+      else:
+        self.emit(child, path)
+
+  def emit(self, node, path):
+    workStack = self.workStack
+    # Backtrack up to nearest parent, i.e. a node on the current path
+    while True:
+      topNode = workStack[-1][0]
+      if topNode is node or topNode is self.root or topNode.inDfs:
+        break
+      self.pathSpec.append(workStack.pop()[1])
+    topNode, topEl = workStack[-1]
+    if topNode is node:
+      # If stack top element is same path: Update if necessary
+      if topEl.mode < node.mode:
+        topEl.mode = node.mode
+    elif topEl.mode == 0 or topNode is not node.parent or node.mode != 0:
+      # If stack top is some parent: Add if necessary
+      workStack.append((node, SpecPoint(path, node.mode)))
+
+class TraceError(Exception):
+  pass
+
+def trace_points(logFile, filters):
+  # Stream the trace row by row, skipping filtered and blacklisted rows
+  csvLogReader = csv.reader(logFile, delimiter=',', quotechar='"')
+  for row in csvLogReader:
+    if row[3] in filters or int(row[1]) < 0\
+      or row[2] in TraceParser.blacklist:
+      continue
+    if row[2] == "@UNKNOWN":
+      raise TraceError("An error occurred during tracing (event code 8)")
+    yield TracePoint(row[2], row[3])
+
+def compact_trace_points(compactTrace, filters):
+  # Same for a compacted trace, whose rows are all successful
+  for (path, calls) in compactTrace.entries(compactTrace.call_mask(filters)):
+    if path in TraceParser.blacklist:
+      continue
+    if path == "@UNKNOWN":
+      raise TraceError("An error occurred during tracing (event code 8)")
+    for call in calls:
+      yield TracePoint(path, call)
+
+def read_trace(job):
+  # Build the partial trie of one trace file, also in a worker process
+  (inputName, policyName, filters) = job
+  pathTrie = PathTrie()
+  policy = ParsingPolicies[policyName]
+  if trace_compact.is_compact(inputName):
+    with trace_compact.CompactTrace(inputName) as compactTrace:
+      points = compact_trace_points(compactTrace, filters)
+      for specPoint in policy(points):
+        pathTrie.add(specPoint.path, specPoint.mode)
+    return pathTrie
+  with open(inputName, "r") as logFile:
+    for specPoint in policy(trace_points(logFile, filters)):
+      pathTrie.add(specPoint.path, specPoint.mode)
+  return pathTrie
+
+def merge_tries(pair):
+  return pair[0].merge(pair[1])
+
 class TraceParser:
   def __init__(self, args):
-    print("Parsing file: " + args.infile)
+    print("Parsing files: " + ", ".join(args.infiles))
     print("Output file: " + args.outfile)
     print("Policy: " + args.policy)
     print("Filters: " + (",".join(args.filters) if len(args.filters) > 0 else "None"))
-    self.inputName = args.infile
+    self.inputNames = args.infiles
     self.outputName = args.outfile
-    self.policy = ParsingPolicies[args.policy]
+    self.policyName = args.policy
     self.filters = dict([(f+"()"), True] for f in args.filters)
+    self.jobs = max(1, min(args.jobs, len(args.infiles)))
+    self.plugins = args.plugin
+    self.reportName = args.report
+    listing = None
+    if args.listing:
+      print("Directory listing: " + args.listing)
+      listing = DirectoryListing().load(args.listing)
+    self.context = PolicyContext(listing, args.entry_cost, args.rule_cost)
+
   def read_log(self):
-    pathsToInclude = []
-    with open(self.inputName, "r") as logFile:
-      csvLogReader = csv.reader(logFile, delimiter=',', quotechar='"')
-      for row in [r
-                    for r in csvLogReader
-                      if r[3] not in self.filters and int(r[1])>=0
-                        and r[2] not in TraceParser.blacklist]:
-        if row[2] == "@UNKNOWN":
-          print("ERROR: An error occurred during tracing (event code 8)")
-          quit(-1)
-        pathsToInclude.append(TracePoint(row[2], row[3]))
-    specsToInclude = self.policy(pathsToInclude)
-    specsToInclude.sort()
-    rootEl = SpecPoint("", 0)
-    workStack = [rootEl]
-    self.pathSpec = []
-    for specPoint in specsToInclude:
-      while not peek(workStack).isParentOf(specPoint.path):
-        # Backtrack up to nearest parent
-        el = workStack.pop()
-        self.pathSpec.append(el)
-      topEl = peek(workStack)
-      if topEl.path == specPoint.path and topEl.mode < specPoint.mode:
-        # If stack top element is same path: Update if necessary
-        topEl.mode = specPoint.mode
-      elif topEl.path != specPoint.path:
-        # If stack top is some parent: Add if necessary
-        if topEl.mode==0\
-          or topEl.path != get_parent(specPoint.path)\
-          or specPoint.mode!=0:
-          workStack.append(specPoint)
-    self.pathSpec+=workStack
+    jobs = [(inputName, self.policyName, self.filters)
+              for inputName in self.inputNames]
+    try:
+      if self.jobs == 1:
+        pathTrie = read_trace(jobs[0])
+        for job in jobs[1:]:
+          pathTrie.merge(read_trace(job))
+      else:
+        # Parse the traces in parallel, then merge the partial tries
+        # pairwise in a reduction tree
+        pool = multiprocessing.Pool(self.jobs, load_plugins, (self.plugins,))
+        try:
+          tries = pool.map(read_trace, jobs, chunksize=1)
+          while len(tries) > 1:
+            pairs = list(zip(tries[0::2], tries[1::2]))
+            merged = pool.map(merge_tries, pairs, chunksize=1)
+            tries = merged + tries[2*len(pairs):]
+          pathTrie = tries[0]
+        finally:
+          pool.terminate()
+      finish = PolicyFinishers.get(self.policyName)
+      if finish is not None:
+        finish(pathTrie, self.context)
+    except TraceError as e:
+      print("ERROR: " + str(e))
+      quit(-1)
+    self.pathSpec = pathTrie.spec()
 
   def write_spec(self):
     if not self.pathSpec:
@@ -136,6 +444,28 @@ class TraceParser:
         specFile.write(str(p)+"\n")
       specFile.write(str(self.pathSpec[-1]))
 
+  def write_report(self):
+    # Bytes and entries each rule adds according to the listing, largest
+    # first.  Rules are counted on their own, a flat directory includes
+    # the sizes of its files but not of its subdirectories.
+    if not self.reportName:
+      return
+    listing = self.context.listing
+    if listing is None:
+      listing = DirectoryListing()
+    rules = [(listing.rule_size(p), str(p)) for p in self.pathSpec]
+    rules.sort(key=lambda rule: (-(rule[0] or (0, 0))[0], rule[1]))
+    totalBytes = sum(size[0] for (size, rule) in rules if size is not None)
+    totalEntries = sum(size[1] for (size, rule) in rules if size is not None)
+    with open(self.reportName, "w") as reportFile:
+      reportFile.write("%14s %10s  %s\n" % ("bytes", "entries", "rule"))
+      for (size, rule) in rules:
+        if size is None:
+          reportFile.write("%14s %10s  %s\n" % ("?", "?", rule))
+        else:
+          reportFile.write("%14d %10d  %s\n" % (size[0], size[1], rule))
+      reportFile.write("%14d %10d  total\n" % (totalBytes, totalEntries))
+
 TraceParser.blacklist = ["/.Trash","/.Trash-1000"]
 
 
@@ -146,17 +476,58 @@ def parse_args():
     default="pdir",
     type=str,
     help="What files should be included given a traced"
-      + " action on a certain file")
+      + " action on a certain file: pdir, exact, cost or one added by"
+      + " a plugin")
+
+  argparser.add_argument("--plugin",
+    required=False,
+    default=[],
+    action="append",
+    help="Python file adding policies with register_policy(name, parser,"
+      + " finish=None)")
+
+  argparser.add_argument("--listing",
+    required=False,
+    default=None,
+    type=str,
+    help="Directory listing of the repository with lines \"path\",size,type,"
+      + " e.g. from find . -printf '\"%%p\",%%s,%%y\\n'")
+
+  argparser.add_argument("--entry-cost",
+    required=False,
+    default=4096,
+    type=int,
+    help="Cost of an entry of the image in bytes, for the cost policy")
+
+  argparser.add_argument("--rule-cost",
+    required=False,
+    default=1048576,
+    type=int,
+    help="Cost of a spec rule in bytes, for the cost policy")
+
+  argparser.add_argument("--report",
+    required=False,
+    default=None,
+    type=str,
+    help="Write the bytes and entries each rule adds to this file")
 
 
-  argparser.add_argument("infile",
+  argparser.add_argument("infiles",
     type=str,
-    help="The trace log file")
+    nargs="+",
+    help="The trace log files, merged into one spec; each may also be"
+      + " compacted with trace_compact.py")
 
   argparser.add_argument("outfile",
     type=str,
     help="The output file")
 
+  argparser.add_argument("--jobs", "-j",
+    required=False,
+    default=multiprocessing.cpu_count(),
+    type=int,
+    help="Number of trace files parsed in parallel")
+
   argparser.add_argument("--filters",
     required=False,
     default="",
@@ -168,9 +539,15 @@ def parse_args():
 
 def main():
   args = parse_args()
+  load_plugins(args.plugin)
+  if args.policy not in ParsingPolicies:
+    print("ERROR: Unknown policy " + args.policy + ", choose from "
+      + ", ".join(sorted(ParsingPolicies)))
+    quit(-1)
   traceParser = TraceParser(args)
   traceParser.read_log()
   traceParser.write_spec()
+  traceParser.write_report()
 
 if __name__ == "__main__":
     main()
@@ -3,82 +3,320 @@
 #
 
 import argparse
+import os
+import struct
+import sys
+from array import array
 
-class TreeNode:
-  def __init__(self, mode):
-    self.children = {}
-    self.mode = mode
-  def getString(self, prefix, wildcard):
-    stringRes = ''
-    if self.mode == '!':
-      stringRes = '!' + prefix + '\n'
-    if not wildcard:
-      if self.mode == '^':
-        stringRes = '^'+prefix+'*\n'
-      elif self.mode == '*':
-        stringRes = prefix + '/*\n'
-      elif self.mode == '/':
-        if len(prefix) == 0:
-          stringRes = "^/\n"
-        stringRes = '^' + prefix + '\n'
-      for key, val in self.children.items():
-        stringRes+=val.getString(prefix+'/'+key, self.mode == '*')
-    return stringRes
-  def __str__(self):
-    return self.getString("", False)
+# Compact trie of spec paths.  Nodes are indexes into parallel arrays of
+# parent, interned name, mode and the first/last child and next sibling,
+# so children keep their insertion order.  Node 0 is the root.  Children
+# are found through one dict keyed by parent and name id.
+class SpecTrie:
+  magic = b"CVMFS-SPEC-TRIE\x02"
+
+  def __init__(self, rootMode='/'):
+    self.names = []
+    self.nameIds = {}
+    self.parent = array('i', [-1])
+    self.name = array('i', [-1])
+    self.mode = bytearray(rootMode.encode())
+    self.firstChild = array('i', [-1])
+    self.lastChild = array('i', [-1])
+    self.nextSibling = array('i', [-1])
+    self.childIndex = {}
+    self.mark_saved()
+
+  def __len__(self):
+    return len(self.parent)
+
+  def intern(self, part):
+    nameId = self.nameIds.get(part)
+    if nameId is None:
+      nameId = len(self.names)
+      self.names.append(part)
+      self.nameIds[part] = nameId
+    return nameId
+
+  def child(self, node, part):
+    nameId = self.nameIds.get(part)
+    if nameId is None:
+      return -1
+    return self.childIndex.get((nameId << 32) | node, -1)
+
+  def add_child(self, node, part, mode):
+    nameId = self.intern(part)
+    child = len(self.parent)
+    self.parent.append(node)
+    self.name.append(nameId)
+    self.mode.append(ord(mode))
+    self.firstChild.append(-1)
+    self.lastChild.append(-1)
+    self.nextSibling.append(-1)
+    if self.lastChild[node] == -1:
+      self.firstChild[node] = child
+    else:
+      self.nextSibling[self.lastChild[node]] = child
+    self.lastChild[node] = child
+    self.childIndex[(nameId << 32) | node] = child
+    return child
+
+  def children(self, node):
+    child = self.firstChild[node]
+    while child != -1:
+      yield child
+      child = self.nextSibling[child]
+
+  def write(self, outFile):
+    # Stream the spec lines depth first.  The subtree of a flat
+    # directory ('*') only contributes its exclusions ('!'), without
+    # descending further.
+    work = [(0, "", False)]
+    while work:
+      (node, prefix, wildcard) = work.pop()
+      mode = chr(self.mode[node])
+      if mode == '!':
+        outFile.write('!' + prefix + '\n')
+      if wildcard:
+        continue
+      if mode == '^':
+        outFile.write('^' + prefix + '*\n')
+      elif mode == '*':
+        outFile.write(prefix + '/*\n')
+      elif mode == '/':
+        outFile.write('^' + prefix + '\n')
+      children = [(child, prefix + '/' + self.names[self.name[child]],
+                   mode == '*')
+                  for child in self.children(node)]
+      children.reverse()
+      work.extend(children)
+
+  # The binary form is the magic followed by segments.  A segment holds
+  # the names and nodes added since the previous segment and the new
+  # modes of nodes stored before it, so an updated trie is persisted by
+  # appending one segment.  Each segment starts with the counts of new
+  # names, new nodes and mode patches (little endian uint32), followed by
+  # the names as length-prefixed UTF-8, the parent and name id of each
+  # new node as int32 arrays, their modes as one byte each, and the
+  # patched node ids and their modes.  Nodes are stored in creation
+  # order, so a child always follows its parent and siblings keep their
+  # order.
+
+  def mark_saved(self):
+    self.savedNames = len(self.names)
+    self.savedNodes = len(self.parent)
+    self.savedMode = bytes(self.mode)
+
+  def changed(self):
+    return self.savedNames < len(self.names)\
+      or self.savedNodes < len(self.parent)\
+      or self.savedMode != self.mode[:self.savedNodes]
+
+  def segment(self, firstName, firstNode, savedMode):
+    patches = array('i', [node for node in range(len(savedMode))
+                          if savedMode[node] != self.mode[node]])
+    parent = self.parent[firstNode:]
+    name = self.name[firstNode:]
+    if sys.byteorder != "little":
+      patches.byteswap()
+      parent.byteswap()
+      name.byteswap()
+    chunks = [struct.pack("<III", len(self.names) - firstName,
+                          len(self.parent) - firstNode, len(patches))]
+    for part in self.names[firstName:]:
+      encoded = part.encode("utf-8", "surrogateescape")
+      chunks.append(struct.pack("<I", len(encoded)))
+      chunks.append(encoded)
+    chunks.append(parent.tobytes())
+    chunks.append(name.tobytes())
+    chunks.append(bytes(self.mode[firstNode:]))
+    chunks.append(patches.tobytes())
+    chunks.append(bytes(self.mode[node] for node in patches))
+    return b"".join(chunks)
+
+  def save(self, fileName):
+    # Write the whole trie as a single segment, to a temporary file that
+    # replaces fileName when complete, so an interrupted save leaves the
+    # previous file intact
+    with open(fileName + ".tmp", "wb") as trieFile:
+      trieFile.write(SpecTrie.magic)
+      # relative to a new trie, which only has the root
+      trieFile.write(self.segment(0, 1, SpecTrie().mode))
+      trieFile.flush()
+      os.fsync(trieFile.fileno())
+    os.rename(fileName + ".tmp", fileName)
+    self.mark_saved()
+
+  def append(self, fileName):
+    # Append the changes since the trie was loaded or saved, undoing a
+    # partial write so the file stays loadable
+    if not self.changed():
+      return False
+    data = self.segment(self.savedNames, self.savedNodes, self.savedMode)
+    with open(fileName, "r+b") as trieFile:
+      size = trieFile.seek(0, os.SEEK_END)
+      try:
+        trieFile.write(data)
+        trieFile.flush()
+        os.fsync(trieFile.fileno())
+      except BaseException:
+        trieFile.truncate(size)
+        raise
+    self.mark_saved()
+    return True
+
+  @staticmethod
+  def is_trie_file(fileName):
+    with open(fileName, "rb") as trieFile:
+      return trieFile.read(len(SpecTrie.magic)) == SpecTrie.magic
+
+  @staticmethod
+  def load(fileName):
+    # parse copies everything into the arrays, so read the file in one go
+    with open(fileName, "rb") as trieFile:
+      data = trieFile.read()
+    trie = SpecTrie.parse(data, fileName)
+    trie.mark_saved()
+    return trie
+
+  @staticmethod
+  def parse(data, fileName):
+    if data[:len(SpecTrie.magic)] != SpecTrie.magic:
+      raise ValueError(fileName + " is not a spec trie file")
+    pos = len(SpecTrie.magic)
+    trie = SpecTrie()
+    while pos < len(data):
+      if pos + 12 > len(data):
+        raise ValueError(fileName + " is truncated")
+      (numNames, numNodes, numPatches) = struct.unpack_from("<III", data, pos)
+      pos += 12
+      for i in range(numNames):
+        (length,) = struct.unpack_from("<I", data, pos)
+        pos += 4
+        trie.intern(data[pos:pos+length].decode("utf-8", "surrogateescape"))
+        pos += length
+      end = pos + 9*numNodes + 5*numPatches
+      if end > len(data):
+        raise ValueError(fileName + " is truncated")
+      parent = array('i', data[pos:pos+4*numNodes])
+      pos += 4*numNodes
+      name = array('i', data[pos:pos+4*numNodes])
+      pos += 4*numNodes
+      mode = data[pos:pos+numNodes]
+      pos += numNodes
+      patches = array('i', data[pos:pos+4*numPatches])
+      pos += 4*numPatches
+      patchModes = data[pos:pos+numPatches]
+      pos += numPatches
+      if sys.byteorder != "little":
+        parent.byteswap()
+        name.byteswap()
+        patches.byteswap()
+      firstNode = len(trie)
+      for node in range(numNodes):
+        trie.add_child(parent[node], trie.names[name[node]], '_')
+      trie.mode[firstNode:] = mode
+      for (node, patchMode) in zip(patches, patchModes):
+        trie.mode[node] = patchMode
+    return trie
 
 class DiffBuilder:
   def __init__(self, args):
     self.infiles = args.infiles
     self.outfile = args.outfile
     self.depth = args.depth
-    self.root = TreeNode('/')
-  
+    self.saveTrie = args.save_trie
+    self.state = args.state
+    self.root = 0
+    self.trie = SpecTrie()
+    self.modeUpdates = {}
+
+  def update_mode(self, node, update):
+    # calc_new_mode on the stored mode byte, memoized per combination
+    modes = self.trie.mode
+    key = (modes[node] << 8) | ord(update)
+    newMode = self.modeUpdates.get(key)
+    if newMode is None:
+      newMode = ord(self.calc_new_mode(chr(modes[node]), update))
+      self.modeUpdates[key] = newMode
+    modes[node] = newMode
+
+  def read_spec(self, fileName):
+    with open(fileName, 'r') as specFile:
+      for curLine in specFile:
+        yield self.get_info(curLine)
+
   def build_diff(self):
-    with open(self.infiles[0], 'r') as specFile0:
-      for curLine in specFile0:
-        (curLine, mode) = self.get_info(curLine)
-        path_parts = curLine.split('/')
-        curNode = self.add_node(path_parts, mode)
-        curNode.mode = self.calc_new_mode(curNode.mode, mode)
-    for curfile in self.infiles[1:]:
-      with open(curfile, 'r') as curSpecFile:
-        for curLine in curSpecFile:
-          (curLine, mode) = self.get_info(curLine)
-          path_parts = curLine.split('/')
-          if (mode == '!'):
-            curNode = self.add_node(path_parts, mode)
-            curNode.mode = self.calc_new_mode(curNode.mode, mode)
-          else:
-            curNode = self.root
-            passthrough = '-' if mode=='!' else '_'
-            curDepth = 0
-            mergeable = True
-            for part in path_parts:
-              curDepth+=1
-              if not part in curNode.children\
-                and curDepth > self.depth\
-                and mergeable:
-                print("Found mergeable")
-                curNode.mode = self.calc_new_mode(curNode.mode, '*')
-                break
-              elif not part in curNode.children:
-                mergeable = False
-                curNode.children[part] = TreeNode(passthrough)
-              curNode = curNode.children[part]
-              curNode.mode = self.calc_new_mode(curNode.mode, passthrough)
-            curNode.mode = self.calc_new_mode(curNode.mode, mode)
+    infiles = self.infiles
+    # a missing or empty state file means there is no saved merge yet
+    hasState = self.state and os.path.exists(self.state)\
+      and os.path.getsize(self.state) > 0
+    if hasState:
+      # incremental: every input is new relative to the saved merge
+      self.trie = SpecTrie.load(self.state)
+    elif SpecTrie.is_trie_file(infiles[0]):
+      # continue from a previously saved merge
+      self.trie = SpecTrie.load(infiles[0])
+      infiles = infiles[1:]
+    else:
+      self.merge_first(infiles[0])
+      infiles = infiles[1:]
+    for curfile in infiles:
+      self.merge_spec(curfile)
     with open(self.outfile, "w") as specFile:
-      specFile.write(str(self.root))
-  
+      self.trie.write(specFile)
+    if self.state:
+      if hasState:
+        self.trie.append(self.state)
+      else:
+        self.trie.save(self.state)
+    if self.saveTrie:
+      self.trie.save(self.saveTrie)
+
+  def merge_first(self, fileName):
+    for (curLine, mode) in self.read_spec(fileName):
+      path_parts = curLine.split('/')
+      curNode = self.add_node(path_parts, mode)
+      self.update_mode(curNode, mode)
+
+  def merge_spec(self, fileName):
+    trie = self.trie
+    for (curLine, mode) in self.read_spec(fileName):
+      path_parts = curLine.split('/')
+      if (mode == '!'):
+        curNode = self.add_node(path_parts, mode)
+        self.update_mode(curNode, mode)
+      else:
+        curNode = self.root
+        passthrough = '-' if mode=='!' else '_'
+        curDepth = 0
+        mergeable = True
+        for part in path_parts:
+          curDepth+=1
+          child = trie.child(curNode, part)
+          if child == -1\
+            and curDepth > self.depth\
+            and mergeable:
+            print("Found mergeable")
+            self.update_mode(curNode, '*')
+            break
+          elif child == -1:
+            mergeable = False
+            child = trie.add_child(curNode, part, passthrough)
+          curNode = child
+          self.update_mode(curNode, passthrough)
+        self.update_mode(curNode, mode)
+
   def add_node(self, path_parts, mode):
+    trie = self.trie
     curNode = self.root
     passthrough = '-' if mode=='!' else '_'
     for part in path_parts:
-      if not part in curNode.children:
-        curNode.children[part] = TreeNode(passthrough)
-      curNode = curNode.children[part]
-      curNode.mode = self.calc_new_mode(curNode.mode, passthrough)
+      child = trie.child(curNode, part)
+      if child == -1:
+        child = trie.add_child(curNode, part, passthrough)
+      curNode = child
+      self.update_mode(curNode, passthrough)
     return curNode
 
   def calc_new_mode(self, old, update):
@@ -128,12 +366,26 @@ def parse_args():
   argparser.add_argument("infiles",
     type=str,
     nargs="+",
-    help="The trace log file")
+    help="The spec files to merge; the first one may be a saved trie")
 
   argparser.add_argument("outfile",
     type=str,
     help="The output file")
 
+  argparser.add_argument("--save-trie",
+    required=False,
+    default=None,
+    type=str,
+    help="Also save the merged trie in binary form to this file")
+
+  argparser.add_argument("--state",
+    required=False,
+    default=None,
+    type=str,
+    help="Merged trie kept across runs.  If it exists, all infiles are "
+      "merged into it as new specs and only the changes are appended to "
+      "it; otherwise it is created from this run's merge")
+
   return argparser.parse_args()
 
 def main():
@@ -4,65 +4,234 @@
 
 import argparse
 import csv
+import json
+import sys
+
+import trace_compact
+
+# Exit codes
+EXIT_SUCCESS = 0
+EXIT_MISSING = 1
+EXIT_INVALID = 2
+
+class SpecError(Exception):
+  pass
+
+class TraceError(Exception):
+  pass
+
+# Spec compiled into a trie of path components with the modes of
+# SpecTree in spec_tree.cc: '' for an exact path, '^' for a flat
+# directory, '*' for a whole subtree, '!' for an exclusion and '_' or '-'
+# for the parents leading to included or only to excluded paths.
+class SpecNode:
+  __slots__ = ("children", "mode")
+  def __init__(self, mode):
+    self.children = {}
+    self.mode = mode
+
+class SpecIndex:
+  def __init__(self):
+    self.root = SpecNode('_')
+
+  def add_line(self, rawLine):
+    line = rawLine.strip()
+    if line == "" or line[0] == '#':
+      return
+    if line[0] not in "/!^":
+      raise SpecError("Invalid specification: " + rawLine.strip())
+    mode = ''
+    if line[0] in "^!":
+      mode = line[0]
+      line = line[1:]
+    if line.endswith('*'):
+      if mode == '':
+        mode = '*'
+      line = line[:-1]
+    elif mode == '^':
+      mode = ''
+    if line == "" or line[0] != '/':
+      raise SpecError("Invalid specification: " + rawLine.strip())
+    passthrough = '-' if mode == '!' else '_'
+    node = self.root
+    for part in line.split('/'):
+      if part == "":
+        continue
+      child = node.children.get(part)
+      if child is None:
+        child = SpecNode(passthrough)
+        node.children[sys.intern(part)] = child
+      elif mode != '!' and child.mode == '-':
+        # now also leads to an included path
+        child.mode = '_'
+      node = child
+    node.mode = mode
+
+  def load(self, fileName):
+    with open(fileName, "r") as specFile:
+      for curLine in specFile:
+        self.add_line(curLine)
+    return self
+
+  def check(self, path, listing):
+    # Like SpecTree::IsMatching, or SpecTree::ListDir serving the full
+    # directory listing if listing is set.  Returns None if the path is
+    # covered, otherwise the root of the missing subtree.
+    node = self.root
+    wildcard = node.mode == '*'
+    flat = node.mode == '^'
+    if node.mode == '!':
+      return "/"
+    parts = path.rstrip('/').split('/')
+    for i in range(1, len(parts)):
+      node = node.children.get(parts[i])
+      if node is None:
+        if wildcard or (not listing and flat and i == len(parts) - 1):
+          return None
+        return "/".join(parts[:i+1])
+      flat = False
+      if node.mode == '!':
+        return "/".join(parts[:i+1])
+      if node.mode == '*':
+        wildcard = True
+      elif node.mode == '^':
+        flat = True
+    if wildcard or flat or (not listing and node.mode in ('', '_')):
+      return None
+    return path if path != "" else "/"
 
-def get_parent(path):
-  pos = path.rfind("/")
-  return path[:pos] if pos>0 else ""
 class TraceParser:
   def __init__(self, args):
     print("Parsing file: " + args.infile)
-    print("Output file: " + args.outfile)
+    print("Spec file: " + args.outfile)
     print("Filters: " + (",".join(args.filters) if len(args.filters) > 0 else "None"))
     self.inputName = args.infile
-    self.outputName = args.outfile
+    self.specName = args.outfile
     self.filters = { (f+"()"):True for f in args.filters}
+    self.top = args.top
+    self.reportName = args.report
+    self.quiet = args.quiet
+
   def read_log(self):
-    error = False
-    pathsIncluded = {}
-    with open(self.outputName, "r") as logFile:
-      for curLine in logFile:
-        #print(curLine)
-        pathsIncluded[curLine.strip()] = True
-    #quit()
+    try:
+      index = SpecIndex().load(self.specName)
+    except SpecError as e:
+      print("ERROR: " + str(e))
+      return EXIT_INVALID
+    # Per call type: [rows checked, rows missing]
+    calls = {}
+    # Check result of every distinct (path, listing) pair
+    results = {}
+    # Missing subtree root: [rows, distinct paths]
+    subtrees = {}
+    try:
+      for (path, call) in self.trace_calls():
+        listing = call in TraceParser.listingCalls
+        key = (path, listing)
+        if key in results:
+          missing = results[key]
+          new = False
+        else:
+          missing = results[key] = index.check(path, listing)
+          new = True
+        counts = calls.get(call)
+        if counts is None:
+          counts = calls[call] = [0, 0]
+        counts[0] += 1
+        if missing is None:
+          continue
+        counts[1] += 1
+        subtree = subtrees.get(missing)
+        if subtree is None:
+          subtree = subtrees[missing] = [0, 0]
+        subtree[0] += 1
+        if new:
+          subtree[1] += 1
+          if not self.quiet:
+            print("ERROR: " + (path if path != "" else "/") +
+                  (" (listing)" if listing else "") +
+                  " not included in spec! Missing: " + missing)
+    except TraceError as e:
+      print("ERROR: " + str(e))
+      return EXIT_INVALID
+    report = self.make_report(calls, subtrees)
+    self.print_report(report)
+    if self.reportName:
+      with open(self.reportName, "w") as reportFile:
+        json.dump(report, reportFile, indent=2, sort_keys=True)
+    if report["missing"] == 0:
+      print("SUCCESS")
+      return EXIT_SUCCESS
+    print("ERROR")
+    return EXIT_MISSING
+
+  def trace_calls(self):
+    # Stream the (path, call) pairs of the trace that are not filtered.
+    # A compacted trace has every pair only once.
+    if trace_compact.is_compact(self.inputName):
+      with trace_compact.CompactTrace(self.inputName) as compactTrace:
+        for (path, calls) in compactTrace.entries(
+            compactTrace.call_mask(self.filters)):
+          if path not in TraceParser.blacklist:
+            for call in calls:
+              yield (path, call)
+      return
     with open(self.inputName, "r") as logFile:
       csvLogReader = csv.reader(logFile, delimiter=',', quotechar='"')
-      for row in [r
-                    for r in csvLogReader
-                      if r[3] not in self.filters and int(r[1])>=0
-                        and r[2] not in TraceParser.blacklist]:
-        # Iterate over not filtered elements
-        path = row[2] if row[2] != "" else "/"
-        if row[3] == "opendir()":
-          if ("^"+row[2]+"/*") not in pathsIncluded:
-            error=True
-            print("ERROR: "+path+" not included in spec! Searched for:")
-            print("^"+path+"/*")
-        elif ("^"+path) not in pathsIncluded\
-          and ("^"+get_parent(path)+"/*") not in pathsIncluded\
-          and ("^"+path+"/*") not in pathsIncluded:
-          error=True
-          print("ERROR: "+path+" not included in spec! Searched for:")
-          print("^"+path)
-          print("^"+get_parent(path)+"/*")
-    if not error:
-      print("SUCCESS")
-      quit(0)
-    else:
-      print("ERROR")
-      quit(-1)
+      try:
+        for row in csvLogReader:
+          if row[3] in self.filters or int(row[1]) < 0\
+            or row[2] in TraceParser.blacklist:
+            continue
+          yield (row[2], row[3])
+      except (IndexError, ValueError):
+        raise TraceError("malformed trace line " + str(csvLogReader.line_num))
+
+  def make_report(self, calls, subtrees):
+    top = sorted(subtrees.items(), key=lambda item: (-item[1][0], item[0]))
+    return {
+      "trace": self.inputName,
+      "spec": self.specName,
+      "checked": sum(counts[0] for counts in calls.values()),
+      "missing": sum(counts[1] for counts in calls.values()),
+      "calls": dict((call, {"checked": counts[0], "missing": counts[1]})
+                    for call, counts in calls.items()),
+      "missingSubtrees": len(subtrees),
+      "topMissing": [{"path": path, "rows": counts[0], "paths": counts[1]}
+                     for path, counts in top[:self.top]],
+    }
+
+  def print_report(self, report):
+    print("%-14s %12s %12s %8s" % ("call", "checked", "missing", "covered"))
+    for call in sorted(report["calls"]):
+      counts = report["calls"][call]
+      print("%-14s %12d %12d %7.2f%%" % (call, counts["checked"],
+        counts["missing"], coverage(counts["checked"], counts["missing"])))
+    print("%-14s %12d %12d %7.2f%%" % ("total", report["checked"],
+      report["missing"], coverage(report["checked"], report["missing"])))
+    if report["topMissing"]:
+      print("Top missing subtrees (of " + str(report["missingSubtrees"]) + "):")
+      for entry in report["topMissing"]:
+        print("%12d rows %8d paths  %s" % (entry["rows"], entry["paths"],
+                                           entry["path"]))
+
+def coverage(checked, missing):
+  return 100.0 * (checked - missing) / checked if checked else 100.0
 
 TraceParser.blacklist = ["/.Trash","/.Trash-1000"]
+# Calls that need the full directory listing
+TraceParser.listingCalls = ["opendir()"]
 
 def parse_args():
   argparser = argparse.ArgumentParser()
-  
+
   argparser.add_argument("infile",
     type=str,
-    help="The trace log file")
+    help="The trace log file, or one compacted with trace_compact.py")
 
   argparser.add_argument("outfile",
     type=str,
-    help="The output file")
+    help="The spec file to verify, as written by spec_builder")
 
   argparser.add_argument("--filters",
     required=False,
@@ -70,12 +239,28 @@ def parse_args():
     nargs="+",
     choices=["open", "opendir", "lookup", "statfs", "getattr", "listxattr", "getxattr", "readlink"],
     help="Calls which should be filtered")
+
+  argparser.add_argument("--top",
+    required=False,
+    default=10,
+    type=int,
+    help="Number of missing subtrees to report")
+
+  argparser.add_argument("--report",
+    required=False,
+    default=None,
+    type=str,
+    help="Also write the coverage report as JSON to this file")
+
+  argparser.add_argument("--quiet", "-q",
+    action="store_true",
+    help="Do not print every missing path")
   return argparser.parse_args()
 
 def main():
   args = parse_args()
   traceParser = TraceParser(args)
-  traceParser.read_log()
+  sys.exit(traceParser.read_log())
 
 if __name__ == "__main__":
     main()
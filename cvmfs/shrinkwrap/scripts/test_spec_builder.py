@@ -0,0 +1,68 @@
+#
+# This file is part of the CernVM File System.
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+plugin = """
+def flat_all(points):
+  for p in points:
+    yield SpecPoint(get_parent(p.path), 1)
+register_policy("flatall", flat_all)
+"""
+
+traces = [
+  ['1.0,-1,"","Tracer starting"',
+   '1.5,4,"/a/b/c","open()"',
+   '2.5,5,"/a/d","lookup()"'],
+  ['1.0,-1,"","Tracer starting"',
+   '1.5,4,"/e/f","open()"',
+   '2.5,5,"/a/b/g","getattr()"']
+]
+
+class PluginTest(unittest.TestCase):
+  def setUp(self):
+    self.workDir = tempfile.mkdtemp()
+    self.pluginName = os.path.join(self.workDir, "plugin.py")
+    with open(self.pluginName, "w") as pluginFile:
+      pluginFile.write(plugin)
+    self.traceNames = []
+    for i, trace in enumerate(traces):
+      traceName = os.path.join(self.workDir, "trace" + str(i) + ".log")
+      with open(traceName, "w") as traceFile:
+        traceFile.write("\n".join(trace) + "\n")
+      self.traceNames.append(traceName)
+
+  def tearDown(self):
+    shutil.rmtree(self.workDir)
+
+  def build(self, jobs, startMethod):
+    # run spec_builder with the given start method of the worker processes
+    specName = os.path.join(self.workDir, "spec" + str(jobs) + startMethod)
+    argv = ["spec_builder.py", "--plugin", self.pluginName, "--policy",
+            "flatall", "-j", str(jobs)] + self.traceNames + [specName]
+    code = ("import multiprocessing, sys\n"
+            "multiprocessing.set_start_method(%r)\n"
+            "import spec_builder\n"
+            "sys.argv = %r\n"
+            "spec_builder.main()\n") % (startMethod, argv)
+    subprocess.check_output([sys.executable, "-c", code], cwd=scriptDir,
+                            stderr=subprocess.STDOUT)
+    with open(specName) as specFile:
+      return specFile.read()
+
+  def test1PluginPolicyInWorkers(self):
+    expected = self.build(1, "spawn")
+    self.assertEqual("^/a/b/*\n^/a/*\n^/\n^/e/*", expected)
+    self.assertEqual(expected, self.build(2, "spawn"))
+    self.assertEqual(expected, self.build(2, "fork"))
+
+if __name__ == "__main__":
+  unittest.main()
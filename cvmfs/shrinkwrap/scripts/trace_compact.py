@@ -0,0 +1,178 @@
+#
+# This file is part of the CernVM File System.
+#
+
+# Compacts a cvmfs trace log into a binary table of (path id, action
+# bitmask) and a sorted path dictionary, with one entry per path that
+# had at least one successful call.  spec_builder.py and spec_test.py
+# accept the compacted form wherever they take a trace log.
+#
+# Format, all integers little endian:
+#   magic
+#   uint32 number of calls, paths and entries
+#   the call names, each as uint32 length and UTF-8 bytes; bit i of an
+#     action bitmask stands for call i
+#   uint64 offsets of the paths in the path blob, one more than paths
+#   the path blob, the sorted paths as UTF-8 without separators
+#   uint32 path ids of the entries, sorted
+#   uint32 action bitmasks of the entries
+
+import argparse
+import csv
+import mmap
+import struct
+import sys
+from array import array
+
+magic = b"CVMFS-TRACE-CPT\x01"
+
+# Calls recorded by the tracer, the first ones get the low bits
+knownCalls = ["open()", "opendir()", "lookup()", "statfs()", "getattr()",
+              "listxattr()", "getxattr()", "readlink()"]
+
+def is_compact(fileName):
+  with open(fileName, "rb") as traceFile:
+    return traceFile.read(len(magic)) == magic
+
+def little_endian(values):
+  if sys.byteorder != "little":
+    values = array(values.typecode, values)
+    values.byteswap()
+  return values
+
+def compact(logFile):
+  # One pass over the trace, or-ing the calls of every path together
+  calls = list(knownCalls)
+  callBits = dict((call, 1 << bit) for bit, call in enumerate(calls))
+  masks = {}
+  csvLogReader = csv.reader(logFile, delimiter=',', quotechar='"')
+  for row in csvLogReader:
+    if int(row[1]) < 0:
+      continue
+    bit = callBits.get(row[3])
+    if bit is None:
+      if len(calls) == 32:
+        raise ValueError("too many different calls in trace")
+      bit = callBits[row[3]] = 1 << len(calls)
+      calls.append(row[3])
+    path = row[2]
+    masks[path] = masks.get(path, 0) | bit
+  return (calls, masks)
+
+def write_compact(fileName, calls, masks):
+  paths = sorted(masks)
+  encoded = [path.encode("utf-8", "surrogateescape") for path in paths]
+  offsets = array('q', [0])
+  for path in encoded:
+    offsets.append(offsets[-1] + len(path))
+  with open(fileName, "wb") as compactFile:
+    compactFile.write(magic)
+    compactFile.write(struct.pack("<III", len(calls), len(paths), len(paths)))
+    for call in calls:
+      call = call.encode("utf-8")
+      compactFile.write(struct.pack("<I", len(call)))
+      compactFile.write(call)
+    compactFile.write(little_endian(offsets).tobytes())
+    for path in encoded:
+      compactFile.write(path)
+    compactFile.write(little_endian(array('I', range(len(paths)))).tobytes())
+    compactFile.write(little_endian(
+      array('I', [masks[path] for path in paths])).tobytes())
+
+# Read access to a compacted trace through a memory map.  The offsets
+# and entries are used in place, only the paths that are asked for are
+# decoded.
+class CompactTrace:
+  def __init__(self, fileName):
+    with open(fileName, "rb") as traceFile:
+      self.data = mmap.mmap(traceFile.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.data[:len(magic)] != magic:
+      self.data.close()
+      raise ValueError(fileName + " is not a compacted trace")
+    self.view = view = memoryview(self.data)
+    pos = len(magic)
+    (numCalls, numPaths, numEntries) = struct.unpack_from("<III", view, pos)
+    pos += 12
+    self.calls = []
+    for i in range(numCalls):
+      (length,) = struct.unpack_from("<I", view, pos)
+      pos += 4
+      self.calls.append(str(view[pos:pos+length], "utf-8"))
+      pos += length
+    self.offsets = self.view_array(view, pos, 'q', numPaths + 1)
+    pos += 8 * (numPaths + 1)
+    self.blob = pos
+    pos += self.offsets[numPaths]
+    self.pathIds = self.view_array(view, pos, 'I', numEntries)
+    pos += 4 * numEntries
+    self.masks = self.view_array(view, pos, 'I', numEntries)
+
+  def close(self):
+    # the views into the map have to be released before it can be closed
+    for values in (self.offsets, self.pathIds, self.masks, self.view):
+      if isinstance(values, memoryview):
+        values.release()
+    self.data.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @staticmethod
+  def view_array(view, pos, typecode, count):
+    size = array(typecode).itemsize
+    if sys.byteorder == "little":
+      return view[pos:pos+size*count].cast(typecode)
+    values = array(typecode, view[pos:pos+size*count])
+    values.byteswap()
+    return values
+
+  def __len__(self):
+    return len(self.pathIds)
+
+  def path(self, pathId):
+    start = self.blob + self.offsets[pathId]
+    end = self.blob + self.offsets[pathId + 1]
+    return self.data[start:end].decode("utf-8", "surrogateescape")
+
+  def call_mask(self, calls):
+    mask = 0
+    for bit, call in enumerate(self.calls):
+      if call in calls:
+        mask |= 1 << bit
+    return mask
+
+  def entries(self, skipMask=0):
+    # Yield (path, list of calls) for the entries with calls not in
+    # skipMask
+    calls = self.calls
+    for (pathId, mask) in zip(self.pathIds, self.masks):
+      mask &= ~skipMask
+      if mask:
+        yield (self.path(pathId),
+               [call for bit, call in enumerate(calls) if mask & (1 << bit)])
+
+def parse_args():
+  argparser = argparse.ArgumentParser()
+
+  argparser.add_argument("infile",
+    type=str,
+    help="The trace log file")
+
+  argparser.add_argument("outfile",
+    type=str,
+    help="The compacted trace file")
+
+  return argparser.parse_args()
+
+def main():
+  args = parse_args()
+  with open(args.infile, "r") as logFile:
+    (calls, masks) = compact(logFile)
+  write_compact(args.outfile, calls, masks)
+  print("Compacted " + args.infile + " to " + str(len(masks)) + " paths")
+
+if __name__ == "__main__":
+    main()
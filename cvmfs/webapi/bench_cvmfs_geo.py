@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+# Benchmark of the geo api under multiple threads, driving the wsgi
+#  application in-process with the synthetic geo database and fake DNS
+#  from loadtest_api.py.  Every request mix is run from a cold start and
+#  reports requests/s, median and 99th percentile latency, the number of
+#  DNS lookups and how long threads waited for the geo locks.
+#
+# Request mixes:
+#   plain  - proxies asking to sort a subset of the stratum 1s
+#   pxysep - the same with backup proxies after a +PXYSEP+ separator
+#   cdn    - requests coming through Cloudflare, trying "ip." names
+#   storm  - every request from a new, unknown name (cache-miss storm)
+#   mixed  - all of the above, interleaved
+#
+# Usage: bench_cvmfs_geo.py [-n requests] [-t threads] [-l dns latency]
+#          [-f dns failure rate] [mix ...]
+
+from __future__ import print_function
+
+import argparse
+import random
+import socket
+import sys
+import threading
+import time
+from concurrent import futures
+
+sys.path.append('.')
+sys.path.append('/usr/share/cvmfs-server/webapi')
+
+import cvmfs_geo
+import cvmfs_metrics
+import loadtest_api
+
+mixes = ['plain', 'pxysep', 'cdn', 'storm', 'mixed']
+
+# Give cvmfs_geo fresh timed locks, so their counters start at zero
+def instrument_locks():
+    locks = [cvmfs_metrics.TimedLock('namelock'),
+             cvmfs_metrics.TimedLock('addrlock'),
+             cvmfs_metrics.TimedLock('gilock'),
+             cvmfs_metrics.TimedLock('indexlock'),
+             cvmfs_metrics.TimedLock('responselock')]
+    cvmfs_geo.namelock = cvmfs_geo.geo_cache.lock = locks[0]
+    cvmfs_geo.addrlock = cvmfs_geo.addr_cache.lock = locks[1]
+    cvmfs_geo.gilock = locks[2]
+    cvmfs_geo.indexlock = locks[3]
+    cvmfs_geo.response_cache.lock = locks[4]
+    return locks
+
+# DNS stand-in that also fails a fraction of the lookups
+class FlakyDns(loadtest_api.FakeDns):
+    def __init__(self, latency, failures, seed=0):
+        loadtest_api.FakeDns.__init__(self, latency)
+        self.failures = failures
+        self.rnd = random.Random(seed)
+
+    def getaddrinfo(self, name, port, *args):
+        if self.rnd.random() < self.failures:
+            time.sleep(self.latency)
+            raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure')
+        return loadtest_api.FakeDns.getaddrinfo(self, name, port, *args)
+
+def random_addr(rnd):
+    return '10.%d.%d.%d' % (rnd.randrange(256), rnd.randrange(256),
+                            rnd.randrange(1, 255))
+
+# Generate environs for a request mix
+def make_requests(mix, count, seed=0):
+    rnd = random.Random(seed)
+    servers = ['s%d.example.org' % i for i in range(30)]
+    backups = ['backup%d.example.org' % i for i in range(5)]
+    proxies = ['proxy%d.example.org' % i for i in range(max(count // 50, 1))]
+    requests = []
+    for i in range(count):
+        kind = mix
+        if mix == 'mixed':
+            kind = rnd.choice(mixes[:-1])
+        serverlist = rnd.sample(servers, rnd.randint(4, 12))
+        environ = {'REQUEST_METHOD': 'GET', 'REMOTE_ADDR': random_addr(rnd)}
+        caching_string = rnd.choice(proxies)
+        if kind == 'pxysep':
+            serverlist += ['+PXYSEP+'] + rnd.sample(backups, 2)
+        elif kind == 'cdn':
+            environ['HTTP_CF_CONNECTING_IP'] = random_addr(rnd)
+        elif kind == 'storm':
+            caching_string = 'storm%d-%d.example.org' % (seed, i)
+            environ['HTTP_X_FORWARDED_FOR'] = \
+                random_addr(rnd) + ', ' + random_addr(rnd)
+        environ['PATH_INFO'] = '/repo/v1.0/geo/' + caching_string + '/' + \
+            ','.join(serverlist)
+        requests.append(environ)
+    return requests
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_mix(application, requests, threads):
+    latencies = []
+    statuses = {}
+    statuslock = threading.Lock()
+    def serve(environ):
+        def start_response(status, headers):
+            statuslock.acquire()
+            statuses[status] = statuses.get(status, 0) + 1
+            statuslock.release()
+        start = time.perf_counter()
+        b''.join(application(environ, start_response))
+        latencies.append(time.perf_counter() - start)
+    executor = futures.ThreadPoolExecutor(max_workers=threads)
+    start = time.perf_counter()
+    list(executor.map(serve, requests))
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    latencies.sort()
+    return elapsed, latencies, statuses
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the geo api')
+    parser.add_argument('-n', '--requests', type=int, default=5000)
+    parser.add_argument('-t', '--threads', type=int, default=64)
+    parser.add_argument('-l', '--latency', type=float, default=0.02,
+                        help='DNS latency in seconds')
+    parser.add_argument('-f', '--failures', type=float, default=0.0,
+                        help='fraction of DNS lookups that fail')
+    parser.add_argument('mix', nargs='*',
+                        help='request mixes to run, default all')
+    args = parser.parse_args()
+    for mix in args.mix:
+        if mix not in mixes:
+            parser.error('unknown mix ' + mix + ', choose from ' +
+                         ', '.join(mixes))
+
+    dns = FlakyDns(args.latency, args.failures)
+    socket.getaddrinfo = dns.getaddrinfo
+    application = loadtest_api.load_wsgi_application()
+
+    print('%-8s %9s %9s %9s %7s  %s' %
+          ('mix', 'req/s', 'p50 ms', 'p99 ms', 'DNS', 'lock waits ms'))
+    for mix in args.mix or mixes:
+        loadtest_api.reset_geo()
+        cvmfs_geo.resolver = cvmfs_geo.Resolver(cvmfs_geo.dns_workers)
+        locks = instrument_locks()
+        dns.lookups = 0
+        requests = make_requests(mix, args.requests)
+        elapsed, latencies, statuses = \
+            run_mix(application, requests, args.threads)
+        waits = ' '.join('%s=%.1f/%d' % (l.name, l.wait_secs * 1000,
+                                          l.contended)
+                         for l in locks if l.contended)
+        print('%-8s %9.0f %9.2f %9.2f %7d  %s' %
+              (mix, len(requests) / elapsed,
+               percentile(latencies, 0.5) * 1000,
+               percentile(latencies, 0.99) * 1000,
+               dns.lookups, waits or '-'))
+        bad = sum(n for status, n in statuses.items() if status != '200 OK')
+        if bad:
+            print('%-8s %d bad requests' % ('', bad))
+
+if __name__ == '__main__':
+    main()
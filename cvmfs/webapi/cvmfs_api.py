@@ -11,15 +11,19 @@ def bad_request(start_response, reason):
                    ('Content-Length', str(len(response_body)))])
     return [response_body.encode('utf-8')]
 
-def good_request(start_response, response_body):
+def good_request(start_response, response_body, max_age=positive_expire_secs):
     start_response('200 OK',
                   [('Content-Type', 'text/plain'),
-                   ('Cache-control', 'max-age=' + str(positive_expire_secs)),
+                   ('Cache-control', 'max-age=' + str(max_age)),
                    ('Content-Length', str(len(response_body)))])
     return [response_body.encode('utf-8')]
 
 def dispatch(api_func, path_info, repo_name, version, start_response, environ):
     if api_func == 'geo':
         return cvmfs_geo.api(path_info, repo_name, version, start_response, environ)
+    if api_func == 'geo-batch':
+        return cvmfs_geo.batch_api(path_info, repo_name, version, start_response, environ)
+    if api_func == 'metrics':
+        return cvmfs_geo.metrics_api(path_info, repo_name, version, start_response, environ)
 
     return bad_request(start_response, 'unrecognized api function')
@@ -0,0 +1,136 @@
+# ASGI entry point for the cvmfs web api, as an alternative to the
+#  mod_wsgi script cvmfs-api.wsgi.  Run it with any ASGI server, e.g.
+#    uvicorn --app-dir /usr/share/cvmfs-server/webapi cvmfs_asgi:application
+#
+# Requests are dispatched with the same cvmfs_api.dispatch as under
+#  wsgi.  For geo and geo-batch requests the names that are not cached
+#  yet are first resolved in the background while the event loop serves
+#  other requests.  Dispatching runs in the default thread pool, so a
+#  lookup that misses the prefetch blocks only that thread, not the loop.
+
+import asyncio
+import io
+import re
+import time
+
+import cvmfs_api
+import cvmfs_geo
+
+pattern = re.compile('^/([^/]*)/(v[^/]*)/([^/]*)/(.*)$')
+
+# when not mounted below /cvmfs/<repo_name>/api by a front end, accept
+#  the same URLs apache maps to the wsgi script
+alias_pattern = re.compile('^/cvmfs/([^/]+)/api(/.*)$')
+
+# Build a wsgi-style environ from an ASGI http scope and request body
+def make_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    alias = alias_pattern.search(environ['PATH_INFO'])
+    if alias:
+        environ['PATH_INFO'] = '/' + alias.group(1) + alias.group(2)
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE':
+            environ[key] = value
+        elif key != 'CONTENT_LENGTH':
+            key = 'HTTP_' + key
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+    return environ
+
+# no api takes more than a geo-batch
+max_body_bytes = cvmfs_geo.batch_max_bytes
+
+# return the request body, or None if it is longer than max_body_bytes
+async def read_body(receive):
+    chunks = []
+    length = 0
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunk = message.get('body', b'')
+        length += len(chunk)
+        if length > max_body_bytes:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+def too_large(start_response):
+    response_body = 'Request Entity Too Large\n'
+    start_response('413 Request Entity Too Large',
+                  [('Content-Length', str(len(response_body)))])
+    return [response_body.encode('utf-8')]
+
+async def send_response(send, response, body):
+    await send({'type': 'http.response.start',
+                'status': response['status'],
+                'headers': response['headers']})
+    await send({'type': 'http.response.body',
+                'body': b''.join(body)})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    response = {}
+    def start_response(status, headers):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'),
+                                value.encode('latin-1'))
+                               for name, value in headers]
+
+    request_body = await read_body(receive)
+    if request_body is None:
+        body = too_large(start_response)
+        return await send_response(send, response, body)
+
+    environ = make_environ(scope, request_body)
+    request_url  = environ['PATH_INFO']
+    match_result = pattern.search(request_url)
+
+    if not match_result:
+        body = cvmfs_api.bad_request(start_response, 'malformed api URL: ' + request_url)
+    else:
+        repo_name, version, api_func, path_info = match_result.groups()
+        pending = []
+        if api_func == 'geo':
+            pending = cvmfs_geo.prefetch_names(int(time.time()), path_info,
+                                               environ)
+        elif api_func == 'geo-batch':
+            entries = cvmfs_geo.parse_batch(request_body)
+            if entries is not None:
+                pending = cvmfs_geo.prefetch_batch(int(time.time()),
+                                                   entries, environ)
+        if pending:
+            await asyncio.wait([asyncio.wrap_future(f) for f in pending],
+                               timeout=cvmfs_geo.dns_timeout_secs)
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, cvmfs_api.dispatch,
+                                          api_func, path_info, repo_name,
+                                          version, start_response, environ)
+
+    await send_response(send, response, body)
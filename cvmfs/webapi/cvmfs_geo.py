@@ -3,11 +3,14 @@ from __future__ import print_function
 import math
 import os
 import re
-import bisect
 import socket
+from array import array
 import cvmfs_api
+import cvmfs_metrics
 import time
 import threading
+from collections import OrderedDict
+from concurrent import futures
 
 # Open the geodb.  Only import maxminddb here (and only once) because it
 #  is not available in the unit test.
@@ -19,57 +22,306 @@ def open_geodb(dbname):
     return maxminddb.open_database(dbname)
 
 gidb="/var/lib/cvmfs-server/geo/GeoLite2-City.mmdb"
-gireader=None
-oldgireader=None
-gichecktime=0
-gimodtime=0
+gidb_check_secs = 60
+gihandle=None
+giwatcher=None
 
 geo_cache_secs = 5*60   # 5 minutes
+geo_cache_negative_secs = 60    # names that could not be located
 
 geo_cache_max_entries = 100000  # a ridiculously large but manageable number
-namelookups = 0
+geo_cache_max_bytes = 64*1024*1024
+
+gilock = cvmfs_metrics.TimedLock('gilock')
+namelock = cvmfs_metrics.TimedLock('namelock')
+addrlock = cvmfs_metrics.TimedLock('addrlock')
+
+# Latency histograms for the metrics api
+dns_histogram = cvmfs_metrics.Histogram()
+mmdb_histogram = cvmfs_metrics.Histogram()
+# request stages: locating the client, sorting the servers on a
+#  response cache miss, and the whole request
+stage_histograms = {'client': cvmfs_metrics.Histogram(),
+                    'sort': cvmfs_metrics.Histogram(),
+                    'request': cvmfs_metrics.Histogram()}
+geodb_reloads = 0
+
+# LRU cache of geo records with separate expiry times for positive and
+#   negative (None) records, and a soft limit on the estimated memory use.
+#   Entries are indexed by name or address and contain a list of
+#   [update time, geo record, hits, creation time].
+# get() returns a tuple of (fresh, geo record).  When the entry has
+#   expired the stale record is returned, and the update time is bumped
+#   so only one thread needs to wait when a lookup is slow.  The caller
+#   then does the lookup and stores the result with put().
+# Least recently used entries are evicted first, so hot names like the
+#   stratum 1s survive a flood of random names.
+class GeoCache():
+    # rough size of an entry apart from its key, including the geo record
+    entry_bytes = 600
+
+    def __init__(self, lock, max_entries, max_bytes, positive_secs,
+                 negative_secs):
+        self.lock = lock
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.positive_secs = positive_secs
+        self.negative_secs = negative_secs
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, now, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return (False, None)
+            self.entries.move_to_end(key)
+            if entry[1] is None:
+                secs = self.negative_secs
+            else:
+                secs = self.positive_secs
+            if now <= entry[0] + secs:
+                entry[2] += 1
+                self.hits += 1
+                return (True, entry[1])
+            entry[0] = now
+            self.misses += 1
+            self.expirations += 1
+            return (False, entry[1])
+        finally:
+            self.lock.release()
 
-# geo_cache entries are indexed by name and contain a tuple of
-# (update time, geo record).  Caching DNS lookups is more important
-# than caching geo information but it's simpler and slightly more
-# efficient to cache the geo information.
-geo_cache = {}
+    def put(self, now, key, gir):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [now, gir, 0, now]
+                self.bytes += len(key) + self.entry_bytes
+            else:
+                entry[0] = now
+                entry[1] = gir
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries or \
+                    (self.bytes > self.max_bytes and len(self.entries) > 1):
+                oldkey, oldentry = self.entries.popitem(last=False)
+                self.bytes -= len(oldkey) + self.entry_bytes
+                self.evictions += 1
+        finally:
+            self.lock.release()
 
-gilock = threading.Lock()
-namelock = threading.Lock()
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
 
-# look up geo info for an address
-# Also periodically check for an update to the database and
-#   reopen it if it changed
-def lookup_geoinfo(now, addr):
-    global gireader, oldgireader
-    global gichecktime
-    global gimodtime
+    # return a dict of statistics about one entry, or None if not cached
+    def entry_stats(self, now, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            return {'hits': entry[2],
+                    'age': now - entry[3],
+                    'updated': entry[0],
+                    'negative': entry[1] is None}
+        finally:
+            self.lock.release()
+
+# Caching DNS lookups is more important than caching geo information
+#   but it's simpler and slightly more efficient to cache the geo
+#   information.  Addresses are cached separately, and that cache is
+#   cleared whenever the database is reopened.
+geo_cache = GeoCache(namelock, geo_cache_max_entries, geo_cache_max_bytes,
+                     geo_cache_secs, geo_cache_negative_secs)
+addr_cache = GeoCache(addrlock, geo_cache_max_entries, geo_cache_max_bytes,
+                      geo_cache_secs, geo_cache_negative_secs)
+
+# Bounded LRU cache of complete api responses.  Many clients behind the
+#   same proxy send identical requests, so responses are keyed by the
+#   client location rounded to a grid cell of response_cache_grid
+#   degrees, together with the server list (which includes any
+#   +PXYSEP+ separator) and whether CDN names were tried.
+#   The cache has to be cleared whenever the server or client locations
+#   may have changed, that is when the geo database is reopened or the
+#   server index is refreshed.
+class ResponseCache():
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = cvmfs_metrics.TimedLock('responselock')
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return body
+        finally:
+            self.lock.release()
+
+    def put(self, key, body):
+        self.lock.acquire()
+        try:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+response_cache_grid = 0.01      # degrees, roughly 1km
+response_cache = ResponseCache(10000)
+
+def response_cache_key(gir_rem, serverlist, trycdn):
+    return (int(round(gir_rem['latitude'] / response_cache_grid)),
+            int(round(gir_rem['longitude'] / response_cache_grid)),
+            serverlist, trycdn)
+
+# An opened geodb together with the modification time of its file.
+#   The current handle is published in gihandle by replacing the
+#   reference, so lookups never need to take a lock to find it.  Users
+#   count themselves in and out, and a handle that has been replaced
+#   is closed as soon as the last user is done with it.
+class GeoDbHandle():
+    def __init__(self, reader, modtime):
+        self.reader = reader
+        self.modtime = modtime
+        self.lock = threading.Lock()
+        self.users = 0
+        self.retired = False
+        self.closed = False
+
+    # return False if the handle is already closed
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return False
+            self.users += 1
+            return True
+        finally:
+            self.lock.release()
 
-    if gireader is None or now > gichecktime + geo_cache_secs:
-        gilock.acquire()
+    def release(self):
+        self.lock.acquire()
         try:
-            # gichecktime might have changed before acquiring the lock, look again
-            if gireader is None or now > gichecktime + geo_cache_secs:
-                if oldgireader is not None:
-                    # By now we're sure nobody is still using the previous
-                    #  gireader, so close it.  This delay avoids having to
-                    #  acquire the lock for every lookup.
-                    oldgireader.close()
-                    oldgireader = None
-                    print('cvmfs_geo: closed old ' + gidb)
-                gichecktime = now
-                modtime = os.stat(gidb).st_mtime
-                if modtime != gimodtime:
-                    # database was modified, reopen it
-                    oldgireader = gireader
-                    gireader = open_geodb(gidb)
-                    gimodtime = modtime
-                    print('cvmfs_geo: opened ' + gidb)
+            self.users -= 1
+            self.close_if_unused()
         finally:
-            gilock.release()
+            self.lock.release()
+
+    def retire(self):
+        self.lock.acquire()
+        try:
+            self.retired = True
+            self.close_if_unused()
+        finally:
+            self.lock.release()
+
+    def close_if_unused(self):
+        if self.retired and self.users == 0 and not self.closed:
+            self.closed = True
+            self.reader.close()
+            print('cvmfs_geo: closed old ' + gidb)
+
+# Make reader the current geodb and retire the previous one
+def publish_geodb(reader, modtime):
+    global gihandle, geodb_reloads
+    oldhandle = gihandle
+    gihandle = GeoDbHandle(reader, modtime)
+    geodb_reloads += 1
+    addr_cache.clear()
+    response_cache.clear()
+    if oldhandle is not None:
+        oldhandle.retire()
+
+# Reopen the geodb if its file was modified
+def reload_geodb():
+    modtime = os.stat(gidb).st_mtime
+    if gihandle is not None and modtime == gihandle.modtime:
+        return
+    publish_geodb(open_geodb(gidb), modtime)
+    print('cvmfs_geo: opened ' + gidb)
+
+# Background thread checking for an update to the database every
+#   gidb_check_secs, so request threads never have to
+def watch_geodb():
+    while True:
+        time.sleep(gidb_check_secs)
+        try:
+            reload_geodb()
+        except Exception as e:
+            print('cvmfs_geo: failed to reload ' + gidb + ': ' + str(e))
 
-    return gireader.get(addr)
+# Modification time of the current geodb, 0 if not opened yet
+def geodb_modtime():
+    handle = gihandle
+    if handle is None:
+        return 0
+    return handle.modtime
+
+# look up geo info for an address
+# The first lookup opens the database and starts the watcher thread.
+def lookup_geoinfo(now, addr):
+    global giwatcher
+
+    while True:
+        handle = gihandle
+        if handle is None:
+            gilock.acquire()
+            try:
+                # another thread might have opened it already, look again
+                if gihandle is None:
+                    reload_geodb()
+                if giwatcher is None:
+                    giwatcher = threading.Thread(target=watch_geodb)
+                    giwatcher.daemon = True
+                    giwatcher.start()
+            finally:
+                gilock.release()
+            continue
+        # the handle might have been replaced and closed in between
+        if handle.acquire():
+            break
+
+    start = time.time()
+    try:
+        return handle.reader.get(addr)
+    finally:
+        handle.release()
+        mmdb_histogram.observe(time.time() - start)
 
 # function came from http://www.johndcook.com/python_longitude_latitude.html
 def distance_on_unit_sphere(lat1, long1, lat2, long2):
@@ -118,45 +370,31 @@ def addr_geoinfo(now, addr):
     if (len(addr) > 256) or not addr_pattern.search(addr):
         return None
 
+    fresh, gir = addr_cache.get(now, addr)
+    if fresh:
+        return gir
+
     response = lookup_geoinfo(now, addr)
     if response == None:
-        return None
+        gir = None
+    else:
+        gir = response['location']
 
-    return response['location']
+    addr_cache.put(now, addr, gir)
+    return gir
 
-# Look up geo info by name.  Try IPv4 first since that DB is
-# better and most servers today are dual stack if they have IPv6.
-# Store results in a cache.  Wsgi is multithreaded so need to lock
-# accesses to the shared cache.
+# Resolve a name and look up geo info for its address, without caching.
+# Try IPv4 first since that DB is better and most servers today are
+# dual stack if they have IPv6.
 # Return geo info record or None if none found.
-def name_geoinfo(now, name):
-    global geo_cache
-    if (len(name) > 256) or not addr_pattern.search(name):
-        return None
-
-    global namelookups
-    namelock.acquire()
-    if name in geo_cache:
-        (stamp, gir) = geo_cache[name]
-        if now <= stamp + geo_cache_secs:
-            # still good, use it
-            namelock.release()
-            return gir
-        # update the timestamp so only one thread needs to wait
-        #  when a lookup is slow
-        geo_cache[name] = (now, gir)
-    elif len(geo_cache) >= geo_cache_max_entries:
-        # avoid denial of service by removing one arbitrary entry
-        #   before we add one
-        geo_cache.popitem()
-    namelookups += 1
-    namelock.release()
-
+def resolve_geoinfo(now, name):
     ai = ()
+    start = time.time()
     try:
         ai = socket.getaddrinfo(name,80,0,0,socket.IPPROTO_TCP)
     except:
         pass
+    dns_histogram.observe(time.time() - start)
     gir = None
     for info in ai:
         # look for IPv4 address first
@@ -174,16 +412,298 @@ def name_geoinfo(now, name):
             gir = gir['location']
         else:
             gir = None
+    return gir
 
-    namelock.acquire()
-    if gir == None and name in geo_cache:
-        # reuse expired entry
-        gir = geo_cache[name][1]
+# Resolve names in a small pool of worker threads so that a slow DNS
+#   server cannot stall the wsgi threads for longer than
+#   dns_timeout_secs.  Concurrent lookups of the same name are merged
+#   into one (single flight), and the result is stored in geo_cache.
+#   The pool is only started on first use.  At most dns_max_pending
+#   lookups are queued or running; names beyond that are answered as
+#   unknown, so clients sending random names cannot grow the queue.
+#   Server index refreshes resolve directly and never wait in it.
+dns_workers = 8
+dns_timeout_secs = 5
+dns_max_pending = 256
+namelookups = 0     # number of names resolved, for the _namelookups_ api
+
+class Resolver():
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.refused = 0
+
+    # return a future for the geo record of name, starting a lookup
+    #   if there isn't one already in flight, or None if too many
+    #   lookups are pending.  oldgir is the expired record to keep if
+    #   the name can no longer be resolved.
+    def submit(self, now, name, oldgir):
+        global namelookups
+        self.lock.acquire()
+        try:
+            future = self.inflight.get(name)
+            if future is None:
+                if len(self.inflight) >= self.max_pending:
+                    self.refused += 1
+                    return None
+                namelookups += 1
+                if self.executor is None:
+                    self.executor = \
+                        futures.ThreadPoolExecutor(max_workers=self.workers)
+                future = self.executor.submit(self.resolve, now, name, oldgir)
+                self.inflight[name] = future
+            return future
+        finally:
+            self.lock.release()
 
-    geo_cache[name] = (now, gir)
-    namelock.release()
+    def resolve(self, now, name, oldgir):
+        try:
+            gir = resolve_geoinfo(now, name)
+            if gir == None:
+                # reuse expired entry
+                gir = oldgir
+            geo_cache.put(now, name, gir)
+            return gir
+        finally:
+            self.lock.acquire()
+            del self.inflight[name]
+            self.lock.release()
+
+resolver = Resolver(dns_workers, dns_max_pending)
+
+# Requests that look up many names at once, like geo-batch, give all of
+#   their lookups in a thread one deadline.  After it, names that are not
+#   resolved yet are answered as unknown instead of waited for again.
+lookup_deadline = threading.local()
+
+# return how long a lookup in this thread may still wait for the resolver
+def lookup_timeout():
+    deadline = getattr(lookup_deadline, 'time', None)
+    if deadline is None:
+        return dns_timeout_secs
+    return max(0, min(dns_timeout_secs, deadline - time.time()))
+
+# Lookups given up on before they completed, counted per thread.  A
+#   response sorted while any of its names timed out may be in the wrong
+#   order, so it is neither memoized nor cached long downstream.
+lookup_timeouts = threading.local()
+partial_expire_secs = 10
+
+def lookup_timeout_count():
+    return getattr(lookup_timeouts, 'count', 0)
+
+# Look up geo info by name.
+# Store results in a cache.  Wsgi is multithreaded so the cache locks
+# accesses itself.  An expired record is served while it is refreshed
+# in the background.
+# Return geo info record or None if none found.
+def name_geoinfo(now, name):
+    if (len(name) > 256) or not addr_pattern.search(name):
+        return None
 
-    return gir
+    fresh, oldgir = geo_cache.get(now, name)
+    if fresh:
+        return oldgir
+
+    future = resolver.submit(now, name, oldgir)
+    if oldgir is not None:
+        return oldgir
+    if future is None:
+        # not looked up at all, so no better than a lookup timing out
+        lookup_timeouts.count = lookup_timeout_count() + 1
+        return None
+
+    try:
+        return future.result(timeout=lookup_timeout())
+    except futures.TimeoutError:
+        # the lookup continues and will fill the cache when it completes
+        lookup_timeouts.count = lookup_timeout_count() + 1
+        return None
+
+# Convert a geo record to a point on the unit sphere, as a tuple of
+#   (x, y, z).  Points are memoized by (latitude, longitude) since the
+#   number of distinct server locations is small.  The memo is only ever
+#   replaced as a whole, so readers need no lock.
+unit_vectors = {}
+
+def geo_unit_vector(gir):
+    global unit_vectors
+    key = (gir['latitude'], gir['longitude'])
+    vec = unit_vectors.get(key)
+    if vec is None:
+        degrees_to_radians = math.pi/180.0
+        phi = (90.0 - key[0])*degrees_to_radians
+        theta = key[1]*degrees_to_radians
+        vec = (math.sin(phi)*math.cos(theta),
+               math.sin(phi)*math.sin(theta),
+               math.cos(phi))
+        if len(unit_vectors) >= geo_cache_max_entries:
+            unit_vectors = {}
+        unit_vectors[key] = vec
+    return vec
+
+# The server index maps server names, including the "ip."-prefixed
+#   CDN names, to a tuple of (geo record, unit vector).  Only names that
+#   could be located are indexed.  It is only ever replaced as a whole
+#   (copy on write under indexlock), so the request path reads it
+#   without taking any lock.  The set of servers is small and rarely
+#   changes, so the whole index is re-resolved in a background thread
+#   when geo_cache_secs have passed or the geo database was reopened.
+#   When it is full, the least recently used name makes room for a new
+#   one; server_index_used holds the time of last use of each name.
+server_index = {}
+server_index_used = {}
+server_index_time = 0
+server_index_modtime = 0
+server_index_refreshing = False
+server_index_max_entries = 1000
+
+indexlock = cvmfs_metrics.TimedLock('indexlock')
+
+# Resolve one server name into a server index entry.
+# If the name can no longer be located, keep the previous entry.
+def make_server_entry(now, name, oldentry):
+    gir = None
+    if (len(name) <= 256) and addr_pattern.search(name):
+        gir = resolve_geoinfo(now, name)
+    if gir is None:
+        return oldentry
+    return (gir, geo_unit_vector(gir))
+
+# Re-resolve all names in the server index and publish the result.
+def refresh_server_index(now):
+    global server_index, server_index_time, server_index_modtime
+    global server_index_refreshing
+    try:
+        modtime = geodb_modtime()
+        oldindex = server_index
+        newentries = {}
+        for name in oldindex:
+            newentries[name] = make_server_entry(now, name, oldindex[name])
+        indexlock.acquire()
+        try:
+            # keep names that were added while refreshing, and don't
+            #  bring back the ones evicted meanwhile
+            newindex = dict(server_index)
+            for name in newentries:
+                if name in newindex:
+                    newindex[name] = newentries[name]
+            server_index = newindex
+            server_index_time = now
+            server_index_modtime = modtime
+        finally:
+            indexlock.release()
+        response_cache.clear()
+    finally:
+        server_index_refreshing = False
+
+# Start a background refresh of the server index if it is out of date.
+def check_server_index(now):
+    global server_index_refreshing
+    if now <= server_index_time + geo_cache_secs and \
+            geodb_modtime() == server_index_modtime:
+        return
+    indexlock.acquire()
+    try:
+        if server_index_refreshing:
+            return
+        server_index_refreshing = True
+    finally:
+        indexlock.release()
+    thread = threading.Thread(target=refresh_server_index, args=(now,))
+    thread.daemon = True
+    thread.start()
+
+# Look up a server in the server index, adding it on first use if it
+#   can be located.
+# Return a tuple of (geo record, unit vector) or None if not located.
+def server_geoinfo(now, name):
+    global server_index, server_index_used
+    try:
+        entry = server_index[name]
+        server_index_used[name] = now
+        return entry
+    except KeyError:
+        pass
+
+    gir = name_geoinfo(now, name)
+    if gir is None:
+        # unknown names stay in geo_cache only, so that arbitrary names
+        #  from requests don't take up the index
+        return None
+    entry = (gir, geo_unit_vector(gir))
+
+    indexlock.acquire()
+    try:
+        if name not in server_index:
+            newindex = dict(server_index)
+            used = server_index_used
+            if len(newindex) >= server_index_max_entries:
+                oldest = min(newindex, key=lambda n: used.get(n, 0))
+                del newindex[oldest]
+                used = dict((n, used.get(n, 0)) for n in newindex)
+            newindex[name] = entry
+            used[name] = now
+            server_index = newindex
+            server_index_used = used
+    finally:
+        indexlock.release()
+    return entry
+
+# Rank packed unit vectors by their distance to gir_rem in one pass.
+#   vectors is an array of 3*N doubles, with None entries in located
+#   marking servers that could not be found; those sort to the end.
+# return list of indexes from geographically closest to furthest away.
+#   Ties keep their original order, the same as the old bisect-based
+#   insertion did.  Servers whose cosines are too close to tell apart
+#   through rounding are ordered by distance_on_unit_sphere itself, so
+#   the order is always the same as sorting by that.
+geosort_tie_epsilon = 1e-12
+
+def geosort_vectors(gir_rem, vectors, located):
+    rx, ry, rz = geo_unit_vector(gir_rem)
+    remkey = (gir_rem['latitude'], gir_rem['longitude'])
+    keys = []
+    j = 0
+    for loc in located:
+        if loc is None:
+            keys.append(float("inf"))
+        elif loc == remkey:
+            # same as distance_on_unit_sphere, identical points are
+            #  exactly 0 apart regardless of rounding
+            keys.append(-1.0)
+        else:
+            # acos is monotonically decreasing, so ordering by the
+            #  negated cosine gives the same order as the arc length
+            cos = rx*vectors[j] + ry*vectors[j+1] + rz*vectors[j+2]
+            keys.append(-min(cos, 1.0))
+        j += 3
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+
+    # re-rank runs of near-ties by the exact arc length
+    first = 0
+    while first < len(order):
+        last = first + 1
+        while last < len(order) and \
+                keys[order[last]] - keys[order[last-1]] < geosort_tie_epsilon:
+            last += 1
+        if last - first > 1:
+            arcs = {}
+            for i in order[first:last]:
+                try:
+                    arcs[i] = distance_on_unit_sphere(remkey[0], remkey[1],
+                                                      located[i][0],
+                                                      located[i][1])
+                except ValueError:
+                    # rounding put the cosine just above 1
+                    arcs[i] = 0.0
+            order[first:last] = sorted(order[first:last],
+                                       key=lambda i: (arcs[i], i))
+        first = last
+    return order
 
 # geo-sort list of servers relative to gir_rem
 #   If trycdn is True, first try prepending "ip." to the name to get the
@@ -195,39 +715,86 @@ def name_geoinfo(now, name):
 #    servers numbered 0 to N-1 from geographically closest to furthest
 #    away compared to gir_rem
 def geosort_servers(now, gir_rem, servers, trycdn=False):
-    idx = 0
-    arcs = []
-    indexes = []
+    vectors = array('d')
+    located = []
 
     onegood = False
     for server in servers:
-        gir_server = None
+        entry = None
         if trycdn:
-            gir_server = name_geoinfo(now, "ip." + server)
-        if gir_server is None:
-            gir_server = name_geoinfo(now, server)
-
-        if gir_server is None:
-            # put it on the end of the list
-            arc = float("inf")
+            entry = server_geoinfo(now, "ip." + server)
+        if entry is None:
+            entry = server_geoinfo(now, server)
+
+        if entry is None:
+            # will be put on the end of the list
+            located.append(None)
+            vectors.extend((0.0, 0.0, 0.0))
         else:
             onegood = True
-            arc = distance_on_unit_sphere(gir_rem['latitude'],
-                                          gir_rem['longitude'],
-                                          gir_server['latitude'],
-                                          gir_server['longitude'])
-            #print("distance between " + \
-            #    str(gir_rem['latitude']) + ',' + str(gir_rem['longitude']) \
-            #    + " and " + \
-            #    server + ' (' + str(gir_server['latitude']) + ',' + str(gir_server['longitude']) + ')' + \
-            #    " is " + str(arc))
-
-        i = bisect.bisect(arcs, arc)
-        arcs[i:i] = [arc]
-        indexes[i:i] = [idx]
-        idx += 1
-
-    return [onegood, indexes]
+            gir_server, vec = entry
+            located.append((gir_server['latitude'], gir_server['longitude']))
+            vectors.extend(vec)
+
+    return [onegood, geosort_vectors(gir_rem, vectors, located)]
+
+# Start lookups of the names in a geo api request that have not been
+#   looked up yet, and return their futures.  An event loop can wait for
+#   these without blocking, after which api() only hits the caches.
+#   Names with an expired record are not included since name_geoinfo
+#   serves those without waiting.
+def prefetch_names(now, path_info, environ):
+    slash = path_info.find('/')
+    if (slash == -1):
+        return []
+    names = [path_info[0:slash]]
+    for server in path_info[slash+1:].split(','):
+        if server == '+PXYSEP+':
+            continue
+        if 'HTTP_CF_CONNECTING_IP' in environ:
+            names.append("ip." + server)
+        names.append(server)
+
+    pending = []
+    for name in names:
+        if (len(name) > 256) or not addr_pattern.search(name):
+            continue
+        if name in server_index or name in geo_cache:
+            continue
+        future = resolver.submit(now, name, None)
+        if future is not None:
+            pending.append(future)
+    return pending
+
+# geo-sort the servers of an api request relative to gir_rem
+# return the response body, or None if none of the servers were found
+def geosort_response(now, gir_rem, servers, trycdn):
+    if '+PXYSEP+' in servers:
+        # first geosort the proxies after the separator and if at least one
+        # is good, sort the hosts before the separator relative to that
+        # proxy rather than the client
+        pxysep = servers.index('+PXYSEP+')
+        # assume backup proxies will not be behind a CDN
+        onegood, pxyindexes = \
+            geosort_servers(now, gir_rem, servers[pxysep+1:], False)
+        if onegood:
+            entry = server_geoinfo(now, servers[pxysep+1+pxyindexes[0]])
+            if not entry is None:
+                gir_rem = entry[0]
+        onegood, hostindexes = \
+            geosort_servers(now, gir_rem, servers[0:pxysep], trycdn)
+        indexes = hostindexes + list(pxysep+1+i for i in pxyindexes)
+        # Append the index of the separator for backward compatibility,
+        # so the client can always expect the same number of indexes as
+        # the number of elements in the request.
+        indexes.append(pxysep)
+    else:
+        onegood, indexes = geosort_servers(now, gir_rem, servers, trycdn)
+
+    if not onegood:
+        return None
+
+    return ','.join(str(i+1) for i in indexes) + '\n'
 
 # expected geo api URL:  /cvmfs/<repo_name>/api/v<version>/geo/<path_info>
 #   <repo_name> is repository name
@@ -246,21 +813,14 @@ def geosort_servers(now, gir_rem, servers, trycdn=False):
 #    away from the requester that initiated the connection (the requester
 #    is typically the proxy)
 
-def api(path_info, repo_name, version, start_response, environ):
-
-    slash = path_info.find('/')
-    if (slash == -1):
-        return cvmfs_api.bad_request(start_response, 'no slash in geo path')
-
-    caching_string = path_info[0:slash]
-    servers = path_info[slash+1:].split(',')
-
-    if caching_string == "_namelookups_":
-        # this is a special debugging URL
-        return cvmfs_api.good_request(start_response, str(namelookups) + '\n')
-
-    # TODO(jblomer): Can this be switched to monotonic time?
-    now = int(time.time())
+# Sort the servers of one geo request relative to the client, which is
+#   caching_string if it can be located or else the requester.
+# return a tuple of (response body, None) if successful or else
+#   (None, reason for a bad request)
+def geo_request(now, caching_string, serverlist, environ):
+    servers = serverlist.split(',')
+    client_start = time.time()
+    timeouts = lookup_timeout_count()
 
     trycdn = False
     if 'HTTP_CF_CONNECTING_IP' in environ:
@@ -290,36 +850,173 @@ def api(path_info, repo_name, version, start_response, environ):
             # IP address connecting to web server
             gir_rem = addr_geoinfo(now, environ['REMOTE_ADDR'])
 
+    stage_histograms['client'].observe(time.time() - client_start)
     if gir_rem is None:
-        return cvmfs_api.bad_request(start_response, 'remote addr not found in database')
+        return (None, 'remote addr not found in database')
+
+    key = response_cache_key(gir_rem, serverlist, trycdn)
+    response_body = response_cache.get(key)
+    if response_body is None:
+        start = time.time()
+        response_body = geosort_response(now, gir_rem, servers, trycdn)
+        stage_histograms['sort'].observe(time.time() - start)
+        if response_body is None:
+            # return a bad request only if all the server names were bad
+            return (None, 'no server addr found in database')
+        if lookup_timeout_count() == timeouts:
+            response_cache.put(key, response_body)
+
+    return (response_body, None)
 
-    if '+PXYSEP+' in servers:
-        # first geosort the proxies after the separator and if at least one
-        # is good, sort the hosts before the separator relative to that
-        # proxy rather than the client
-        pxysep = servers.index('+PXYSEP+')
-        # assume backup proxies will not be behind a CDN
-        onegood, pxyindexes = \
-            geosort_servers(now, gir_rem, servers[pxysep+1:], False)
-        if onegood:
-            gir_pxy = name_geoinfo(now, servers[pxysep+1+pxyindexes[0]])
-            if not gir_pxy is None:
-                gir_rem = gir_pxy
-        onegood, hostindexes = \
-            geosort_servers(now, gir_rem, servers[0:pxysep], trycdn)
-        indexes = hostindexes + list(pxysep+1+i for i in pxyindexes)
-        # Append the index of the separator for backward compatibility,
-        # so the client can always expect the same number of indexes as
-        # the number of elements in the request.
-        indexes.append(pxysep)
-    else:
-        onegood, indexes = geosort_servers(now, gir_rem, servers, trycdn)
+def api(path_info, repo_name, version, start_response, environ):
 
-    if not onegood:
-        # return a bad request only if all the server names were bad
-        return cvmfs_api.bad_request(start_response, 'no server addr found in database')
+    slash = path_info.find('/')
+    if (slash == -1):
+        return cvmfs_api.bad_request(start_response, 'no slash in geo path')
+
+    caching_string = path_info[0:slash]
+
+    if caching_string == "_namelookups_":
+        # this is a special debugging URL
+        return cvmfs_api.good_request(start_response, str(namelookups) + '\n')
 
-    response_body = ','.join(str(i+1) for i in indexes) + '\n'
+    # TODO(jblomer): Can this be switched to monotonic time?
+    now = int(time.time())
+
+    # refreshing the server index also clears the response cache
+    check_server_index(now)
 
+    start = time.time()
+    timeouts = lookup_timeout_count()
+    response_body, reason = \
+        geo_request(now, caching_string, path_info[slash+1:], environ)
+    stage_histograms['request'].observe(time.time() - start)
+    if response_body is None:
+        return cvmfs_api.bad_request(start_response, reason)
+
+    if lookup_timeout_count() != timeouts:
+        return cvmfs_api.good_request(start_response, response_body,
+                                      partial_expire_secs)
     return cvmfs_api.good_request(start_response, response_body)
 
+# expected geo-batch api URL:  /cvmfs/<repo_name>/api/v<version>/geo-batch/
+#   The body of the POST request has one line per geo request in the same
+#   form as the geo api <path_info>, that is <caching_string>/<serverlist>.
+# response: one line per non-empty line of the request, with the same
+#    comma-separated list of numbers the geo api would return, or an
+#    empty line if that request would have been a bad request.
+#   All entries are looked up and sorted together, so names are resolved
+#    concurrently and entries for the same client location and server
+#    list are only sorted once.  All lookups of a batch share one
+#    deadline of dns_timeout_secs, names not resolved by then count as
+#    unknown.
+batch_max_bytes = 256*1024
+batch_max_entries = 500
+
+# return the list of geo requests in a batch body, or None if too large
+def parse_batch(body):
+    if len(body) > batch_max_bytes:
+        return None
+    entries = []
+    for line in body.decode('utf-8', 'replace').splitlines():
+        line = line.strip()
+        if line:
+            entries.append(line)
+    if len(entries) > batch_max_entries:
+        return None
+    return entries
+
+# Start lookups of the names in all batch entries not looked up yet
+def prefetch_batch(now, entries, environ):
+    pending = []
+    for entry in entries:
+        pending.extend(prefetch_names(now, entry, environ))
+    return pending
+
+def batch_api(path_info, repo_name, version, start_response, environ):
+    if environ.get('REQUEST_METHOD') != 'POST':
+        return cvmfs_api.bad_request(start_response, 'geo-batch requires POST')
+
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = -1
+    if length < 0 or length > batch_max_bytes:
+        return cvmfs_api.bad_request(start_response, 'bad geo-batch length')
+    entries = parse_batch(environ['wsgi.input'].read(length))
+    if entries is None:
+        return cvmfs_api.bad_request(start_response, 'too many geo-batch entries')
+
+    deadline = time.time() + dns_timeout_secs
+    now = int(time.time())
+    check_server_index(now)
+
+    pending = prefetch_batch(now, entries, environ)
+    if pending:
+        futures.wait(pending, timeout=dns_timeout_secs)
+
+    lines = []
+    timeouts = lookup_timeout_count()
+    lookup_deadline.time = deadline
+    try:
+        for entry in entries:
+            slash = entry.find('/')
+            response_body = None
+            if slash != -1:
+                response_body, reason = \
+                    geo_request(now, entry[0:slash], entry[slash+1:], environ)
+            if response_body is None:
+                response_body = '\n'
+            lines.append(response_body)
+    finally:
+        lookup_deadline.time = None
+
+    if lookup_timeout_count() != timeouts:
+        return cvmfs_api.good_request(start_response, ''.join(lines),
+                                      partial_expire_secs)
+    return cvmfs_api.good_request(start_response, ''.join(lines))
+
+# expected metrics api URL:  /cvmfs/<repo_name>/api/v<version>/metrics/
+# response: the geo api metrics in the Prometheus text format
+def metrics_api(path_info, repo_name, version, start_response, environ):
+    out = cvmfs_metrics.Exposition()
+    caches = (('name', geo_cache), ('addr', addr_cache),
+              ('response', response_cache))
+    for name, help, attr in \
+            (('cvmfs_geo_cache_hits_total', 'Cache hits', 'hits'),
+             ('cvmfs_geo_cache_misses_total', 'Cache misses', 'misses'),
+             ('cvmfs_geo_cache_evictions_total', 'Cache evictions',
+              'evictions')):
+        for label, cache in caches:
+            out.counter(name, help, getattr(cache, attr), (('cache', label),))
+    for label, cache in caches:
+        out.gauge('cvmfs_geo_cache_entries', 'Cache entries',
+                  len(cache.entries), (('cache', label),))
+    out.gauge('cvmfs_geo_server_index_entries', 'Server index entries',
+              len(server_index))
+
+    out.histogram('cvmfs_geo_dns_lookup_seconds', 'DNS lookup latency',
+                  dns_histogram)
+    out.counter('cvmfs_geo_dns_lookups_refused_total',
+                'Name lookups refused because too many were pending',
+                resolver.refused)
+    out.histogram('cvmfs_geo_mmdb_lookup_seconds', 'Geo database lookup latency',
+                  mmdb_histogram)
+    out.counter('cvmfs_geo_mmdb_reloads_total', 'Geo database (re)loads',
+                geodb_reloads)
+    for stage in sorted(stage_histograms):
+        out.histogram('cvmfs_geo_request_stage_seconds',
+                      'Time spent per request stage',
+                      stage_histograms[stage], (('stage', stage),))
+
+    locks = (namelock, gilock, addrlock, indexlock, response_cache.lock)
+    for lock in locks:
+        out.counter('cvmfs_geo_lock_wait_seconds_total',
+                    'Time spent waiting for locks', lock.wait_secs,
+                    (('lock', lock.name),))
+    for lock in locks:
+        out.counter('cvmfs_geo_lock_contended_total',
+                    'Lock acquisitions that had to wait', lock.contended,
+                    (('lock', lock.name),))
+
+    return cvmfs_api.good_request(start_response, out.render(), 0)
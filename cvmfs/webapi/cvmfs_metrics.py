@@ -0,0 +1,113 @@
+# Instruments for the cvmfs web api metrics, and their rendering in the
+#  Prometheus text exposition format.
+
+import threading
+import time
+
+# Lock that counts how often and how long threads had to wait for it.
+#  Uncontended acquisitions are not timed.  The counters are updated
+#  while holding the lock.
+class TimedLock():
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_secs = 0.0
+
+    def acquire(self):
+        if self.lock.acquire(False):
+            self.acquisitions += 1
+            return True
+        start = time.time()
+        self.lock.acquire()
+        self.acquisitions += 1
+        self.contended += 1
+        self.wait_secs += time.time() - start
+        return True
+
+    def release(self):
+        self.lock.release()
+
+# Histogram of durations in seconds with cumulative buckets
+class Histogram():
+    default_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+                       0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, secs):
+        self.lock.acquire()
+        try:
+            for i in range(len(self.buckets)):
+                if secs <= self.buckets[i]:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += secs
+        finally:
+            self.lock.release()
+
+    # return a tuple of (cumulative counts per bucket, count, sum)
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            cumulative = []
+            total = 0
+            for n in self.counts:
+                total += n
+                cumulative.append(total)
+            return (cumulative, self.count, self.sum)
+        finally:
+            self.lock.release()
+
+# Format a label set like {cache="name"}
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, v) for k, v in labels) + '}'
+
+# Collects lines of the exposition format, one metric family at a time
+class Exposition():
+    def __init__(self):
+        self.lines = []
+        self.declared = set()
+
+    def declare(self, name, kind, help):
+        if name in self.declared:
+            return
+        self.declared.add(name)
+        self.lines.append('# HELP ' + name + ' ' + help)
+        self.lines.append('# TYPE ' + name + ' ' + kind)
+
+    def counter(self, name, help, value, labels=()):
+        self.declare(name, 'counter', help)
+        self.lines.append(name + format_labels(labels) + ' ' + repr(value))
+
+    def gauge(self, name, help, value, labels=()):
+        self.declare(name, 'gauge', help)
+        self.lines.append(name + format_labels(labels) + ' ' + repr(value))
+
+    def histogram(self, name, help, histogram, labels=()):
+        self.declare(name, 'histogram', help)
+        cumulative, count, total = histogram.snapshot()
+        labels = tuple(labels)
+        for le, n in zip(histogram.buckets, cumulative):
+            self.lines.append(name + '_bucket' +
+                              format_labels(labels + (('le', repr(le)),)) +
+                              ' ' + str(n))
+        self.lines.append(name + '_bucket' +
+                          format_labels(labels + (('le', '+Inf'),)) +
+                          ' ' + str(count))
+        self.lines.append(name + '_sum' + format_labels(labels) +
+                          ' ' + repr(total))
+        self.lines.append(name + '_count' + format_labels(labels) +
+                          ' ' + str(count))
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
@@ -0,0 +1,155 @@
+#! /usr/bin/env python3
+
+# Local load test comparing the wsgi and asgi modes of the cvmfs web api.
+# Both applications are driven in-process, the wsgi one from a pool of
+#  threads like mod_wsgi and the asgi one from tasks on an event loop.
+#  The geo database and DNS are replaced by synthetic stand-ins, with a
+#  configurable DNS latency, so no network or GeoLite2 database is
+#  needed.
+#
+# Usage: loadtest_api.py [-n requests] [-c wsgi threads]
+#          [-a asgi concurrency] [-w dns workers] [-l dns latency]
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import random
+import socket
+import sys
+import threading
+import time
+import zlib
+from concurrent import futures
+
+sys.path.append('.')
+sys.path.append('/usr/share/cvmfs-server/webapi')
+
+import cvmfs_geo
+import cvmfs_asgi
+
+# Geo database stand-in, placing every 10.x.y.z address at a location
+#  derived from x and y
+class SyntheticGeoDb():
+    def get(self, addr):
+        parts = addr.split('.')
+        if len(parts) != 4 or parts[0] != '10':
+            return None
+        return {'location': {'latitude': int(parts[1]) * 179.0 / 255 - 89.5,
+                             'longitude': int(parts[2]) * 359.0 / 255 - 179.5}}
+
+    def close(self):
+        pass
+
+# DNS stand-in resolving <anything>.example.org to a stable 10.x.y.z
+#  address after sleeping for latency seconds
+class FakeDns():
+    def __init__(self, latency):
+        self.latency = latency
+        self.lookups = 0
+        self.lock = threading.Lock()
+
+    def getaddrinfo(self, name, port, *args):
+        self.lock.acquire()
+        self.lookups += 1
+        self.lock.release()
+        time.sleep(self.latency)
+        if not name.endswith('.example.org'):
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        h = zlib.crc32(name.encode())
+        addr = '10.%d.%d.%d' % (h & 0xff, (h >> 8) & 0xff, (h >> 16) & 0xff)
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                 (addr, port))]
+
+def load_wsgi_application():
+    namespace = {'__file__': 'cvmfs-api.wsgi'}
+    with open('cvmfs-api.wsgi') as f:
+        exec(compile(f.read(), 'cvmfs-api.wsgi', 'exec'), namespace)
+    return namespace['application']
+
+# Forget everything cached so both modes start out cold
+def reset_geo():
+    cvmfs_geo.geo_cache.clear()
+    cvmfs_geo.addr_cache.clear()
+    cvmfs_geo.response_cache.clear()
+    cvmfs_geo.server_index = {}
+    cvmfs_geo.server_index_time = int(time.time())
+    cvmfs_geo.gihandle = cvmfs_geo.GeoDbHandle(SyntheticGeoDb(), 0)
+
+# Generate environs for geo requests from many proxies, each asking to
+#  sort a few of a fixed set of servers
+def make_requests(count, seed=0):
+    rnd = random.Random(seed)
+    servers = ['s%d.example.org' % i for i in range(30)]
+    requests = []
+    for i in range(count):
+        proxy = 'proxy%d.example.org' % rnd.randrange(count // 4 + 1)
+        path = '/repo/v1.0/geo/' + proxy + '/' + \
+            ','.join(rnd.sample(servers, rnd.randint(3, 10)))
+        requests.append({'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                         'REMOTE_ADDR': '10.%d.%d.1' % (rnd.randrange(256),
+                                                        rnd.randrange(256))})
+    return requests
+
+def run_wsgi(application, requests, concurrency):
+    def start_response(status, headers):
+        pass
+    def serve(environ):
+        return b''.join(application(environ, start_response))
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    start = time.time()
+    list(executor.map(serve, requests))
+    elapsed = time.time() - start
+    executor.shutdown()
+    return elapsed
+
+def run_asgi(requests, concurrency):
+    async def serve(environ, semaphore):
+        async with semaphore:
+            scope = {'type': 'http', 'method': environ['REQUEST_METHOD'],
+                     'path': environ['PATH_INFO'], 'headers': [],
+                     'client': (environ['REMOTE_ADDR'], 0)}
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+            async def send(message):
+                pass
+            await cvmfs_asgi.application(scope, receive, send)
+    async def serve_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*[serve(e, semaphore) for e in requests])
+    start = time.time()
+    asyncio.run(serve_all())
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare wsgi and asgi mode')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=64,
+                        help='number of wsgi threads')
+    parser.add_argument('-a', '--asgi-concurrency', type=int, default=1000,
+                        help='number of concurrent asgi requests')
+    parser.add_argument('-w', '--dns-workers', type=int,
+                        default=cvmfs_geo.dns_workers)
+    parser.add_argument('-l', '--latency', type=float, default=0.05,
+                        help='DNS latency in seconds')
+    args = parser.parse_args()
+
+    dns = FakeDns(args.latency)
+    socket.getaddrinfo = dns.getaddrinfo
+    requests = make_requests(args.requests)
+
+    for mode in ('wsgi', 'asgi'):
+        reset_geo()
+        cvmfs_geo.resolver = cvmfs_geo.Resolver(args.dns_workers)
+        dns.lookups = 0
+        if mode == 'wsgi':
+            elapsed = run_wsgi(load_wsgi_application(), requests,
+                               args.concurrency)
+        else:
+            elapsed = run_asgi(requests, args.asgi_concurrency)
+        print('%s: %d requests in %.2fs, %.0f requests/s, %d DNS lookups' %
+              (mode, len(requests), elapsed, len(requests) / elapsed,
+               dns.lookups))
+
+if __name__ == '__main__':
+    main()
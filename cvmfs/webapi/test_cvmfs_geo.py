@@ -1,12 +1,21 @@
 from __future__ import print_function
 import unittest
 import socket
+import random
+import time
+import threading
+from array import array
 
 import cvmfs_geo
+import cvmfs_metrics
 from cvmfs_geo import distance_on_unit_sphere
 from cvmfs_geo import addr_geoinfo
 from cvmfs_geo import name_geoinfo
 from cvmfs_geo import geosort_servers
+from cvmfs_geo import geo_unit_vector
+from cvmfs_geo import geosort_vectors
+from cvmfs_geo import server_geoinfo
+from cvmfs_geo import refresh_server_index
 
 ###
 # Simulate a small geo IP database, since we can't always
@@ -67,7 +76,14 @@ class giTestDb():
 
         return {'location' : answer}
 
-cvmfs_geo.gireader = giTestDb()
+cvmfs_geo.gihandle = cvmfs_geo.GeoDbHandle(giTestDb(), 0)
+
+# Lookups and server index refreshes started in the background by an
+#  earlier test would call a patched resolve_geoinfo, so wait for them
+#  to finish first.
+def wait_for_lookups():
+    while cvmfs_geo.server_index_refreshing or cvmfs_geo.resolver.inflight:
+        time.sleep(0.01)
 
 ####
 
@@ -117,14 +133,14 @@ class GeoTest(unittest.TestCase):
         self.assertEqual(4, len(cvmfs_geo.geo_cache))
 
         # test the caching, when there's no database available
-        savegireader = cvmfs_geo.gireader
-        cvmfs_geo.gireader = None
+        savehandle = cvmfs_geo.gihandle
+        cvmfs_geo.gihandle = None
         now = 1
         self.assertEqual(CERNgeo, name_geoinfo(now, CERNname))
         self.assertEqual(FNALgeo, name_geoinfo(now, FNALname))
         self.assertEqual(IHEPgeo, name_geoinfo(now, IHEPname))
         self.assertEqual(RALgeo,  name_geoinfo(now, RALname))
-        cvmfs_geo.gireader = savegireader
+        cvmfs_geo.gihandle = savehandle
 
     def test4GeosortServers(self):
         self.assertEqual([True, [3, 0, 1, 2]],
@@ -138,6 +154,483 @@ class GeoTest(unittest.TestCase):
         self.assertEqual([True, [3, 2, 1, 0]],
             geosort_servers(0, FNALgeo, [IHEPname, CERNname, RALname, FNALname]))
 
+    def test5GeosortVectors(self):
+        # compare against sorting by distance_on_unit_sphere, with
+        #  unknown servers at infinity and ties kept in original order
+        def check(gir_rem, girs):
+            arcs = []
+            vectors = array('d')
+            located = []
+            for gir in girs:
+                if gir is None:
+                    arcs.append(float("inf"))
+                    located.append(None)
+                    vectors.extend((0.0, 0.0, 0.0))
+                else:
+                    arcs.append(distance_on_unit_sphere(
+                        gir_rem['latitude'], gir_rem['longitude'],
+                        gir['latitude'], gir['longitude']))
+                    located.append((gir['latitude'], gir['longitude']))
+                    vectors.extend(geo_unit_vector(gir))
+            expected = sorted(range(len(arcs)), key=lambda i: arcs[i])
+            self.assertEqual(expected,
+                geosort_vectors(gir_rem, vectors, located))
+
+        rnd = random.Random(5)
+        for n in range(40):
+            gir_rem = {'latitude': rnd.uniform(-90, 90),
+                       'longitude': rnd.uniform(-180, 180)}
+            girs = []
+            for i in range(rnd.randint(1, 30)):
+                choice = rnd.random()
+                if choice < 0.1:
+                    girs.append(None)
+                elif choice < 0.2:
+                    girs.append(gir_rem)
+                elif choice < 0.3 and len(girs) > 0:
+                    girs.append(girs[-1])
+                else:
+                    girs.append({'latitude': rnd.uniform(-90, 90),
+                                 'longitude': rnd.uniform(-180, 180)})
+            check(gir_rem, girs)
+
+        # servers a few metres apart around the client, in pairs that are
+        #  equally far away, where rounding decides the order of the
+        #  cosines
+        for n in range(200):
+            gir_rem = {'latitude': rnd.uniform(-89, 89),
+                       'longitude': rnd.uniform(-179, 179)}
+            girs = []
+            for i in range(rnd.randint(1, 5)):
+                dlat = rnd.uniform(-0.0001, 0.0001)
+                dlong = rnd.uniform(-0.0001, 0.0001)
+                for sign in (1, -1):
+                    girs.append({'latitude': gir_rem['latitude'] + dlat,
+                                 'longitude': gir_rem['longitude'] +
+                                    sign * dlong})
+            rnd.shuffle(girs)
+            check(gir_rem, girs)
+
+    def test6ServerIndex(self):
+        self.assertEqual([True, [1, 0]],
+            geosort_servers(0, FNALgeo, [CERNname, FNALname], True))
+        self.assertEqual((CERNgeo, geo_unit_vector(CERNgeo)),
+                         cvmfs_geo.server_index[CERNname])
+        # CDN names are looked up too, but only indexed if they resolve
+        self.assertFalse('ip.' + CERNname in cvmfs_geo.server_index)
+
+        # a full index drops the least recently used name
+        savemax = cvmfs_geo.server_index_max_entries
+        cvmfs_geo.server_index_max_entries = 2
+        cvmfs_geo.server_index = {}
+        server_geoinfo(1, CERNname)
+        server_geoinfo(2, IHEPname)
+        self.assertEqual(None, server_geoinfo(3, 'unknown.invalid'))
+        self.assertEqual(set([CERNname, IHEPname]),
+                         set(cvmfs_geo.server_index))
+        server_geoinfo(4, CERNname)
+        server_geoinfo(5, RALname)
+        self.assertEqual(set([CERNname, RALname]),
+                         set(cvmfs_geo.server_index))
+        cvmfs_geo.server_index_max_entries = savemax
+
+        # a changed database is picked up by a refresh, which doesn't
+        #  go through the name cache
+        class giMovedDb():
+            def get(self, addr):
+                if addr in CERNaddrs:
+                    return {'location' : IHEPgeo}
+                return giTestDb().get(addr)
+        savehandle = cvmfs_geo.gihandle
+        cvmfs_geo.gihandle = cvmfs_geo.GeoDbHandle(giMovedDb(), 0)
+        refresh_server_index(1)
+        cvmfs_geo.gihandle = savehandle
+        self.assertEqual(IHEPgeo, server_geoinfo(1, CERNname)[0])
+        self.assertEqual(CERNgeo, name_geoinfo(1, CERNname))
+        self.assertEqual(1, cvmfs_geo.server_index_time)
+
+        # names that can no longer be located keep their old entry
+        class giEmptyDb():
+            def get(self, addr):
+                return None
+        cvmfs_geo.gihandle = cvmfs_geo.GeoDbHandle(giEmptyDb(), 0)
+        refresh_server_index(2)
+        cvmfs_geo.gihandle = savehandle
+        self.assertEqual(IHEPgeo, server_geoinfo(2, CERNname)[0])
+        refresh_server_index(3)
+        self.assertEqual(CERNgeo, server_geoinfo(3, CERNname)[0])
+
+    def test7ResponseCache(self):
+        statuses = []
+        def start_response(status, headers):
+            statuses.append(status)
+        def api(caching_string, servers, environ={}):
+            path_info = caching_string + '/' + ','.join(servers)
+            body = cvmfs_geo.api(path_info, 'repo', 'v1.0',
+                                 start_response, environ)
+            return b''.join(body).decode('utf-8')
+
+        # api() uses the current time, keep it from refreshing the
+        #  server index
+        cvmfs_geo.server_index_time = int(time.time()) + 3600
+
+        cache = cvmfs_geo.response_cache
+        cache.clear()
+        hits, misses = cache.hits, cache.misses
+        servers = [CERNname, FNALname, IHEPname, RALname]
+        self.assertEqual('4,1,2,3\n', api(RALname, servers))
+        self.assertEqual(misses + 1, cache.misses)
+        self.assertEqual('4,1,2,3\n', api(RALname, servers))
+        self.assertEqual(hits + 1, cache.hits)
+        # the client address maps to the same cell as the caching string
+        self.assertEqual('4,1,2,3\n',
+            api('x', servers, {'REMOTE_ADDR': RALaddrs[0]}))
+        self.assertEqual(hits + 2, cache.hits)
+        # a different layout is a different entry
+        self.assertEqual('1,2,5,4,3\n',
+            api(RALname, [CERNname, FNALname, '+PXYSEP+', IHEPname, RALname]))
+        self.assertEqual(misses + 2, cache.misses)
+        self.assertEqual(['200 OK'] * 4, statuses)
+
+        # bad requests are not cached
+        self.assertTrue(api(RALname, ['unknown.invalid']).startswith('Bad'))
+        self.assertEqual(2, len(cache.entries))
+
+        savemax = cache.max_entries
+        cache.max_entries = 1
+        evictions = cache.evictions
+        api(CERNname, servers)
+        self.assertEqual(evictions + 2, cache.evictions)
+        self.assertEqual(1, len(cache.entries))
+        cache.max_entries = savemax
+
+        # reloading the server locations empties the cache
+        refresh_server_index(4)
+        self.assertEqual(0, len(cache.entries))
+
+        # a response sorted while a lookup timed out is not kept, and
+        #  once the name is known to be bad the full response is
+        headers = []
+        def start_response(status, response_headers):
+            headers.append(dict(response_headers))
+        release = threading.Event()
+        def slow_resolve_geoinfo(now, name):
+            release.wait(5)
+            return None
+        wait_for_lookups()
+        cvmfs_geo.server_index_time = int(time.time()) + 3600
+        saveresolve = cvmfs_geo.resolve_geoinfo
+        savetimeout = cvmfs_geo.dns_timeout_secs
+        cvmfs_geo.resolve_geoinfo = slow_resolve_geoinfo
+        cvmfs_geo.dns_timeout_secs = 0.1
+        self.assertEqual('4,1,2,3,5\n',
+                         api(RALname, servers + ['slow.example.org']))
+        self.assertEqual(0, len(cache.entries))
+        self.assertEqual('max-age=' + str(cvmfs_geo.partial_expire_secs),
+                         headers[-1]['Cache-control'])
+        release.set()
+        wait_for_lookups()
+        cvmfs_geo.resolve_geoinfo = saveresolve
+        cvmfs_geo.dns_timeout_secs = savetimeout
+        self.assertEqual('4,1,2,3,5\n',
+                         api(RALname, servers + ['slow.example.org']))
+        self.assertEqual(1, len(cache.entries))
+        self.assertEqual('max-age=3600', headers[-1]['Cache-control'])
+        cache.clear()
+        cvmfs_geo.geo_cache.clear()
+        cvmfs_geo.server_index = {}
+        cvmfs_geo.server_index_time = 0
+
+    def test8GeoCache(self):
+        cache = cvmfs_geo.GeoCache(threading.Lock(), 3, 1000000, 10, 2)
+        cache.put(0, 'hot', CERNgeo)
+        cache.put(0, 'miss', None)
+        self.assertEqual((True, CERNgeo), cache.get(1, 'hot'))
+        self.assertEqual((False, None), cache.get(1, 'cold'))
+        # negative entries expire sooner, and the stale record is returned
+        self.assertEqual((True, None), cache.get(2, 'miss'))
+        self.assertEqual((False, None), cache.get(3, 'miss'))
+        self.assertEqual((True, CERNgeo), cache.get(10, 'hot'))
+        self.assertEqual((False, CERNgeo), cache.get(11, 'hot'))
+        # the expired entry was bumped, so others keep using it
+        self.assertEqual((True, CERNgeo), cache.get(12, 'hot'))
+        self.assertEqual({'hits': 3, 'age': 12, 'updated': 11,
+                          'negative': False}, cache.entry_stats(12, 'hot'))
+
+        # a flood of new names evicts the least recently used entries
+        for i in range(10):
+            cache.get(20, 'hot')
+            cache.put(20, 'flood%d' % i, None)
+        self.assertEqual(3, len(cache))
+        self.assertTrue('hot' in cache)
+        self.assertFalse('miss' in cache)
+        self.assertEqual(9, cache.evictions)
+
+        # the soft memory limit also evicts
+        cache.max_bytes = 2 * (cache.entry_bytes + len('flood0'))
+        cache.put(30, 'flood0', None)
+        self.assertEqual(2, len(cache))
+        self.assertTrue('flood0' in cache)
+
+        # addresses are cached too, until the database is reopened
+        self.assertEqual(FNALgeo, addr_geoinfo(0, FNALaddrs[0]))
+        self.assertTrue(FNALaddrs[0] in cvmfs_geo.addr_cache)
+
+    def test9Resolver(self):
+        calls = []
+        release = threading.Event()
+        def slow_resolve_geoinfo(now, name):
+            calls.append(name)
+            release.wait(5)
+            return FNALgeo
+        wait_for_lookups()
+        saveresolve = cvmfs_geo.resolve_geoinfo
+        cvmfs_geo.resolve_geoinfo = slow_resolve_geoinfo
+
+        # concurrent lookups of a new name share one resolution
+        lookups = cvmfs_geo.namelookups
+        results = []
+        def lookup():
+            results.append(name_geoinfo(0, 'slow.example.org'))
+        threads = [threading.Thread(target=lookup) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([FNALgeo] * 5, results)
+        self.assertEqual(['slow.example.org'], calls)
+        self.assertEqual(lookups + 1, cvmfs_geo.namelookups)
+
+        # an expired record is served while it is refreshed
+        release.clear()
+        now = cvmfs_geo.geo_cache_secs + 1
+        self.assertEqual(FNALgeo, name_geoinfo(now, 'slow.example.org'))
+        future = cvmfs_geo.resolver.inflight.get('slow.example.org')
+        release.set()
+        if future is not None:
+            future.result()
+        self.assertEqual(2, len(calls))
+
+        # lookups that take too long give up without a record
+        savetimeout = cvmfs_geo.dns_timeout_secs
+        cvmfs_geo.dns_timeout_secs = 0.1
+        release.clear()
+        self.assertEqual(None, name_geoinfo(0, 'slower.example.org'))
+        release.set()
+        cvmfs_geo.dns_timeout_secs = savetimeout
+        wait_for_lookups()
+
+        # once too many lookups are pending, new names are not queued
+        release.clear()
+        resolver = cvmfs_geo.resolver
+        savemax = resolver.max_pending
+        resolver.max_pending = 2
+        refused = resolver.refused
+        calls[:] = []
+        self.assertNotEqual(None, resolver.submit(0, 'slow1.example.org', None))
+        self.assertNotEqual(None, resolver.submit(0, 'slow2.example.org', None))
+        start = time.time()
+        self.assertEqual(None, name_geoinfo(0, 'slow3.example.org'))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(refused + 1, resolver.refused)
+        self.assertEqual(2, len(resolver.inflight))
+        # names already in flight are still joined
+        self.assertNotEqual(None, resolver.submit(0, 'slow1.example.org', None))
+        release.set()
+        wait_for_lookups()
+        self.assertEqual(['slow1.example.org', 'slow2.example.org'],
+                         sorted(calls))
+        resolver.max_pending = savemax
+        cvmfs_geo.resolve_geoinfo = saveresolve
+        cvmfs_geo.geo_cache.clear()
+
+    def test10GeoDbHandle(self):
+        class giClosingDb(giTestDb):
+            closed = False
+            def close(self):
+                self.closed = True
+        savehandle = cvmfs_geo.gihandle
+        olddb = giClosingDb()
+        cvmfs_geo.gihandle = cvmfs_geo.GeoDbHandle(olddb, 1)
+        self.assertEqual(FNALgeo, addr_geoinfo(0, FNALaddrs[0]))
+        self.assertTrue(FNALaddrs[0] in cvmfs_geo.addr_cache)
+
+        # a handle still in use is only closed when its user is done
+        oldhandle = cvmfs_geo.gihandle
+        self.assertTrue(oldhandle.acquire())
+        newdb = giClosingDb()
+        cvmfs_geo.publish_geodb(newdb, 2)
+        self.assertEqual(2, cvmfs_geo.geodb_modtime())
+        self.assertFalse(FNALaddrs[0] in cvmfs_geo.addr_cache)
+        self.assertFalse(olddb.closed)
+        oldhandle.release()
+        self.assertTrue(olddb.closed)
+        self.assertFalse(oldhandle.acquire())
+        self.assertFalse(newdb.closed)
+        self.assertEqual(IHEPgeo, addr_geoinfo(0, IHEPaddrs[0]))
+
+        cvmfs_geo.gihandle = savehandle
+
+    def test11Asgi(self):
+        import asyncio
+        import cvmfs_asgi
+        cvmfs_geo.server_index_time = int(time.time()) + 3600
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': 'GET',
+                 'path': '/cvmfs/repo/api/v1.0/geo/x/' +
+                    ','.join([CERNname, FNALname, IHEPname, RALname]),
+                 'headers': [(b'x-forwarded-for', IHEPaddrs[0].encode())],
+                 'client': ('127.0.0.1', 12345)}
+        asyncio.run(cvmfs_asgi.application(scope, receive, send))
+        self.assertEqual(200, messages[0]['status'])
+        self.assertEqual(b'3,4,1,2\n', messages[1]['body'])
+
+        messages = []
+        scope['path'] = '/malformed'
+        asyncio.run(cvmfs_asgi.application(scope, receive, send))
+        self.assertEqual(400, messages[0]['status'])
+
+        # a body longer than any api takes is refused while it is read
+        chunks = []
+        async def receive_chunks():
+            chunks.append(1)
+            return {'type': 'http.request', 'body': b'x' * 65536,
+                    'more_body': True}
+        messages = []
+        scope['method'] = 'POST'
+        scope['path'] = '/cvmfs/repo/api/v1.0/geo-batch/'
+        asyncio.run(cvmfs_asgi.application(scope, receive_chunks, send))
+        self.assertEqual(413, messages[0]['status'])
+        self.assertTrue(len(chunks) * 65536 <= cvmfs_asgi.max_body_bytes +
+                        65536)
+
+        # leave the name cache empty for test3NameGeoinfo
+        cvmfs_geo.geo_cache.clear()
+        cvmfs_geo.server_index = {}
+        cvmfs_geo.server_index_time = 0
+
+    def test12GeoBatch(self):
+        import io
+        import cvmfs_api
+        cvmfs_geo.server_index_time = int(time.time()) + 3600
+        statuses = []
+        def start_response(status, headers):
+            statuses.append(status)
+        servers = ','.join([CERNname, FNALname, IHEPname, RALname])
+        body = '\n'.join([RALname + '/' + servers,
+                          'x/' + servers,
+                          '',
+                          'noslash',
+                          FNALname + '/unknown.invalid',
+                          IHEPname + '/' + servers]).encode('utf-8')
+        environ = {'REQUEST_METHOD': 'POST',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body),
+                   'REMOTE_ADDR': CERNaddrs[0]}
+        response = cvmfs_api.dispatch('geo-batch', '', 'repo', 'v1.0',
+                                      start_response, environ)
+        self.assertEqual(['200 OK'], statuses)
+        self.assertEqual('4,1,2,3\n1,4,2,3\n\n\n3,4,1,2\n',
+                         b''.join(response).decode('utf-8'))
+
+        environ['REQUEST_METHOD'] = 'GET'
+        cvmfs_api.dispatch('geo-batch', '', 'repo', 'v1.0',
+                           start_response, environ)
+        self.assertEqual('400 Bad Request', statuses[-1])
+
+        # too many entries are refused
+        body = ('x/' + servers + '\n').encode('utf-8') * \
+                    (cvmfs_geo.batch_max_entries + 1)
+        environ = {'REQUEST_METHOD': 'POST',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body),
+                   'REMOTE_ADDR': CERNaddrs[0]}
+        cvmfs_api.dispatch('geo-batch', '', 'repo', 'v1.0',
+                           start_response, environ)
+        self.assertEqual('400 Bad Request', statuses[-1])
+
+        # slow lookups share one deadline instead of one each
+        release = threading.Event()
+        def slow_resolve_geoinfo(now, name):
+            release.wait(5)
+            return None
+        wait_for_lookups()
+        saveresolve = cvmfs_geo.resolve_geoinfo
+        savetimeout = cvmfs_geo.dns_timeout_secs
+        cvmfs_geo.resolve_geoinfo = slow_resolve_geoinfo
+        cvmfs_geo.dns_timeout_secs = 0.2
+        body = '\n'.join(['slow%d.example.org/%s' % (i, servers)
+                          for i in range(10)]).encode('utf-8')
+        environ = {'REQUEST_METHOD': 'POST',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body),
+                   'REMOTE_ADDR': CERNaddrs[0]}
+        start = time.time()
+        response = cvmfs_api.dispatch('geo-batch', '', 'repo', 'v1.0',
+                                      start_response, environ)
+        elapsed = time.time() - start
+        release.set()
+        cvmfs_geo.resolve_geoinfo = saveresolve
+        cvmfs_geo.dns_timeout_secs = savetimeout
+        self.assertEqual('200 OK', statuses[-1])
+        self.assertTrue(elapsed < 1, elapsed)
+        self.assertEqual(None, getattr(cvmfs_geo.lookup_deadline, 'time'))
+
+        cvmfs_geo.geo_cache.clear()
+        cvmfs_geo.response_cache.clear()
+        cvmfs_geo.server_index = {}
+        cvmfs_geo.server_index_time = 0
+
+    def test13Metrics(self):
+        import cvmfs_api
+        statuses = []
+        headers = []
+        def start_response(status, response_headers):
+            statuses.append(status)
+            headers.extend(response_headers)
+        self.assertEqual(CERNgeo, addr_geoinfo(0, CERNaddrs[0]))
+        response = cvmfs_api.dispatch('metrics', '', 'repo', 'v1.0',
+                                      start_response, {})
+        self.assertEqual(['200 OK'], statuses)
+        self.assertTrue(('Cache-control', 'max-age=0') in headers)
+        lines = b''.join(response).decode('utf-8').splitlines()
+        self.assertTrue('# TYPE cvmfs_geo_cache_hits_total counter' in lines)
+        self.assertTrue('# TYPE cvmfs_geo_dns_lookup_seconds histogram'
+                        in lines)
+        count = [l for l in lines
+                 if l.startswith('cvmfs_geo_mmdb_lookup_seconds_count ')]
+        self.assertEqual(1, len(count))
+        self.assertTrue(int(count[0].split()[1]) > 0)
+        self.assertEqual(1, len([l for l in lines if l.startswith(
+            'cvmfs_geo_lock_contended_total{lock="namelock"} ')]))
+        # every metric family is declared once, before its samples
+        types = [l for l in lines if l.startswith('# TYPE')]
+        self.assertEqual(len(set(types)), len(types))
+
+        # the client stage of a proxied request is timed, not the
+        #  position of the address in X-Forwarded-For
+        client = cvmfs_geo.stage_histograms['client']
+        before = client.snapshot()
+        cvmfs_geo.geo_request(0, 'x', CERNname,
+            {'HTTP_X_FORWARDED_FOR': '10.0.0.1, ' + FNALaddrs[0]})
+        after = client.snapshot()
+        self.assertEqual(before[1] + 1, after[1])
+        self.assertTrue(after[2] - before[2] < 60)
+        cvmfs_geo.geo_cache.clear()
+        cvmfs_geo.response_cache.clear()
+        cvmfs_geo.server_index = {}
+
+        histogram = cvmfs_metrics.Histogram((0.1, 1.0))
+        for secs in (0.05, 0.5, 0.7, 2.0):
+            histogram.observe(secs)
+        self.assertEqual(([1, 3], 4, 3.25), histogram.snapshot())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -679,6 +679,7 @@ systemctl daemon-reload
 %defattr(-,root,root)
 %{_bindir}/cvmfs_shrinkwrap
 /usr/libexec/cvmfs/shrinkwrap/spec_builder.py*
+/usr/libexec/cvmfs/shrinkwrap/trace_compact.py*
 %doc COPYING AUTHORS README.md ChangeLog
 
 %files unittests